@@ -0,0 +1,155 @@
+# encoding: utf-8
+'''
+Admission control in front of the webhook handlers - one chatty user or a retry storm must not
+starve everyone else.
+
+AdmissionControl, a WebhookDispatcher wrapper, refuses a call when
+
+    - `max_in_flight` handler calls are already running in this process (load shedding)
+    - the caller's user went over `user_rate` calls per second (token bucket, `user_burst` deep)
+    - the webhook went over its own rate (`webhook_rates`, or `default_webhook_rate`)
+
+and answers it with a pre-encoded "try again" TextMessage - a 200, so BotKit shows the message
+instead of retrying and making things worse.
+
+Buckets live in an LRU of at most `max_buckets`; a bucket idle for `idle_timeout` seconds is full
+again anyway, so it is dropped (checked on the oldest ones at every call - O(1) amortized).
+'''
+from __future__ import unicode_literals, division
+import threading
+import time
+import types
+from collections import OrderedDict
+
+from botkit_messages import BotkitResponse, TextMessage
+from response_cache import StaticResponse
+
+TRY_AGAIN_RESPONSE = StaticResponse('try_again', BotkitResponse([
+    TextMessage("I'm a bit overwhelmed right now, please try again in a few seconds"),
+]))
+
+
+class TokenBucket(object):
+    """`rate` tokens per second, at most `burst` of them"""
+    __slots__ = ('tokens', 'updated')
+
+    def __init__(self, burst, now):
+        self.tokens = burst
+        self.updated = now
+
+    def refill(self, now, rate, burst):
+        """Add the tokens earned since the last refill, return True if one can be taken"""
+        self.tokens = min(burst, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        return self.tokens >= 1
+
+    def take(self):
+        """Take a token - after `refill` said there is one"""
+        self.tokens -= 1
+
+
+class AdmissionControl(object):
+    """Token bucket limits per user and per webhook, and a bound on the calls in flight"""
+
+    def __init__(self, user_rate=5, user_burst=20, webhook_rates=None, default_webhook_rate=None,
+                 max_in_flight=64, max_buckets=100000, idle_timeout=300, exempt=(), reply=TRY_AGAIN_RESPONSE,
+                 clock=time.monotonic):
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        # {webhook: (rate, burst)}
+        self.webhook_rates = dict(webhook_rates or {})
+        self.default_webhook_rate = default_webhook_rate
+        self.max_in_flight = max_in_flight
+        self.max_buckets = max_buckets
+        self.idle_timeout = idle_timeout
+        self.exempt = frozenset(exempt)
+        self.reply = reply
+        self._clock = clock
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self.admitted = 0
+        self.shed = 0
+        self.limited = 0
+
+    def _bucket(self, key, burst, now):
+        buckets = self._buckets
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = TokenBucket(burst, now)
+            if len(buckets) > self.max_buckets:
+                buckets.popitem(last=False)
+        else:
+            buckets.move_to_end(key)
+        return bucket
+
+    def _evict_idle(self, now):
+        buckets = self._buckets
+        # the least recently used buckets come first - stop at the first one still in use
+        for _ in range(2):
+            if not buckets:
+                return
+            key = next(iter(buckets))
+            if now - buckets[key].updated < self.idle_timeout:
+                return
+            del buckets[key]
+
+    def admit(self, webhook_request):
+        """True if the call may run - it then counts as in flight until `release`"""
+        webhook = webhook_request.webhook
+        now = self._clock()
+        with self._lock:
+            if self._in_flight >= self.max_in_flight:
+                self.shed += 1
+                return False
+            self._evict_idle(now)
+            # every bucket is checked before any token is taken - a call refused by one costs nothing from the others
+            buckets = []
+            user = webhook_request.user
+            if user is not None and user.user_id is not None and self.user_rate:
+                buckets.append((self._bucket(('user', user.user_id), self.user_burst, now), self.user_rate,
+                                self.user_burst))
+            webhook_rate = self.webhook_rates.get(webhook, self.default_webhook_rate)
+            if webhook_rate is not None:
+                buckets.append((self._bucket(('webhook', webhook), webhook_rate[1], now),) + tuple(webhook_rate))
+            if not all([bucket.refill(now, rate, burst) for bucket, rate, burst in buckets]):
+                self.limited += 1
+                return False
+            for bucket, _, _ in buckets:
+                bucket.take()
+            self._in_flight += 1
+            self.admitted += 1
+            return True
+
+    def release(self):
+        """An admitted call is done"""
+        with self._lock:
+            self._in_flight -= 1
+
+    def wrapper(self, call, webhook_request):
+        """WebhookDispatcher wrapper"""
+        if webhook_request.webhook in self.exempt:
+            return call(webhook_request)
+        if not self.admit(webhook_request):
+            return self.reply
+        try:
+            reply = call(webhook_request)
+        except BaseException:
+            self.release()
+            raise
+        if isinstance(reply, types.GeneratorType):
+            # still in flight while its messages are produced
+            return self._released_after(reply)
+        self.release()
+        return reply
+
+    def _released_after(self, reply):
+        try:
+            yield from reply
+        finally:
+            self.release()
+
+    def stats(self):
+        """Counters of the admission decisions"""
+        return dict(in_flight=self._in_flight, admitted=self.admitted, shed=self.shed, limited=self.limited,
+                    buckets=len(self._buckets))
@@ -0,0 +1,369 @@
+# encoding: utf-8
+'''
+ASGI execution mode of the webhooks app - same APP, same routes.
+
+    uvicorn asgi:ASGI_APP
+
+The Flask views keep running as they are, on a bounded thread pool (`max_workers`, 32 threads),
+while I/O bound routes can be served by coroutines registered with `AsgiApp.async_route` - those
+do not hold a thread while they wait. Only /https_proxy is one, when httpx is installed (it is
+optional, without it the proxy runs on the thread pool too). It shares the cache and the limits
+of the WSGI proxy, so both modes behave the same. Every other route, the webhooks included, runs
+on the pool: at most `max_workers` of them at a time, like on a threaded WSGI server - ASGI only
+adds thousands of concurrent calls to the proxy.
+
+The views read the request body as it arrives, with their own limits (a /webhook/batch of NDJSON
+is handled line by line), exactly as under WSGI. Coroutine routes get the whole body, up to
+`max_body_size`.
+
+Coroutine routes skip the Flask request hooks, so AsgiApp does their part itself: each call is
+recorded in the `metrics` ('http' family, like the views) and in the traffic `capture` when
+sampled. They are not compressed - neither is the proxied body in WSGI mode.
+
+See benchmarks/load_asgi.py for the concurrency of both modes against a slow upstream.
+'''
+from __future__ import unicode_literals, division
+import asyncio
+import contextvars
+import io
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, unquote
+
+from werkzeug.http import unquote_etag, parse_etags
+
+from my_app import APP, CAPTURE, METRICS, PROXY
+from proxy import CacheEntry, cache_lifetime, freshness_lifetime, HOP_BY_HOP_HEADERS, UPSTREAM_ACCEPT_ENCODING
+
+try:
+    import httpx
+except ImportError: # optional - without it /https_proxy runs on the thread pool
+    httpx = None
+
+
+class AsgiApp(object):
+    """ASGI application running a WSGI app on a thread pool, plus native coroutine routes"""
+
+    def __init__(self, wsgi_app, max_workers=32, max_body_size=1024 * 1024, metrics=None, capture=None):
+        self.wsgi_app = wsgi_app
+        self.max_workers = max_workers
+        self.max_body_size = max_body_size
+        self.metrics = metrics
+        self.capture = capture
+        self._executor = None
+        self._async_routes = {}
+
+    def async_route(self, path):
+        """Decorator - serve `path` with `coroutine(scope, body, send)` instead of the WSGI app"""
+        def decorator(coroutine):
+            self._async_routes[path] = coroutine
+            return coroutine
+        return decorator
+
+    @property
+    def executor(self):
+        """The pool running the WSGI views"""
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix='wsgi')
+        return self._executor
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            raise ValueError("Unsupported ASGI scope type {!r}".format(scope['type']))
+        coroutine = self._async_routes.get(scope['path'])
+        if coroutine is None:
+            await self._run_wsgi(scope, receive, send)
+            return
+        body = await self._read_body(receive)
+        if body is None:
+            await send_simple(send, 413, b"Request body too large")
+            return
+        await self._run_coroutine(coroutine, scope, body, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                for hook in self._shutdown_hooks():
+                    await hook()
+                if self._executor is not None:
+                    self._executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def _shutdown_hooks(self):
+        return [route.aclose for route in self._async_routes.values() if hasattr(route, 'aclose')]
+
+    async def _read_body(self, receive):
+        chunks = []
+        size = 0
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                break
+            chunk = message.get('body', b'')
+            size += len(chunk)
+            if size > self.max_body_size:
+                return None
+            chunks.append(chunk)
+            if not message.get('more_body'):
+                break
+        return b''.join(chunks)
+
+    async def _run_coroutine(self, coroutine, scope, body, send):
+        """Run a coroutine route, recording it like the Flask hooks record the views"""
+        capture = self.capture
+        record = None
+        if capture is not None and capture.sampled(scope['path']):
+            headers = dict((name.decode('latin-1').lower(), value.decode('latin-1'))
+                           for name, value in scope.get('headers', ()))
+            record = capture.start(scope['method'], scope['path'], scope.get('query_string', b'').decode('latin-1'),
+                                   dict((name, headers[name.lower()]) for name, _ in capture.headers
+                                        if headers.get(name.lower())),
+                                   headers.get('content-type'), body)
+        status = [500]
+        size = [0]
+
+        async def observed_send(message):
+            if message['type'] == 'http.response.start':
+                status[0] = message['status']
+            elif message['type'] == 'http.response.body':
+                size[0] += len(message.get('body', b''))
+            await send(message)
+
+        started = time.perf_counter()
+        try:
+            await coroutine(scope, body, observed_send)
+        finally:
+            seconds = time.perf_counter() - started
+            if self.metrics is not None:
+                self.metrics.record('http', scope['path'], int(seconds * 1e6), error=status[0] >= 500,
+                                    bytes_in=len(body), bytes_out=size[0])
+            if record is not None:
+                capture.finish(record, status[0], size[0], seconds)
+
+    async def _run_wsgi(self, scope, receive, send):
+        """Run the WSGI app on the pool, streaming its input and its output as they come"""
+        loop = asyncio.get_running_loop()
+        # every step runs in the same context - Flask keeps its request context in context vars,
+        # and the steps of one request may land on different threads of the pool
+        context = contextvars.Context()
+        started = []
+
+        def start_response(status, headers, exc_info=None): # pylint:disable=unused-argument
+            started[:] = [int(status.split(' ', 1)[0]),
+                          [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]]
+            return lambda data: None
+
+        environ = wsgi_environ(scope, io.BufferedReader(_ReceivedBody(receive, loop)))
+        result = await loop.run_in_executor(self.executor, context.run, self.wsgi_app, environ, start_response)
+        iterator = iter(result)
+        try:
+            while True:
+                chunk = await loop.run_in_executor(self.executor, context.run, next, iterator, None)
+                if chunk is None:
+                    break
+                if started[0] is not None:
+                    await send({'type': 'http.response.start', 'status': started[0], 'headers': started[1]})
+                    started[0] = None
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            if started[0] is not None:
+                await send({'type': 'http.response.start', 'status': started[0], 'headers': started[1]})
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            if hasattr(result, 'close'):
+                await loop.run_in_executor(self.executor, context.run, result.close)
+
+
+class _ReceivedBody(io.RawIOBase):
+    """The request body of an ASGI call, as a WSGI input - read on a worker thread, received by the loop"""
+
+    def __init__(self, receive, loop):
+        super(_ReceivedBody, self).__init__()
+        self._receive = receive
+        self._loop = loop
+        self._chunk = b''
+        self._done = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._chunk and not self._done:
+            message = asyncio.run_coroutine_threadsafe(self._receive(), self._loop).result()
+            if message['type'] == 'http.disconnect':
+                self._done = True
+                break
+            self._chunk = message.get('body', b'')
+            self._done = not message.get('more_body')
+        size = min(len(buffer), len(self._chunk))
+        buffer[:size] = self._chunk[:size]
+        self._chunk = self._chunk[size:]
+        return size
+
+
+def wsgi_environ(scope, stream):
+    """The WSGI environ of an ASGI http scope (PEP 3333) - `stream` is the request body"""
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/{}'.format(scope.get('http_version', '1.1')),
+        'REMOTE_ADDR': (scope.get('client') or ('', 0))[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': stream,
+        # the input ends with the body, whether it has a Content-Length or is chunked
+        'wsgi.input_terminated': True,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', ()):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            environ[name] = value
+            continue
+        key = 'HTTP_' + name
+        environ[key] = environ[key] + ',' + value if key in environ else value
+    return environ
+
+
+async def send_simple(send, status, body, headers=(), head=False):
+    """Send a complete, small response - only its headers if `head`"""
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-length', str(len(body)).encode('ascii'))] + list(headers)})
+    await send({'type': 'http.response.body', 'body': b'' if head else body})
+
+
+class AsyncHttpsProxy(object):
+    """Coroutine version of /https_proxy - streams from a pooled httpx.AsyncClient
+
+    It shares its cache and limits with `proxy` (the CachingProxy of the WSGI view).
+    """
+
+    def __init__(self, proxy, max_connections=1000):
+        self.proxy = proxy
+        self.max_connections = max_connections
+        self._client = None
+
+    @property
+    def client(self):
+        """The pooled client, created on first use (inside the running loop)"""
+        if self._client is None:
+            connect_timeout, read_timeout = self.proxy.timeout
+            self._client = httpx.AsyncClient(
+                follow_redirects=True,
+                timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+                limits=httpx.Limits(max_connections=self.max_connections,
+                                    max_keepalive_connections=self.proxy.pool_size))
+        return self._client
+
+    async def aclose(self):
+        """Close the pooled connections"""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def __call__(self, scope, body, send): # pylint:disable=unused-argument
+        if scope['method'] not in ('GET', 'HEAD'):
+            await send_simple(send, 405, b"Method Not Allowed", [(b'allow', b'GET, HEAD')])
+            return
+        url = parse_qs(scope.get('query_string', b'').decode('latin-1')).get('url', [''])[0]
+        if not url:
+            await send_simple(send, 200, b"No URL", [(b'content-type', b'text/html; charset=utf-8')])
+            return
+        url = unquote(url)
+        if not url.startswith(('http://', 'https://')):
+            await send_simple(send, 400, b"Only http(s) URLs can be proxied")
+            return
+        if_none_match = dict(scope.get('headers', ())).get(b'if-none-match', b'').decode('latin-1')
+        head = scope['method'] == 'HEAD'
+        now = time.time()
+        entry = self.proxy.cache.get(url)
+        if entry is not None and entry.is_fresh(now):
+            await self._send_cached(send, entry, if_none_match, head)
+            return
+        upstream_headers = {'Accept-Encoding': UPSTREAM_ACCEPT_ENCODING}
+        if entry is not None:
+            if entry.etag:
+                upstream_headers['If-None-Match'] = entry.etag
+            if entry.last_modified:
+                upstream_headers['If-Modified-Since'] = entry.last_modified
+        try:
+            res = await self.client.send(self.client.build_request(scope['method'], url, headers=upstream_headers),
+                                         stream=True)
+        except httpx.HTTPError:
+            await send_simple(send, 502, b"Upstream request failed")
+            return
+        try:
+            if entry is not None and res.status_code == 304:
+                self.proxy.cache.revalidated(entry, now + (freshness_lifetime(res.headers, now) or 0))
+                await self._send_cached(send, entry, if_none_match, head)
+                return
+            length = res.headers.get('Content-Length')
+            if length and length.isdigit() and int(length) > self.proxy.max_body_size:
+                await send_simple(send, 502, b"Upstream response too large")
+                return
+            await self._stream(send, url, res, now, head)
+        finally:
+            await res.aclose()
+
+    async def _stream(self, send, url, res, now, head=False):
+        skipped = HOP_BY_HOP_HEADERS.union(name.strip().lower() for name in res.headers.get('Connection', '').split(',')
+                                           if name.strip())
+        headers = [(key, value) for key, value in res.headers.items() if key.lower() not in skipped]
+        if head:
+            # the headers of the upstream HEAD, nothing to stream nor to cache
+            await send({'type': 'http.response.start', 'status': res.status_code,
+                        'headers': [(key.encode('latin-1'), value.encode('latin-1')) for key, value in headers]})
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+        lifetime = cache_lifetime(res.status_code, res.headers, now)
+        kept = [] if lifetime is not None else None
+        await send({'type': 'http.response.start', 'status': res.status_code,
+                    'headers': [(key.encode('latin-1'), value.encode('latin-1')) for key, value in headers]})
+        deadline = now + self.proxy.total_timeout
+        sent = 0
+        complete = True
+        async for chunk in res.aiter_raw(self.proxy.chunk_size):
+            sent += len(chunk)
+            if sent > self.proxy.max_body_size or time.time() > deadline:
+                complete = False
+                break
+            if kept is not None:
+                kept.append(chunk)
+                if sent > self.proxy.max_cached_body_size:
+                    kept = None
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+        if complete and kept is not None:
+            self.proxy.cache.put(url, CacheEntry(res.status_code, headers, b''.join(kept), now + lifetime,
+                                                 res.headers.get('ETag'), res.headers.get('Last-Modified')))
+
+    @staticmethod
+    async def _send_cached(send, entry, if_none_match, head=False):
+        if entry.etag and if_none_match and parse_etags(if_none_match).contains_weak(unquote_etag(entry.etag)[0]):
+            await send_simple(send, 304, b'', [(b'etag', entry.etag.encode('latin-1'))])
+            return
+        headers = [(key.lower().encode('latin-1'), value.encode('latin-1')) for key, value in entry.headers
+                   if key.lower() != 'content-length']
+        await send_simple(send, entry.status, entry.body, headers, head)
+
+
+ASGI_APP = AsgiApp(APP, metrics=METRICS, capture=CAPTURE)
+if httpx is not None:
+    ASGI_APP.async_route('/https_proxy')(AsyncHttpsProxy(PROXY))
@@ -0,0 +1,88 @@
+# encoding: utf-8
+'''
+Benchmark of the typed message model against the old dict + jsonify path.
+
+Run from the project root:
+    python -m benchmarks.bench_messages [--number 20000]
+
+Builds and encodes the greeting and capabilities replies both ways, and reports the time per
+reply and the memory allocated per reply (tracemalloc).
+'''
+from __future__ import unicode_literals, division, print_function
+import argparse
+import timeit
+import tracemalloc
+
+from flask import jsonify
+
+from my_app import APP
+from botkit_messages import (BOTKIT_API_LATEST_VERSION, BotkitResponse, encode_bytes, TextMessage, ButtonMessage,
+                             InputTextAction, RichMessage, MultiRichMessage, MultiChoiceQuestion, QuestionnaireEvent,
+                             Hook)
+
+CHOICES = ["YatraBot Please!", "Wait for an agent"]
+QUESTION = "Would you like to talk to YatraBot or wait for an agent?"
+CATEGORIES = [("Flight Status:", ["My flight status", "status of ua-123", "arrivals"]),
+              ("General questions:", ["Time in Rome", "the weather in paris", "Who are you?"]),
+              ("Hotel searches:", ["hotel tonight", "cheap hotel nyc", "3-4 stars for Monday"])]
+
+
+def greeting_dicts():
+    messages = [dict(_type="TextMessage", text="Hello there Tal!"),
+                dict(_type="QuestionnaireEvent",
+                     questionnaireAnsweredHook=dict(webhook="chat_greeting", payload=dict()),
+                     questions=[dict(_type="MultiChoiceQuestion", text=QUESTION, name="bot_or_agent",
+                                     choices=CHOICES)])]
+    return jsonify(dict(messages=messages, botkitVersion=BOTKIT_API_LATEST_VERSION)).get_data()
+
+def greeting_typed():
+    return encode_bytes(BotkitResponse([
+        TextMessage("Hello there Tal!"),
+        QuestionnaireEvent(answered_hook=Hook("chat_greeting", payload=dict()),
+                           questions=[MultiChoiceQuestion(text=QUESTION, name="bot_or_agent", choices=CHOICES)])]))
+
+def capabilities_dicts():
+    messages = [dict(_type="TextMessage", text="I can do many things! Here are a few options:")]
+    rich = [dict(_type="RichMessage", title=title,
+                 buttons=[dict(_type="ButtonMessage", text=text, action=dict(_type="InputTextAction", inputText=text))
+                          for text in texts])
+            for title, texts in CATEGORIES]
+    messages.append(dict(_type="MultiRichMessage", messages=rich))
+    return jsonify(dict(botkitVersion=BOTKIT_API_LATEST_VERSION, messages=messages)).get_data()
+
+def capabilities_typed():
+    rich = [RichMessage(title, buttons=[ButtonMessage(text, action=InputTextAction(text)) for text in texts])
+            for title, texts in CATEGORIES]
+    return encode_bytes(BotkitResponse([TextMessage("I can do many things! Here are a few options:"),
+                                        MultiRichMessage(rich)]))
+
+
+def allocated_per_call(func, calls=200):
+    """Average peak of memory allocated while making one call (tracemalloc)"""
+    func()
+    tracemalloc.start()
+    total = 0
+    for _ in range(calls):
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        func()
+        total += tracemalloc.get_traced_memory()[1] - before
+    tracemalloc.stop()
+    return total / calls
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--number', type=int, default=20000, help="calls per measurement")
+    args = parser.parse_args()
+    with APP.app_context():
+        print("{:<26} {:>12} {:>16}".format("case", "usec/reply", "peak bytes/reply"))
+        for name, func in [('greeting dict+jsonify', greeting_dicts), ('greeting typed', greeting_typed),
+                           ('capabilities dict+jsonify', capabilities_dicts), ('capabilities typed', capabilities_typed)]:
+            seconds = min(timeit.repeat(func, number=args.number, repeat=3))
+            peak = allocated_per_call(func)
+            print("{:<26} {:>12.2f} {:>16.0f}".format(name, seconds / args.number * 1e6, peak))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,201 @@
+# encoding: utf-8
+'''
+Throughput, latency and allocations of every webhook route.
+
+Run from the project root:
+    python -m benchmarks.bench_routes [--mode client|server|both] [--requests 2000] [--routes /sudhanwa,/greeting]
+    python -m benchmarks.bench_routes --save baseline.json
+    python -m benchmarks.bench_routes --compare baseline.json [--threshold 10]
+
+`client` drives the routes through the Flask test client (the cost of the app itself), `server`
+through a real local WSGI server over TCP. /https_proxy fetches from a local stub upstream.
+Allocations are the average tracemalloc peak of one request, measured in client mode.
+
+--save writes the results as JSON, --compare prints the change against such a file and exits
+with status 1 when the p50 latency or the throughput of a route got worse by more than
+--threshold percent.
+'''
+from __future__ import unicode_literals, division, print_function
+import argparse
+import http.client
+import json
+import sys
+import time
+import tracemalloc
+from urllib.parse import quote, urlencode, urlsplit
+
+from benchmarks.servers import start_stub_upstream, start_wsgi_server
+
+GREETING_BODY = {"user": {"firstName": "Tal", "lastName": "Weiss"}}
+LOGIN_QUERY = '?' + urlencode(dict(redirect_uri='https://example.com/cb?a=1', account_linking_token='abc'))
+
+
+def route_cases(upstream, logged_in):
+    """(name, method, path, json body, form body, expected bytes of the reply or None) of every benchmarked call
+
+    `logged_in` is the body of a logged in user - with the authorization code of a real login.
+    """
+    return [
+        ('/simple', 'POST', '/simple', None, None, None),
+        ('/greeting', 'POST', '/greeting', GREETING_BODY, None, b'QuestionnaireEvent'),
+        ('/locked', 'POST', '/locked', {}, None, b'LoginOAuthEvent'),
+        ('/locked (logged in)', 'POST', '/locked', logged_in, None, b'I guess you logged in'),
+        ('/bplogin', 'POST', '/bplogin', logged_in, None, b'airline_boardingpass'),
+        ('/capabilities_evature_airports', 'POST', '/capabilities_evature_airports', {}, None, None),
+        ('/questions', 'POST', '/questions', None, None, b'QuestionnaireEvent'),
+        ('/sudhanwa', 'POST', '/sudhanwa', None, None, None),
+        ('/dl GET', 'GET', '/dl' + LOGIN_QUERY, None, None, None),
+        ('/dl POST', 'POST', '/dl' + LOGIN_QUERY, None, dict(username='username', password='password'), None),
+        ('/https_proxy', 'GET', '/https_proxy?url=' + quote(upstream + '/image.png', safe=''), None, None, None),
+    ]
+
+
+def login(sessions):
+    """The body of a user logged in through /dl - the code BotKit gets once the login succeeded"""
+    return {"user": {"firstName": "Tal"}, "loginData": {"authorization_code": sessions.issue_code(
+        dict(username='username'))}}
+
+
+def client_caller(app):
+    """Returns call(method, path, body, form) -> (status, body), through the Flask test client"""
+    client = app.test_client()
+
+    def call(method, path, body, form):
+        response = client.open(path, method=method, json=body, data=form)
+        data = response.get_data()
+        response.close()
+        return response.status_code, data
+    return call
+
+
+def server_caller(base_url):
+    """Returns call(method, path, body, form) -> (status, body), over TCP to the local server"""
+    parts = urlsplit(base_url)
+
+    def call(method, path, body, form):
+        headers = {}
+        payload = None
+        if body is not None:
+            payload = json.dumps(body)
+            headers['Content-Type'] = 'application/json'
+        elif form is not None:
+            payload = urlencode(form)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        connection = http.client.HTTPConnection(parts.hostname, parts.port, timeout=30)
+        connection.request(method, path, body=payload, headers=headers)
+        response = connection.getresponse()
+        data = response.read()
+        connection.close()
+        return response.status, data
+    return call
+
+
+def measure(call, case, requests, warmup):
+    """Run one case, return its result dict - a reply with an error status or without the expected bytes is an error"""
+    _, method, path, body, form, expected = case
+    for _ in range(warmup):
+        call(method, path, body, form)
+    latencies = []
+    errors = 0
+    started = time.perf_counter()
+    for _ in range(requests):
+        before = time.perf_counter()
+        status, data = call(method, path, body, form)
+        latencies.append(time.perf_counter() - before)
+        if status >= 400 or (expected is not None and expected not in data):
+            errors += 1
+    wall = time.perf_counter() - started
+    latencies.sort()
+    return dict(rps=requests / wall, p50_ms=latencies[len(latencies) // 2] * 1000,
+                p99_ms=latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000, errors=errors)
+
+
+def allocations(call, case, requests=50):
+    """Average tracemalloc peak (bytes) of one request"""
+    _, method, path, body, form, _ = case
+    call(method, path, body, form)
+    tracemalloc.start()
+    total = 0
+    for _ in range(requests):
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        call(method, path, body, form)
+        total += tracemalloc.get_traced_memory()[1] - before
+    tracemalloc.stop()
+    return total / requests
+
+
+def run(modes, requests, warmup, only):
+    """Benchmark every selected route in every mode, print and return the results"""
+    from my_app import APP, SESSIONS
+    upstream, stop_upstream = start_stub_upstream()
+    cases = [case for case in route_cases(upstream, login(SESSIONS)) if not only or case[0] in only or case[2] in only]
+    results = {}
+    try:
+        callers = []
+        if 'client' in modes:
+            callers.append(('client', client_caller(APP), None))
+        if 'server' in modes:
+            base_url, stop = start_wsgi_server(APP, workers=1)
+            callers.append(('server', server_caller(base_url), stop))
+        print("{:<7} {:<32} {:>9} {:>9} {:>9} {:>11} {:>6}".format("mode", "route", "req/s", "p50 ms", "p99 ms",
+                                                                     "alloc B", "errors"))
+        for mode, call, stop in callers:
+            for case in cases:
+                result = measure(call, case, requests, warmup)
+                if mode == 'client':
+                    result['alloc_bytes'] = allocations(call, case)
+                results['{} {}'.format(mode, case[0])] = result
+                print("{:<7} {:<32} {:>9.0f} {:>9.3f} {:>9.3f} {:>11} {:>6}".format(
+                    mode, case[0], result['rps'], result['p50_ms'], result['p99_ms'],
+                    '{:.0f}'.format(result['alloc_bytes']) if 'alloc_bytes' in result else '-', result['errors']))
+            if stop is not None:
+                stop()
+    finally:
+        stop_upstream()
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Print the change of every route against the baseline, return the number of regressions"""
+    regressions = 0
+    print()
+    print("{:<40} {:>10} {:>10}".format("vs baseline", "p50", "req/s"))
+    for key, result in sorted(results.items()):
+        old = baseline.get(key)
+        if old is None:
+            print("{:<40} {:>10} {:>10}".format(key, "new", "new"))
+            continue
+        p50_change = (result['p50_ms'] - old['p50_ms']) / old['p50_ms'] * 100
+        rps_change = (result['rps'] - old['rps']) / old['rps'] * 100
+        regressed = p50_change > threshold or rps_change < -threshold
+        regressions += regressed
+        print("{:<40} {:>+9.1f}% {:>+9.1f}% {}".format(key, p50_change, rps_change, "REGRESSION" if regressed else ""))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mode', choices=['client', 'server', 'both'], default='both')
+    parser.add_argument('--requests', type=int, default=2000, help="measured requests per route")
+    parser.add_argument('--warmup', type=int, default=50)
+    parser.add_argument('--routes', default='', help="comma separated route names or paths (default: all)")
+    parser.add_argument('--save', metavar='FILE', help="save the results as a baseline")
+    parser.add_argument('--compare', metavar='FILE', help="compare with a saved baseline")
+    parser.add_argument('--threshold', type=float, default=10, help="regression threshold, in percent")
+    args = parser.parse_args()
+    modes = ('client', 'server') if args.mode == 'both' else (args.mode,)
+    only = set(route for route in args.routes.split(',') if route)
+    results = run(modes, args.requests, args.warmup, only)
+    if args.save:
+        with open(args.save, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            if compare(results, json.load(baseline_file), args.threshold):
+                return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,84 @@
+# encoding: utf-8
+'''
+Concurrency of the WSGI and ASGI modes, through /https_proxy to a slow stub upstream.
+
+Run from the project root:
+    python -m benchmarks.load_asgi [--concurrency 500] [--delay 0.5] [--workers 8]
+
+Fires `concurrency` simultaneous proxy requests at the app served by a WSGI server with a fixed
+number of worker threads, then by uvicorn (asgi.ASGI_APP - needs uvicorn and httpx), and reports
+wall time, throughput and latency percentiles of each.
+'''
+from __future__ import unicode_literals, division, print_function
+import argparse
+import asyncio
+import time
+from urllib.parse import quote, urlsplit
+
+from benchmarks.servers import start_stub_upstream, start_wsgi_server, start_asgi_server
+
+
+async def _get(host, port, path):
+    """One HTTP/1.1 GET on its own connection, returns (status, seconds)"""
+    started = time.perf_counter()
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write('GET {} HTTP/1.1\r\nHost: {}:{}\r\nConnection: close\r\n\r\n'.format(path, host, port).encode())
+    await writer.drain()
+    data = await reader.read()
+    writer.close()
+    status = int(data.split(b' ', 2)[1]) if data else 0
+    return status, time.perf_counter() - started
+
+
+async def _load(base_url, path, concurrency):
+    parts = urlsplit(base_url)
+    return await asyncio.gather(*[_get(parts.hostname, parts.port, path) for _ in range(concurrency)],
+                                return_exceptions=True)
+
+
+def run(name, base_url, path, concurrency):
+    """Run one load and print its line of the report"""
+    started = time.perf_counter()
+    results = asyncio.run(_load(base_url, path, concurrency))
+    wall = time.perf_counter() - started
+    latencies = sorted(seconds for result in results if not isinstance(result, Exception)
+                       for status, seconds in [result] if status == 200)
+    errors = concurrency - len(latencies)
+    if not latencies:
+        print("{:<6} all {} requests failed".format(name, concurrency))
+        return
+    p50 = latencies[len(latencies) // 2]
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    print("{:<6} {:>8.2f} {:>10.1f} {:>9.0f} {:>9.0f} {:>7}".format(name, wall, len(latencies) / wall,
+                                                                   p50 * 1000, p99 * 1000, errors))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--concurrency', type=int, default=500, help="simultaneous requests")
+    parser.add_argument('--delay', type=float, default=0.5, help="upstream latency in seconds")
+    parser.add_argument('--workers', type=int, default=8, help="worker threads of the WSGI server")
+    args = parser.parse_args()
+
+    from asgi import ASGI_APP, httpx
+    from my_app import APP
+
+    upstream, stop_upstream = start_stub_upstream(delay=args.delay)
+    path = '/https_proxy?url=' + quote(upstream + '/image.png', safe='')
+    print("{} requests, upstream delay {}s".format(args.concurrency, args.delay))
+    print("{:<6} {:>8} {:>10} {:>9} {:>9} {:>7}".format("mode", "wall s", "req/s", "p50 ms", "p99 ms", "errors"))
+    base_url, stop = start_wsgi_server(APP, workers=args.workers)
+    run('wsgi', base_url, path, args.concurrency)
+    stop()
+    served = start_asgi_server(ASGI_APP)
+    if served is None or httpx is None:
+        print("asgi   skipped - needs uvicorn and httpx")
+    else:
+        base_url, stop = served
+        run('asgi', base_url, path, args.concurrency)
+        stop()
+    stop_upstream()
+
+
+if __name__ == '__main__':
+    main()
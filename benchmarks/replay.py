@@ -0,0 +1,246 @@
+# encoding: utf-8
+'''
+Replays traffic captured by capture.TrafficCapture (WEBHOOKS_CAPTURE_DIR) against the app.
+
+Run from the project root:
+    python -m benchmarks.replay CAPTURE.ndjson.gz [...] [--speed 1] [--mode client|server] [--concurrency 8]
+    python -m benchmarks.replay CAPTURE.ndjson.gz --save before.json
+    python -m benchmarks.replay CAPTURE.ndjson.gz --compare before.json [--threshold 10]
+
+The requests are sent in their captured order, at the captured rate (--speed 1), N times faster
+(--speed N) or as fast as possible (--speed 0), by --concurrency threads. `client` drives the app
+through the Flask test client, `server` through a real local WSGI server over TCP.
+
+Nothing leaves the machine: /https_proxy fetches from a local stub upstream, the supplier
+searches are the in-process stubs, and the redacted /dl passwords are replaced by --password
+(the other redacted values - login codes, sessions, emails, booking references - are sent as captured).
+The message log goes to a temporary directory and the capture itself is off.
+
+To compare two builds, replay the same capture on each: --save with the first, --compare with
+the second. The report has the latency and error changes of every route, and the number of
+requests whose status changed. Exits with status 1 when the p50 or p99 latency of a route got
+worse by more than --threshold percent, or it has more errors.
+'''
+from __future__ import unicode_literals, division, print_function
+import argparse
+import base64
+import gzip
+import http.client
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+from benchmarks.servers import start_stub_upstream, start_wsgi_server
+
+REDACTED = '<redacted>'
+
+
+def load_capture(paths, limit=None):
+    """The captured requests of the NDJSON (or .gz) files, in the order they were received"""
+    requests = []
+    for path in paths:
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rt', encoding='utf-8') as capture_file:
+            for line in capture_file:
+                line = line.strip()
+                if line:
+                    requests.append(json.loads(line)['event'])
+    requests.sort(key=lambda captured: captured['started'])
+    return requests[:limit] if limit else requests
+
+
+def prepare(captured, upstream, password):
+    """(route, method, path with query, body bytes, headers) to send for a captured request"""
+    query = captured.get('query') or ''
+    route = captured['path']
+    if route == '/https_proxy' and query:
+        # same path, but on the stub upstream
+        query = urlencode([(key, upstream + (urlsplit(value).path or '/') if key == 'url' else value)
+                           for key, value in parse_qsl(query, keep_blank_values=True)])
+    if 'body_base64' in captured:
+        body = base64.b64decode(captured['body_base64'])
+    else:
+        body = (captured.get('body') or '').encode('utf-8')
+    headers = dict(captured.get('headers') or {})
+    if body and headers.get('Content-Type', '').startswith('application/x-www-form-urlencoded'):
+        body = urlencode([(key, password if value == REDACTED else value)
+                          for key, value in parse_qsl(body.decode('utf-8'), keep_blank_values=True)]).encode('utf-8')
+    return route, captured['method'], route + ('?' + query if query else ''), body, headers
+
+
+def client_caller(app):
+    """Returns call(method, path, body, headers) -> status, through a Flask test client per thread"""
+    local = threading.local()
+
+    def call(method, path, body, headers):
+        client = getattr(local, 'client', None)
+        if client is None:
+            client = local.client = app.test_client()
+        response = client.open(path, method=method, data=body, headers=headers)
+        response.get_data()
+        response.close()
+        return response.status_code
+    return call
+
+
+def server_caller(base_url):
+    """Returns call(method, path, body, headers) -> status, over TCP to the local server"""
+    parts = urlsplit(base_url)
+
+    def call(method, path, body, headers):
+        connection = http.client.HTTPConnection(parts.hostname, parts.port, timeout=30)
+        connection.request(method, path, body=body or None, headers=headers)
+        response = connection.getresponse()
+        response.read()
+        connection.close()
+        return response.status
+    return call
+
+
+def replay(call, prepared, speed, concurrency):
+    """Send the prepared requests, return [(status, latency seconds, lateness seconds)] in the same order"""
+    results = [None] * len(prepared)
+
+    def send(index, due):
+        _, method, path, body, headers = prepared[index][1]
+        before = time.perf_counter()
+        try:
+            status = call(method, path, body, headers)
+        except Exception: # pylint:disable=broad-except
+            status = 0
+        results[index] = (status, time.perf_counter() - before, max(0.0, before - due) if due else 0.0)
+
+    first = prepared[0][0] if prepared else 0
+    with ThreadPoolExecutor(concurrency) as executor:
+        started = time.perf_counter()
+        for index, (captured_at, _) in enumerate(prepared):
+            due = None
+            if speed:
+                due = started + (captured_at - first) / speed
+                delay = due - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            executor.submit(send, index, due)
+    return results
+
+
+def _percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else 0.0
+
+
+def summarize(captured, prepared, results):
+    """Per route results, and per request statuses"""
+    routes = {}
+    for captured_request, (route, _, _, _, _), (status, latency, lateness) in zip(captured, prepared, results):
+        stats = routes.setdefault(route, dict(latencies=[], captured=[], errors=0, status_changes=0, late=[]))
+        stats['latencies'].append(latency * 1000)
+        stats['late'].append(lateness * 1000)
+        if 'duration_ms' in captured_request:
+            stats['captured'].append(captured_request['duration_ms'])
+        stats['errors'] += status == 0 or status >= 500
+        stats['status_changes'] += status != captured_request.get('status', status)
+    summary = {}
+    for route, stats in routes.items():
+        latencies = sorted(stats['latencies'])
+        summary[route] = dict(requests=len(latencies), p50_ms=_percentile(latencies, 0.5),
+                              p99_ms=_percentile(latencies, 0.99), errors=stats['errors'],
+                              captured_p50_ms=_percentile(sorted(stats['captured']), 0.5),
+                              late_p99_ms=_percentile(sorted(stats['late']), 0.99),
+                              status_changes=stats['status_changes'])
+    return dict(routes=summary, statuses=[status for status, _, _ in results])
+
+
+def report(summary, wall):
+    """Print the per route results"""
+    print("{:<34} {:>8} {:>9} {:>9} {:>11} {:>9} {:>7} {:>8}".format(
+        "route", "requests", "p50 ms", "p99 ms", "captured ms", "late ms", "errors", "changed"))
+    total = 0
+    for route, stats in sorted(summary['routes'].items()):
+        total += stats['requests']
+        print("{:<34} {:>8} {:>9.3f} {:>9.3f} {:>11.3f} {:>9.1f} {:>7} {:>8}".format(
+            route, stats['requests'], stats['p50_ms'], stats['p99_ms'], stats['captured_p50_ms'],
+            stats['late_p99_ms'], stats['errors'], stats['status_changes']))
+    print("{} requests in {:.2f}s ({:.0f} req/s)".format(total, wall, total / wall if wall else 0))
+
+
+def compare(summary, baseline, threshold):
+    """Print the changes against the baseline run, return the number of regressions"""
+    regressions = 0
+    print()
+    print("{:<34} {:>10} {:>10} {:>8}".format("vs baseline", "p50", "p99", "errors"))
+    for route, stats in sorted(summary['routes'].items()):
+        old = baseline['routes'].get(route)
+        if old is None:
+            print("{:<34} {:>10} {:>10} {:>8}".format(route, "new", "new", stats['errors']))
+            continue
+        p50_change = (stats['p50_ms'] - old['p50_ms']) / old['p50_ms'] * 100 if old['p50_ms'] else 0
+        p99_change = (stats['p99_ms'] - old['p99_ms']) / old['p99_ms'] * 100 if old['p99_ms'] else 0
+        errors_change = stats['errors'] - old['errors']
+        regressed = p50_change > threshold or p99_change > threshold or errors_change > 0
+        regressions += regressed
+        print("{:<34} {:>+9.1f}% {:>+9.1f}% {:>+8} {}".format(route, p50_change, p99_change, errors_change,
+                                                             "REGRESSION" if regressed else ""))
+    old_statuses = baseline['statuses']
+    if len(old_statuses) == len(summary['statuses']):
+        changed = sum(old != new for old, new in zip(old_statuses, summary['statuses']))
+        print("{} of {} requests got a different status".format(changed, len(old_statuses)))
+    else:
+        print("The baseline replayed a different capture ({} requests)".format(len(old_statuses)))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('captures', nargs='+', metavar='CAPTURE', help="capture files (.ndjson or .ndjson.gz)")
+    parser.add_argument('--speed', type=float, default=1, help="times the captured rate, 0 for as fast as possible")
+    parser.add_argument('--mode', choices=['client', 'server'], default='client')
+    parser.add_argument('--concurrency', type=int, default=8, help="requests in flight at most")
+    parser.add_argument('--limit', type=int, help="replay only the first LIMIT requests")
+    parser.add_argument('--password', default='password', help="sent instead of the redacted /dl passwords")
+    parser.add_argument('--save', metavar='FILE', help="save the results as a baseline")
+    parser.add_argument('--compare', metavar='FILE', help="compare with a saved baseline")
+    parser.add_argument('--threshold', type=float, default=10, help="regression threshold, in percent")
+    args = parser.parse_args()
+    captured = load_capture(args.captures, args.limit)
+    if not captured:
+        print("No captured requests")
+        return 1
+    # never capture the replay, and keep its message log out of the way
+    os.environ.pop('WEBHOOKS_CAPTURE_DIR', None)
+    os.environ['WEBHOOKS_MESSAGE_LOG_DIR'] = tempfile.mkdtemp(prefix='webhooks-replay-')
+    from my_app import APP
+    upstream, stop_upstream = start_stub_upstream()
+    stop = None
+    try:
+        if args.mode == 'server':
+            base_url, stop = start_wsgi_server(APP, workers=args.concurrency)
+            call = server_caller(base_url)
+        else:
+            call = client_caller(APP)
+        prepared = [(request['started'], prepare(request, upstream, args.password)) for request in captured]
+        started = time.perf_counter()
+        results = replay(call, prepared, args.speed, args.concurrency)
+        wall = time.perf_counter() - started
+    finally:
+        if stop is not None:
+            stop()
+        stop_upstream()
+    summary = summarize(captured, [request for _, request in prepared], results)
+    report(summary, wall)
+    if args.save:
+        with open(args.save, 'w') as baseline_file:
+            json.dump(summary, baseline_file, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            if compare(summary, json.load(baseline_file), args.threshold):
+                return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
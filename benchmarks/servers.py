@@ -0,0 +1,91 @@
+# encoding: utf-8
+'''
+Local servers used by the benchmarks: a stub upstream for /https_proxy and WSGI/ASGI servers
+running the app in background threads.
+'''
+from __future__ import unicode_literals, division
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler, make_server
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body are separate writes - without this, Nagle + delayed ACK add 40ms per request
+    disable_nagle_algorithm = True
+
+    def do_GET(self): # pylint:disable=invalid-name
+        """Answer after `delay` with `body_size` bytes"""
+        server = self.server
+        if server.delay:
+            time.sleep(server.delay)
+        body = b'\x89PNG' + b'x' * max(0, server.body_size - 4)
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', server.cache_control)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args): # pylint:disable=arguments-differ
+        pass
+
+
+class _StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+def start_stub_upstream(delay=0.0, body_size=20 * 1024, cache_control='no-store'):
+    """Start the stub image server, return (base URL, stop function)"""
+    server = _StubServer(('127.0.0.1', 0), _StubHandler)
+    server.delay = delay
+    server.body_size = body_size
+    server.cache_control = cache_control
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return 'http://127.0.0.1:{}'.format(server.server_address[1]), server.shutdown
+
+
+class _QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args): # pylint:disable=arguments-differ
+        pass
+
+
+class PooledWSGIServer(ThreadingMixIn, WSGIServer):
+    """wsgiref server handling requests on a fixed number of worker threads, like N sync workers"""
+    daemon_threads = True
+    workers = 8
+    request_queue_size = 1024
+
+    def process_request(self, request, client_address):
+        if not hasattr(self, '_pool'):
+            self._pool = ThreadPoolExecutor(self.workers) # pylint:disable=attribute-defined-outside-init
+        self._pool.submit(self.process_request_thread, request, client_address)
+
+
+def start_wsgi_server(app, workers=8):
+    """Serve the WSGI app on a free port, return (base URL, stop function)"""
+    server_class = type(str('PooledWSGIServer'), (PooledWSGIServer,), dict(workers=workers))
+    server = make_server('127.0.0.1', 0, app, server_class=server_class, handler_class=_QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return 'http://127.0.0.1:{}'.format(server.server_address[1]), server.shutdown
+
+
+def start_asgi_server(app):
+    """Serve the ASGI app with uvicorn (if installed) on a free port, return (base URL, stop function) or None"""
+    try:
+        import uvicorn
+    except ImportError:
+        return None
+    import socket
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    config = uvicorn.Config(app, log_level='warning', lifespan='on', backlog=4096)
+    server = uvicorn.Server(config)
+    threading.Thread(target=server.run, kwargs=dict(sockets=[sock]), daemon=True).start()
+    while not server.started:
+        time.sleep(0.01)
+    return 'http://127.0.0.1:{}'.format(sock.getsockname()[1]), lambda: setattr(server, 'should_exit', True)
@@ -0,0 +1,434 @@
+# encoding: utf-8
+'''
+Typed BotKit message model - see http://www.evature.com/docs/botkit.html
+
+Every message type is a small __slots__ class that validates its fields when constructed, so a
+broken reply fails here and not on the BotKit side. `encode` writes the JSON in one pass straight
+from the objects, without building an intermediate dict per message.
+
+Plain dicts, lists and scalars are accepted anywhere a value is expected (e.g. the free form
+`jsonData` of a DataMessage), so hand written and typed messages can be mixed.
+'''
+from __future__ import unicode_literals, division
+import re
+from json.encoder import encode_basestring_ascii as _quote
+
+BOTKIT_API_LATEST_VERSION = "0.4.0"
+
+class DataMessageSubType(object):
+    """Sub Types of DataMessage JSON data"""
+    airline_itinerary = "airline_itinerary"
+    airline_checkin = "airline_checkin"
+    airline_boardingpass = "airline_boardingpass"
+    airline_update = "airline_update"
+
+_DATA_MESSAGE_SUB_TYPES = frozenset(value for key, value in vars(DataMessageSubType).items()
+                                    if not key.startswith('_'))
+
+
+class MessageValidationError(ValueError):
+    """A message was constructed with a value BotKit would reject"""
+
+
+def _require_text(value, field):
+    if not isinstance(value, str) or not value:
+        raise MessageValidationError("{} must be a non empty string, got {!r}".format(field, value))
+    return value
+
+def _optional_text(value, field):
+    if value is None:
+        return None
+    return _require_text(value, field)
+
+def _require_list_of(values, classes, field, allow_empty=False):
+    values = list(values)
+    if not values and not allow_empty:
+        raise MessageValidationError("{} must not be empty".format(field))
+    for value in values:
+        if not isinstance(value, classes):
+            raise MessageValidationError("{} items must be {}, got {!r}".format(
+                field, "/".join(cls.__name__ for cls in classes), value))
+    return values
+
+
+class Message(object):
+    """Base of all the typed BotKit objects
+
+    Subclasses declare `_type` (None for the untyped helper objects) and `_fields` - a tuple of
+    (attribute, JSON key) pairs in the order they are written. Attributes set to None are omitted.
+    """
+    __slots__ = ()
+    _type = None
+    _fields = ()
+    # computed per class by __init_subclass__
+    _prefix = '{'
+    _encoded_fields = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super(Message, cls).__init_subclass__(**kwargs)
+        if cls._type is None:
+            # untyped objects: the first field must be mandatory since it is written without a comma
+            cls._prefix = '{'
+            cls._encoded_fields = tuple((attr, ('' if index == 0 else ',') + _quote(key) + ':')
+                                        for index, (attr, key) in enumerate(cls._fields))
+        else:
+            cls._prefix = '{"_type":' + _quote(cls._type)
+            cls._encoded_fields = tuple((attr, ',' + _quote(key) + ':') for attr, key in cls._fields)
+
+    def _encode(self, write):
+        write(self._prefix)
+        for attr, key in self._encoded_fields:
+            value = getattr(self, attr)
+            if value is not None:
+                write(key)
+                _write(value, write)
+        write('}')
+
+    def __eq__(self, other):
+        return type(self) is type(other) and all(getattr(self, attr) == getattr(other, attr)
+                                                 for attr, _ in self._fields)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "{}({})".format(self.__class__.__name__,
+                               ", ".join("{}={!r}".format(attr, getattr(self, attr)) for attr, _ in self._fields))
+
+
+class Hook(Message):
+    """A webhook to call back, with an optional payload passed along to it"""
+    __slots__ = ('webhook', 'payload')
+    _fields = (('webhook', 'webhook'), ('payload', 'payload'))
+
+    def __init__(self, webhook, payload=None):
+        self.webhook = _require_text(webhook, 'webhook')
+        if payload is not None and not isinstance(payload, dict):
+            raise MessageValidationError("payload must be a dict, got {!r}".format(payload))
+        self.payload = payload
+
+
+class InputTextAction(Message):
+    """Button action - act as if the user typed `input_text`"""
+    __slots__ = ('input_text',)
+    _type = 'InputTextAction'
+    _fields = (('input_text', 'inputText'),)
+
+    def __init__(self, input_text):
+        self.input_text = _require_text(input_text, 'input_text')
+
+
+class TextMessage(Message):
+    """Plain text message"""
+    __slots__ = ('text',)
+    _type = 'TextMessage'
+    _fields = (('text', 'text'),)
+
+    def __init__(self, text):
+        self.text = _require_text(text, 'text')
+
+
+class ImageMessage(Message):
+    """An image, given by URL"""
+    __slots__ = ('image_url',)
+    _type = 'ImageMessage'
+    _fields = (('image_url', 'imageUrl'),)
+
+    def __init__(self, image_url):
+        self.image_url = _require_text(image_url, 'image_url')
+
+
+class HtmlMessage(Message):
+    """A block of HTML"""
+    __slots__ = ('html', 'width', 'height')
+    _type = 'HtmlMessage'
+    _fields = (('height', 'height'), ('width', 'width'), ('html', 'html'))
+
+    def __init__(self, html, width=None, height=None):
+        self.html = _require_text(html, 'html')
+        self.width = None if width is None else str(width)
+        self.height = None if height is None else str(height)
+
+
+class ButtonMessage(Message):
+    """A button - opens `url`, posts back `payload` or runs `action`"""
+    __slots__ = ('text', 'url', 'payload', 'action')
+    _type = 'ButtonMessage'
+    _fields = (('text', 'text'), ('payload', 'payload'), ('url', 'url'), ('action', 'action'))
+
+    def __init__(self, text, url=None, payload=None, action=None):
+        self.text = _require_text(text, 'text')
+        self.url = _optional_text(url, 'url')
+        self.payload = payload
+        if action is not None and not isinstance(action, InputTextAction):
+            raise MessageValidationError("action must be an InputTextAction, got {!r}".format(action))
+        self.action = action
+        if url is None and payload is None and action is None:
+            raise MessageValidationError("ButtonMessage {!r} needs a url, payload or action".format(text))
+
+
+class RichMessage(Message):
+    """A card with a title, optional image/subtitle/link and buttons"""
+    __slots__ = ('title', 'image_url', 'subtitle', 'url', 'buttons')
+    _type = 'RichMessage'
+    _fields = (('title', 'title'), ('image_url', 'imageUrl'), ('subtitle', 'subtitle'),
+               ('buttons', 'buttons'), ('url', 'url'))
+
+    def __init__(self, title, image_url=None, subtitle=None, url=None, buttons=()):
+        self.title = _require_text(title, 'title')
+        self.image_url = _optional_text(image_url, 'image_url')
+        self.subtitle = subtitle
+        self.url = _optional_text(url, 'url')
+        self.buttons = _require_list_of(buttons, (ButtonMessage,), 'buttons', allow_empty=True) or None
+
+
+class MultiRichMessage(Message):
+    """A carousel of RichMessages"""
+    __slots__ = ('messages',)
+    _type = 'MultiRichMessage'
+    _fields = (('messages', 'messages'),)
+
+    def __init__(self, messages):
+        self.messages = _require_list_of(messages, (RichMessage,), 'messages')
+
+
+class Question(Message):
+    """Base of the questions asked by a QuestionnaireEvent"""
+    __slots__ = ('name', 'text')
+    _fields = (('name', 'name'), ('text', 'text'))
+
+    def __init__(self, name, text):
+        self.name = _require_text(name, 'name')
+        self.text = _require_text(text, 'text')
+
+
+class EmailQuestion(Question):
+    """Ask for an email address"""
+    __slots__ = ()
+    _type = 'EmailQuestion'
+
+
+class MultiChoiceQuestion(Question):
+    """Ask to pick one of `choices`"""
+    __slots__ = ('choices',)
+    _type = 'MultiChoiceQuestion'
+    _fields = Question._fields + (('choices', 'choices'),)
+
+    def __init__(self, name, text, choices):
+        super(MultiChoiceQuestion, self).__init__(name, text)
+        self.choices = _require_list_of(choices, (str,), 'choices')
+
+
+class OpenQuestion(Question):
+    """Ask for free text, optionally validated by a regular expression"""
+    __slots__ = ('validation_regex',)
+    _type = 'OpenQuestion'
+    _fields = Question._fields + (('validation_regex', 'validationRegex'),)
+
+    def __init__(self, name, text, validation_regex=None):
+        super(OpenQuestion, self).__init__(name, text)
+        if validation_regex is not None:
+            try:
+                re.compile(validation_regex)
+            except re.error as exc:
+                raise MessageValidationError("Invalid validation_regex {!r}: {}".format(validation_regex, exc))
+        self.validation_regex = validation_regex
+
+
+class QuestionnaireEvent(Message):
+    """Ask the user a list of questions, the answers are sent to `answered_hook`"""
+    __slots__ = ('questions', 'answered_hook', 'aborted_hook')
+    _type = 'QuestionnaireEvent'
+    _fields = (('answered_hook', 'questionnaireAnsweredHook'), ('aborted_hook', 'questionnaireAbortedHook'),
+               ('questions', 'questions'))
+
+    def __init__(self, questions, answered_hook, aborted_hook=None):
+        self.questions = _require_list_of(questions, (Question,), 'questions')
+        if not isinstance(answered_hook, Hook) or (aborted_hook is not None and not isinstance(aborted_hook, Hook)):
+            raise MessageValidationError("Questionnaire hooks must be Hook instances")
+        self.answered_hook = answered_hook
+        self.aborted_hook = aborted_hook
+
+
+class DataMessage(Message):
+    """Structured data (itinerary, boarding pass, ...) rendered by the messaging platform"""
+    __slots__ = ('sub_type', 'as_attachment', 'intro_message', 'json_data')
+    _type = 'DataMessage'
+    _fields = (('sub_type', 'subType'), ('as_attachment', 'asAttachment'), ('intro_message', 'introMessage'),
+               ('json_data', 'jsonData'))
+
+    def __init__(self, sub_type, json_data, intro_message=None, as_attachment=False):
+        if sub_type not in _DATA_MESSAGE_SUB_TYPES:
+            raise MessageValidationError("Unknown DataMessage subType {!r}".format(sub_type))
+        if not isinstance(json_data, dict):
+            raise MessageValidationError("json_data must be a dict, got {!r}".format(json_data))
+        self.sub_type = sub_type
+        self.json_data = json_data
+        self.intro_message = _optional_text(intro_message, 'intro_message')
+        self.as_attachment = bool(as_attachment)
+
+
+class _FixedDataMessage(DataMessage):
+    __slots__ = ()
+    _sub_type = None
+
+    def __init__(self, json_data, intro_message=None, as_attachment=False):
+        super(_FixedDataMessage, self).__init__(self._sub_type, json_data, intro_message, as_attachment)
+
+
+class AirlineItineraryMessage(_FixedDataMessage):
+    """DataMessage of subType airline_itinerary"""
+    __slots__ = ()
+    _sub_type = DataMessageSubType.airline_itinerary
+
+
+class AirlineCheckinMessage(_FixedDataMessage):
+    """DataMessage of subType airline_checkin"""
+    __slots__ = ()
+    _sub_type = DataMessageSubType.airline_checkin
+
+
+class AirlineBoardingPassMessage(_FixedDataMessage):
+    """DataMessage of subType airline_boardingpass"""
+    __slots__ = ()
+    _sub_type = DataMessageSubType.airline_boardingpass
+
+
+class AirlineUpdateMessage(_FixedDataMessage):
+    """DataMessage of subType airline_update"""
+    __slots__ = ()
+    _sub_type = DataMessageSubType.airline_update
+
+
+class LoginOAuthEvent(Message):
+    """Ask the user to log in at `web_login_url`, then call `login_success_hook`"""
+    __slots__ = ('login_success_hook', 'text', 'web_login_url')
+    _type = 'LoginOAuthEvent'
+    _fields = (('login_success_hook', 'loginSuccessHook'), ('text', 'text'), ('web_login_url', 'webLoginUrl'))
+
+    def __init__(self, text, web_login_url, login_success_hook=None):
+        if login_success_hook is not None and not isinstance(login_success_hook, Hook):
+            raise MessageValidationError("login_success_hook must be a Hook")
+        self.login_success_hook = login_success_hook
+        self.text = _require_text(text, 'text')
+        self.web_login_url = _require_text(web_login_url, 'web_login_url')
+
+
+class HandoffToHumanEvent(Message):
+    """Transfer the chat to a human agent"""
+    __slots__ = ()
+    _type = 'HandoffToHumanEvent'
+
+
+class EncodedMessage(Message):
+    """A message already encoded to JSON, written as is - for replies assembled from precomputed fragments"""
+    __slots__ = ('json',)
+    _fields = (('json', 'json'),)
+
+    def __init__(self, json):
+        self.json = _require_text(json, 'json')
+
+    @classmethod
+    def of(cls, message):
+        """Encode `message` once, to be sent many times"""
+        return cls(encode(message))
+
+    def _encode(self, write):
+        write(self.json)
+
+
+class BotkitResponse(Message):
+    """The top level reply of a webhook"""
+    __slots__ = ('botkit_version', 'messages')
+    _fields = (('botkit_version', 'botkitVersion'), ('messages', 'messages'))
+
+    def __init__(self, messages, botkit_version=BOTKIT_API_LATEST_VERSION):
+        self.botkit_version = _require_text(botkit_version, 'botkit_version')
+        self.messages = _require_list_of(messages, (Message, dict), 'messages', allow_empty=True)
+
+
+def _write(value, write):
+    """Write the JSON of `value`, one chunk at a time"""
+    cls = value.__class__
+    if cls is str:
+        write(_quote(value))
+    elif isinstance(value, Message):
+        value._encode(write) # pylint:disable=protected-access
+    elif value is None:
+        write('null')
+    elif value is True:
+        write('true')
+    elif value is False:
+        write('false')
+    elif cls is int:
+        write(int.__repr__(value))
+    elif cls is float:
+        if value != value or value in (float('inf'), float('-inf')):
+            raise ValueError("Out of range float values are not JSON compliant: {!r}".format(value))
+        write(float.__repr__(value))
+    elif isinstance(value, dict):
+        write('{')
+        first = True
+        for key, item in value.items():
+            if not isinstance(key, str):
+                key = str(key)
+            write(_quote(key) + ':' if first else ',' + _quote(key) + ':')
+            first = False
+            _write(item, write)
+        write('}')
+    elif isinstance(value, (list, tuple)):
+        write('[')
+        first = True
+        for item in value:
+            if not first:
+                write(',')
+            first = False
+            _write(item, write)
+        write(']')
+    elif isinstance(value, str):
+        write(_quote(value))
+    elif isinstance(value, (int, float)):
+        _write(int(value) if isinstance(value, int) else float(value), write)
+    else:
+        raise TypeError("Object of type {} is not JSON serializable".format(cls.__name__))
+
+
+def encode(value):
+    """Compact JSON text of a message, a BotkitResponse or any plain JSON value"""
+    chunks = []
+    _write(value, chunks.append)
+    return ''.join(chunks)
+
+
+def encode_bytes(value):
+    """Like `encode`, as UTF-8 bytes ready to be sent"""
+    return encode(value).encode('utf-8')
+
+
+def encode_stream(messages, botkit_version=BOTKIT_API_LATEST_VERSION, chunk_size=8192):
+    """The UTF-8 JSON of BotkitResponse(messages), in chunks of about `chunk_size` bytes
+
+    `messages` may be a generator - each message is encoded as soon as it is produced, and a
+    chunk is sent whenever enough of them are ready.
+    """
+    head, tail = encode(BotkitResponse([], botkit_version)).rsplit('[]', 1)
+    chunks = [head, '[']
+    size = len(head) + 1
+    first = True
+    for message in messages:
+        if not isinstance(message, (Message, dict)):
+            raise MessageValidationError("messages items must be Message/dict, got {!r}".format(message))
+        if not first:
+            chunks.append(',')
+        first = False
+        start = len(chunks)
+        _write(message, chunks.append)
+        size += sum(len(chunk) for chunk in chunks[start:])
+        if size >= chunk_size:
+            yield ''.join(chunks).encode('utf-8')
+            chunks = []
+            size = 0
+    chunks.append(']' + tail)
+    yield ''.join(chunks).encode('utf-8')
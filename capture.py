@@ -0,0 +1,203 @@
+# encoding: utf-8
+'''
+Capture of the live traffic, to replay it later in load tests (see benchmarks/replay.py).
+
+TrafficCapture is a WSGI middleware: a sampled request (`sample_rate` of them) is recorded with
+its body, a few of its headers, its status, its response size and how long it took, and handed
+to a sink - a MessageLog, so the disk is written by a background thread in batches (compressed
+NDJSON, rotated) and never by the request.
+
+Requests that are not sampled only cost a random number. Bodies larger than `max_body_size` are
+not captured (the request is, without its body, and flagged `truncated`), and the app reads the
+body as sent either way - a chunked body is read ahead only when the server marks it terminated
+(`wsgi.input_terminated`). Only the headers in `headers` are kept, and the `redact` fields are
+replaced by REDACTED wherever they are: in the query string, in form posts and at any depth of a
+JSON body (the /dl password and account linking token, login codes and sessions, emails and
+booking references).
+'''
+from __future__ import unicode_literals, division
+import base64
+import io
+import json
+import random
+import time
+from urllib.parse import parse_qsl, urlencode
+
+CAPTURED_HEADERS = ('Content-Type', 'Accept-Encoding', 'Idempotency-Key', 'User-Agent')
+REDACTED_FIELDS = ('password', 'account_linking_token', 'authorization_code', 'session', 'email', 'pnr')
+REDACTED = '<redacted>'
+FORM_MIMETYPE = 'application/x-www-form-urlencoded'
+JSON_MIMETYPE = 'application/json'
+
+
+def _environ_header(name):
+    name = name.upper().replace('-', '_')
+    return name if name in ('CONTENT_TYPE', 'CONTENT_LENGTH') else 'HTTP_' + name
+
+
+def _redact_json(value, redact):
+    if isinstance(value, dict):
+        return dict((key, REDACTED if key in redact else _redact_json(item, redact)) for key, item in value.items())
+    if isinstance(value, list):
+        return [_redact_json(item, redact) for item in value]
+    return value
+
+
+class _ReadAhead(io.RawIOBase):
+    """The bytes read ahead of the app, then the rest of the original input"""
+
+    def __init__(self, head, rest):
+        super(_ReadAhead, self).__init__()
+        self._head = io.BytesIO(head)
+        self._rest = rest
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self._head.read(len(buffer)) or self._rest.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+
+class _CapturedBody(object):
+    """The response iterable of the app - counts its bytes, and completes the record when closed"""
+
+    def __init__(self, iterable, done):
+        self._iterable = iterable
+        self._done = done
+        self.size = 0
+
+    def __iter__(self):
+        for chunk in self._iterable:
+            self.size += len(chunk)
+            yield chunk
+
+    def close(self):
+        """Close the app's iterable, then record the request"""
+        try:
+            close = getattr(self._iterable, 'close', None)
+            if close is not None:
+                close()
+        finally:
+            self._done(self.size)
+
+
+class TrafficCapture(object):
+    """WSGI middleware recording a sample of the requests to `sink` (anything with an `append`)"""
+
+    def __init__(self, app, sink, sample_rate=1.0, max_body_size=256 * 1024, exclude=('/metrics',),
+                 headers=CAPTURED_HEADERS, redact=REDACTED_FIELDS, rng=random.random):
+        self.app = app
+        self.sink = sink
+        self.sample_rate = sample_rate
+        self.max_body_size = max_body_size
+        self.exclude = frozenset(exclude)
+        self.headers = [(name, _environ_header(name)) for name in headers]
+        self.redact = frozenset(redact)
+        self._random = rng
+        self.captured = 0
+
+    def sampled(self, path):
+        """True if a request of `path` is to be captured"""
+        return path not in self.exclude and (self.sample_rate >= 1 or self._random() < self.sample_rate)
+
+    def _redact_fields(self, encoded):
+        fields = parse_qsl(encoded, keep_blank_values=True)
+        if not any(key in self.redact for key, _ in fields):
+            return encoded
+        return urlencode([(key, REDACTED if key in self.redact else value) for key, value in fields])
+
+    def _redact_body(self, content_type, body):
+        mimetype = (content_type or '').split(';')[0].strip()
+        if mimetype == FORM_MIMETYPE:
+            return self._redact_fields(body.decode('latin-1')).encode('latin-1')
+        if mimetype == JSON_MIMETYPE:
+            try:
+                decoded = json.loads(body.decode('utf-8'))
+            except ValueError:
+                return body
+            return json.dumps(_redact_json(decoded, self.redact), ensure_ascii=False,
+                              separators=(',', ':')).encode('utf-8')
+        return body
+
+    def start(self, method, path, query, headers, content_type, body):
+        """The record of a sampled request - `headers` are the captured ones, `body` is None if too large"""
+        if query and self.redact:
+            query = self._redact_fields(query)
+        record = dict(started=time.time(), method=method, path=path, query=query, headers=headers)
+        if body is None:
+            record['truncated'] = True
+        elif body:
+            if self.redact:
+                body = self._redact_body(content_type, body)
+            try:
+                record['body'] = body.decode('utf-8')
+            except UnicodeDecodeError:
+                record['body_base64'] = base64.b64encode(body).decode('ascii')
+        return record
+
+    def finish(self, record, status, size, seconds):
+        """Complete the record of a request once its response is sent, and hand it to the sink"""
+        record['status'] = status
+        record['duration_ms'] = round(seconds * 1000, 3)
+        record['response_bytes'] = size
+        self.captured += 1
+        self.sink.append(record)
+
+    def _body(self, environ):
+        """Read the request body, so it can be both recorded and read again by the app - None if too large
+
+        Without a Content-Length (a chunked body), up to `max_body_size` + 1 bytes are read if the
+        server ends the input with the body; else the input is left alone, and the body not captured.
+        """
+        try:
+            length = int(environ.get('CONTENT_LENGTH') or -1)
+        except ValueError:
+            length = -1
+        if length > self.max_body_size:
+            return None
+        if length >= 0:
+            body = environ['wsgi.input'].read(length) if length > 0 else b''
+            environ['wsgi.input'] = io.BytesIO(body)
+            return body
+        if 'chunked' not in environ.get('HTTP_TRANSFER_ENCODING', '').lower():
+            return b''
+        if not environ.get('wsgi.input_terminated'):
+            return None
+        stream = environ['wsgi.input']
+        body = b''
+        while len(body) <= self.max_body_size:
+            chunk = stream.read(self.max_body_size + 1 - len(body))
+            if not chunk:
+                break
+            body += chunk
+        if len(body) > self.max_body_size:
+            environ['wsgi.input'] = io.BufferedReader(_ReadAhead(body, stream))
+            return None
+        environ['wsgi.input'] = io.BytesIO(body)
+        return body
+
+    def __call__(self, environ, start_response):
+        if not self.sampled(environ.get('PATH_INFO')):
+            return self.app(environ, start_response)
+        record = self.start(environ.get('REQUEST_METHOD', 'GET'), environ.get('PATH_INFO', '/'),
+                            environ.get('QUERY_STRING', ''),
+                            dict((name, environ[key]) for name, key in self.headers if environ.get(key)),
+                            environ.get('CONTENT_TYPE'), self._body(environ))
+        begin = time.perf_counter()
+        status = [500]
+
+        def capture_start_response(status_line, response_headers, exc_info=None):
+            status[0] = int(status_line.split(' ', 1)[0])
+            return start_response(status_line, response_headers, exc_info)
+
+        def done(size):
+            self.finish(record, status[0], size, time.perf_counter() - begin)
+
+        try:
+            iterable = self.app(environ, capture_start_response)
+        except Exception:
+            done(0)
+            raise
+        return _CapturedBody(iterable, done)
@@ -0,0 +1,95 @@
+# encoding: utf-8
+'''
+Cold start tooling for the Lambda deployment.
+
+    python coldstart.py precompile
+        Compile the Jinja templates into templates_compiled/ - my_app imports them instead of
+        compiling demo_login.html on the first request. Run it before every `zappa update`.
+
+    python coldstart.py importtime [--budget-ms 400] [--top 15] [--repeat 5]
+        Import my_app in fresh interpreters with `-X importtime` and report the slowest modules.
+        Exits with status 1 if the import takes longer than the budget, or if a module that must
+        stay lazy (see LAZY_MODULES) got imported - so a CI step catches cold start regressions.
+'''
+from __future__ import unicode_literals, division, print_function
+import argparse
+import os
+import re
+import shutil
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# Only imported when they are needed, never by `import my_app`
+LAZY_MODULES = ('requests', 'urllib3', 'httpx')
+DEFAULT_BUDGET_MS = 400
+
+_IMPORTTIME_LINE = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)\s*$')
+
+
+def precompile():
+    """Write the compiled templates of the app to templates_compiled/"""
+    sys.path.insert(0, ROOT)
+    from my_app import APP, PRECOMPILED_TEMPLATES_DIR
+    if os.path.isdir(PRECOMPILED_TEMPLATES_DIR):
+        shutil.rmtree(PRECOMPILED_TEMPLATES_DIR)
+    # compile with the app's own environment so autoescaping & co. are the same as at runtime
+    APP.jinja_env.compile_templates(PRECOMPILED_TEMPLATES_DIR, zip=None, ignore_errors=False, log_function=print)
+
+
+def measure_import(module='my_app'):
+    """Import `module` in a fresh interpreter, return [(module, self us, cumulative us, depth)]"""
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import {}'.format(module)],
+                          cwd=ROOT, stderr=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                          universal_newlines=True, check=True)
+    rows = []
+    for line in proc.stderr.splitlines():
+        match = _IMPORTTIME_LINE.match(line)
+        if match:
+            rows.append((match.group(4), int(match.group(1)), int(match.group(2)), len(match.group(3)) // 2))
+    return rows
+
+
+def importtime(budget_ms, top, repeat):
+    """Print the import time report, return the process exit status"""
+    runs = [measure_import() for _ in range(repeat)]
+    # the fastest run is the least noisy estimate of the real cost
+    rows = min(runs, key=lambda rows: dict((name, cumulative) for name, _, cumulative, _ in rows).get('my_app', 0))
+    total_us = dict((name, cumulative) for name, _, cumulative, _ in rows)['my_app']
+    print("{:>10} {:>10}  module".format("self ms", "total ms"))
+    for name, self_us, cumulative_us, depth in sorted(rows, key=lambda row: -row[2])[:top]:
+        print("{:>10.1f} {:>10.1f}  {}{}".format(self_us / 1000, cumulative_us / 1000, '  ' * depth, name))
+    status = 0
+    imported = set(name for name, _, _, _ in rows)
+    for lazy in LAZY_MODULES:
+        if lazy in imported:
+            print("FAIL: {} is imported by my_app, it must stay lazy".format(lazy))
+            status = 1
+    print("import my_app: {:.1f} ms (budget {} ms)".format(total_us / 1000, budget_ms))
+    if total_us / 1000 > budget_ms:
+        print("FAIL: over budget")
+        status = 1
+    return status
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('precompile', help="precompile the Jinja templates")
+    report = commands.add_parser('importtime', help="import time report and budget check")
+    report.add_argument('--budget-ms', type=float, default=DEFAULT_BUDGET_MS)
+    report.add_argument('--top', type=int, default=15)
+    report.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    if args.command == 'precompile':
+        precompile()
+        return 0
+    if args.command == 'importtime':
+        return importtime(args.budget_ms, args.top, args.repeat)
+    parser.print_help()
+    return 2
+
+
+if __name__ == '__main__':
+    sys.exit(main())
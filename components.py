@@ -0,0 +1,52 @@
+# encoding: utf-8
+'''
+The external services behind the webhooks (search suppliers, location providers), declared in a
+JSON file instead of in code, so a deployment picks its own without a code change.
+
+    WEBHOOKS_PROVIDERS=providers.json
+
+    {"search": [{"class": "my_suppliers.AmadeusSupplier", "name": "Amadeus", "kinds": ["flight"]}, ...],
+     "timezone": {"class": "my_providers.Timezones", "api_key": "..."}, ...}
+
+A component is {"class": "module.Class", ...the keyword arguments of its constructor}. Without
+WEBHOOKS_PROVIDERS, local runs use the stand-ins of data/stub_providers.json - and a Lambda
+uses none, stubs are never deployed by accident.
+'''
+from __future__ import unicode_literals, division
+import importlib
+import io
+import json
+import os
+
+PROVIDERS_ENV = 'WEBHOOKS_PROVIDERS'
+STUB_PROVIDERS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'stub_providers.json')
+
+
+def import_object(path):
+    """The object named by 'module.name'"""
+    module, _, name = path.rpartition('.')
+    if not module:
+        raise ValueError("Expected a 'module.name', got {!r}".format(path))
+    return getattr(importlib.import_module(module), name)
+
+
+def build(config):
+    """The component of `config` - {"class": "module.Class", ...its constructor arguments}"""
+    arguments = dict(config)
+    return import_object(arguments.pop('class'))(**arguments)
+
+
+def load_providers(path):
+    """The providers configuration of a JSON file"""
+    with io.open(path, encoding='utf-8') as config_file:
+        return json.load(config_file)
+
+
+def providers_config():
+    """The file of $WEBHOOKS_PROVIDERS, else the stubs when running locally - {} on AWS Lambda"""
+    path = os.environ.get(PROVIDERS_ENV)
+    if path:
+        return load_providers(path)
+    if os.environ.get('AWS_LAMBDA_FUNCTION_NAME'):
+        return {}
+    return load_providers(STUB_PROVIDERS_FILE)
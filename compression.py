@@ -0,0 +1,116 @@
+# encoding: utf-8
+'''
+gzip / brotli compression of the JSON replies, negotiated with Accept-Encoding.
+
+    Compressor().init_app(APP)
+
+compresses every JSON (or NDJSON, or text) response of at least `min_size` bytes that is not
+already encoded. Streamed responses (the /webhook/batch NDJSON) are compressed as they are
+produced, flushing after every chunk so each line still reaches the client as soon as it is
+ready. Static replies carry their own precompressed copies (see response_cache) and are left alone.
+
+brotli is used when the `brotli` (or `brotlicffi`) package is installed and the client prefers
+it, gzip otherwise.
+'''
+from __future__ import unicode_literals, division
+import gzip
+import zlib
+
+from flask import request
+
+try:
+    import brotli
+except ImportError: # optional
+    try:
+        import brotlicffi as brotli
+    except ImportError:
+        brotli = None
+
+# Bodies smaller than this are not worth compressing
+COMPRESS_MIN_SIZE = 1024
+
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+
+COMPRESSIBLE_MIMETYPES = frozenset(('application/json', 'application/x-ndjson', 'application/jsonl',
+                                    'text/html', 'text/plain', 'text/css', 'application/javascript'))
+
+# Per request compression trades ratio for speed, precompressed static bytes use the best level
+FAST_GZIP_LEVEL = 6
+FAST_BROTLI_QUALITY = 4
+BEST_GZIP_LEVEL = 9
+BEST_BROTLI_QUALITY = 11
+
+
+def best_encoding(available=ENCODINGS):
+    """The encoding of `available` the current request accepts best, None for identity"""
+    if not available:
+        return None
+    return request.accept_encodings.best_match(available)
+
+
+def compress(body, encoding, best=False):
+    """`body` compressed with `encoding` ('gzip' or 'br')"""
+    if encoding == 'br':
+        return brotli.compress(body, quality=BEST_BROTLI_QUALITY if best else FAST_BROTLI_QUALITY)
+    if encoding == 'gzip':
+        return gzip.compress(body, compresslevel=BEST_GZIP_LEVEL if best else FAST_GZIP_LEVEL, mtime=0)
+    raise ValueError("Unsupported encoding {!r}".format(encoding))
+
+
+def compress_stream(chunks, encoding):
+    """Compress an iterable of chunks, yielding the compressed bytes of each as soon as it is read"""
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=FAST_BROTLI_QUALITY)
+        process, flush, finish = compressor.process, compressor.flush, compressor.finish
+    elif encoding == 'gzip':
+        compressor = zlib.compressobj(FAST_GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        process, flush, finish = compressor.compress, lambda: compressor.flush(zlib.Z_SYNC_FLUSH), compressor.flush
+    else:
+        raise ValueError("Unsupported encoding {!r}".format(encoding))
+    try:
+        for chunk in chunks:
+            if not isinstance(chunk, bytes):
+                chunk = chunk.encode('utf-8')
+            if chunk:
+                yield process(chunk) + flush()
+        yield finish()
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+class Compressor(object):
+    """Flask extension compressing the responses the client accepts compressed"""
+
+    def __init__(self, min_size=COMPRESS_MIN_SIZE, encodings=ENCODINGS, mimetypes=COMPRESSIBLE_MIMETYPES):
+        self.min_size = min_size
+        self.encodings = encodings
+        self.mimetypes = mimetypes
+
+    def _after_request(self, response):
+        if (response.status_code < 200 or response.status_code in (204, 206, 304) or request.method == 'HEAD'
+                or response.direct_passthrough or 'Content-Encoding' in response.headers
+                or response.mimetype not in self.mimetypes
+                or 'no-transform' in response.headers.get('Cache-Control', '')):
+            return response
+        if not response.is_streamed and (response.content_length or 0) < self.min_size:
+            return response
+        response.vary.add('Accept-Encoding')
+        encoding = best_encoding(self.encodings)
+        if encoding is None:
+            return response
+        if response.is_streamed:
+            response.response = compress_stream(response.response, encoding)
+            response.headers.pop('Content-Length', None)
+        else:
+            body = response.get_data()
+            compressed = compress(body, encoding)
+            if len(compressed) >= len(body):
+                return response
+            response.set_data(compressed)
+        response.headers['Content-Encoding'] = encoding
+        return response
+
+    def init_app(self, app):
+        """Compress the responses of `app`"""
+        app.after_request(self._after_request)
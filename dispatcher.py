@@ -0,0 +1,326 @@
+# encoding: utf-8
+'''
+A single entry point for all the applicative webhooks.
+
+Handlers register for a webhook name (one of the BotWebhookTypes values) and are looked up in a
+dict, so `/webhook?webhook=chat_greeting` costs one URL rule match and one dict lookup whatever
+the number of webhooks. Handlers receive a WebhookRequest - the BotKit body already parsed and
+validated against the schema the handler registered with (see request_parsing) - and return the
+reply: a list of messages, a BotkitResponse, a StaticResponse or a Flask Response - or a
+generator of messages. A generator reply is rendered whole (with a Content-Length, and a 500 if
+it fails) unless it grows over STREAM_THRESHOLD bytes - only then is it streamed, and a failure
+past that point ends the messages with STREAM_ERROR_MESSAGE so the JSON stays valid.
+
+The old per-webhook routes stay as thin aliases that dispatch to the same handlers.
+
+`/webhook/batch` runs many webhook calls in one HTTP request - see WebhookDispatcher.batch_view.
+'''
+from __future__ import unicode_literals, division
+import functools
+import types
+
+from flask import request, Response, current_app, stream_with_context
+
+from botkit_messages import BotkitResponse, Message, TextMessage, encode, encode_bytes, encode_stream
+from request_parsing import InvalidWebhookBody, MAX_BODY_SIZE, decode_json, read_json_body, webhook_schema
+from response_cache import StaticResponse
+
+
+class UnknownWebhook(KeyError):
+    """No handler is registered for the requested webhook"""
+
+
+class BotkitUser(object):
+    """The `user` object of a BotKit call"""
+    __slots__ = ('first_name', 'last_name', 'user_id')
+
+    def __init__(self, first_name=None, last_name=None, user_id=None):
+        self.first_name = first_name
+        self.last_name = last_name
+        self.user_id = user_id
+
+    @classmethod
+    def from_json(cls, user):
+        """From the (validated) JSON object"""
+        return cls(user.get('firstName'), user.get('lastName'), user.get('id'))
+
+
+class WebhookRequest(object):
+    """A BotKit webhook call, parsed once and handed to the handler
+
+    `body` is the decoded JSON - a dict once dispatch validated it, None for an empty call.
+    """
+    __slots__ = ('webhook', 'body', 'args', 'headers', '_user')
+
+    def __init__(self, webhook, body, args=None, headers=None):
+        self.webhook = webhook
+        self.body = body
+        self.args = args if args is not None else {}
+        self.headers = headers if headers is not None else {}
+        self._user = None
+
+    @classmethod
+    def from_flask(cls, webhook, max_body_size=MAX_BODY_SIZE):
+        """Build it from the current Flask request - raises InvalidWebhookBody"""
+        return cls(webhook, read_json_body(request.stream, request.content_length, max_body_size),
+                   request.args, request.headers)
+
+    def get(self, key, default=None):
+        """A top level field of the body"""
+        if self.body is None:
+            return default
+        return self.body.get(key, default)
+
+    @property
+    def user(self):
+        """The BotkitUser of the call, or None"""
+        if self._user is None:
+            user = self.get('user')
+            if user:
+                self._user = BotkitUser.from_json(user)
+        return self._user
+
+    @property
+    def login_data(self):
+        """The `loginData` sent by BotKit once the user logged in, or None"""
+        return self.get('loginData') or None
+
+
+# replies up to this size are rendered whole before anything is sent
+STREAM_THRESHOLD = 64 * 1024
+STREAM_ERROR_MESSAGE = TextMessage("Sorry, something went wrong - some results are missing")
+
+
+def error_response(message, status):
+    """A JSON error reply"""
+    return Response(encode_bytes(dict(error=message)), status=status, mimetype='application/json')
+
+
+def encode_reply(reply):
+    """The JSON bytes of whatever a handler returned"""
+    if isinstance(reply, StaticResponse):
+        return reply.body
+    if isinstance(reply, Response):
+        return reply.get_data()
+    if isinstance(reply, (list, tuple, types.GeneratorType)):
+        reply = BotkitResponse(list(reply))
+    return encode_bytes(reply)
+
+
+def generator_response(messages, threshold=None):
+    """The Flask response of a generator of messages - whole if under `threshold` bytes, streamed otherwise"""
+    streaming = []
+
+    def guarded():
+        try:
+            for message in messages:
+                yield message
+        except Exception: # pylint:disable=broad-except
+            if not streaming:
+                raise
+            # the status is sent already - end the messages, so the client still gets valid JSON
+            current_app.logger.exception("Streamed reply failed")
+            yield STREAM_ERROR_MESSAGE
+
+    chunks = encode_stream(guarded(), chunk_size=threshold or STREAM_THRESHOLD)
+    first = next(chunks)
+    second = next(chunks, None)
+    if second is None:
+        return Response(first, mimetype='application/json')
+    streaming.append(True)
+
+    def stream():
+        # the rest is produced as it is sent - closed with the response (the wrappers of the handler end then)
+        try:
+            yield first
+            yield second
+            yield from chunks
+        finally:
+            chunks.close()
+    return Response(stream_with_context(stream()), mimetype='application/json')
+
+
+def to_response(reply):
+    """The Flask response for whatever a handler returned"""
+    if isinstance(reply, Response):
+        return reply
+    if isinstance(reply, StaticResponse):
+        return reply.serve()
+    if isinstance(reply, types.GeneratorType):
+        return generator_response(reply)
+    if isinstance(reply, (list, tuple, Message, dict)):
+        return Response(encode_reply(reply), mimetype='application/json')
+    raise TypeError("Unsupported webhook reply {!r}".format(reply))
+
+
+class WebhookDispatcher(object):
+    """Registry of webhook handlers, keyed by webhook name"""
+
+    # Most webhook calls accepted by a single batch request, and largest batch body
+    max_batch_items = 1000
+    max_batch_body_size = 4 * 1024 * 1024
+
+    def __init__(self):
+        self._handlers = {}
+        self._schemas = {}
+        self._default_schema = webhook_schema()
+        self._wrappers = []
+        # the handlers with all the wrappers applied, what dispatch actually calls
+        self._calls = {}
+
+    def handler(self, *webhooks, **kwargs):
+        """Decorator registering the function as the handler of the given webhook names
+
+        `schema` - the fields of the body the handler relies on, on top of the common BotKit
+        fields (see request_parsing.webhook_schema). Calls not matching it are rejected.
+        """
+        schema = webhook_schema(kwargs.pop('schema', None))
+        if kwargs:
+            raise TypeError("Unexpected arguments {}".format(", ".join(kwargs)))
+
+        def decorator(func):
+            for webhook in webhooks:
+                if webhook in self._handlers:
+                    raise ValueError("Webhook {!r} already handled by {}".format(webhook,
+                                                                              self._handlers[webhook].__name__))
+                self._handlers[webhook] = func
+                self._schemas[webhook] = schema
+                self._calls[webhook] = self._wrap(func)
+            return func
+        return decorator
+
+    def add_wrapper(self, wrapper):
+        """Wrap every handler call (metrics, caching, ...)
+
+        `wrapper(call, webhook_request)` returns the reply, normally by returning `call(webhook_request)`.
+        The last wrapper added is the outermost one.
+        """
+        self._wrappers.append(wrapper)
+        self._calls = dict((webhook, self._wrap(func)) for webhook, func in self._handlers.items())
+
+    def _wrap(self, func):
+        call = func
+        for wrapper in self._wrappers:
+            call = functools.partial(wrapper, call)
+        return call
+
+    def __contains__(self, webhook):
+        return webhook in self._handlers
+
+    def webhooks(self):
+        """The names of all the registered webhooks"""
+        return sorted(self._handlers)
+
+    def dispatch(self, webhook_request):
+        """Validate the body, run the handler of `webhook_request.webhook` and return its reply
+
+        Raises UnknownWebhook, or InvalidWebhookBody when the body does not match the schema.
+        """
+        try:
+            call = self._calls[webhook_request.webhook]
+        except KeyError:
+            raise UnknownWebhook(webhook_request.webhook)
+        if webhook_request.body is not None:
+            self._schemas.get(webhook_request.webhook, self._default_schema)(webhook_request.body)
+        return call(webhook_request)
+
+    def serve(self, webhook):
+        """Dispatch the current Flask request to the handler of `webhook`"""
+        try:
+            return to_response(self.dispatch(WebhookRequest.from_flask(webhook)))
+        except InvalidWebhookBody as exc:
+            return error_response(str(exc), exc.status)
+
+    def view(self):
+        """The view of the single `/webhook?webhook=<name>` endpoint"""
+        webhook = request.args.get('webhook')
+        if webhook not in self._handlers:
+            return error_response("Unknown webhook {!r}".format(webhook), 404)
+        return self.serve(webhook)
+
+    def run_batch_item(self, index, item, headers=None):
+        """Run one call of a batch, the result is one NDJSON line - errors stay local to the item"""
+        if isinstance(item, _InvalidLine):
+            return _batch_line(index, None, 400, error=item.error)
+        if not isinstance(item, dict):
+            return _batch_line(index, None, 400, error="Batch items must be objects with 'webhook' and 'body'")
+        webhook = item.get('webhook')
+        if webhook not in self._handlers:
+            return _batch_line(index, webhook, 404, error="Unknown webhook {!r}".format(webhook))
+        try:
+            reply = self.dispatch(WebhookRequest(webhook, item.get('body'), headers=headers))
+            return _batch_line(index, webhook, 200, reply_bytes=encode_reply(reply))
+        except InvalidWebhookBody as exc:
+            return _batch_line(index, webhook, exc.status, error=str(exc))
+        except Exception: # pylint:disable=broad-except
+            current_app.logger.exception("Batch item %d (%s) failed", index, webhook)
+            return _batch_line(index, webhook, 500, error="Internal error")
+
+    def batch_view(self):
+        """Run many webhook calls in one request
+
+        The body is either a JSON array or newline delimited JSON, each item being
+        {"webhook": "<BotWebhookTypes value>", "body": {...the usual BotKit body...}}.
+        The reply is streamed as NDJSON, one line per item and in the same order:
+        {"index": 0, "webhook": "chat_greeting", "status": 200, "response": {...}}
+        or {"index": 1, "webhook": "nope", "status": 404, "error": "..."}.
+        """
+        headers = request.headers
+        if request.mimetype in ('application/x-ndjson', 'application/jsonl'):
+            items = _iter_ndjson(request.stream)
+        else:
+            try:
+                items = read_json_body(request.stream, request.content_length, self.max_batch_body_size)
+            except InvalidWebhookBody as exc:
+                return error_response(str(exc), exc.status)
+            if not isinstance(items, list):
+                return error_response("Expected a JSON array or NDJSON of webhook calls", 400)
+        max_items = self.max_batch_items
+
+        def generate():
+            for index, item in enumerate(items):
+                if index >= max_items:
+                    yield _batch_line(index, None, 413, error="Too many items, at most {}".format(max_items))
+                    break
+                yield self.run_batch_item(index, item, headers)
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+    def init_app(self, app, rule='/webhook'):
+        """Add the dispatch endpoints to the Flask app"""
+        app.add_url_rule(rule, 'webhook', self.view, methods=['POST'])
+        app.add_url_rule(rule + '/batch', 'webhook_batch', self.batch_view, methods=['POST'])
+
+
+class _InvalidLine(object):
+    """Placeholder for an NDJSON line that is not valid JSON"""
+    __slots__ = ('error',)
+
+    def __init__(self, error):
+        self.error = error
+
+
+def _iter_ndjson(stream, max_line_size=MAX_BODY_SIZE):
+    """Parse the NDJSON lines one at a time, as they are read"""
+    while True:
+        line = stream.readline(max_line_size + 1)
+        if not line:
+            return
+        if len(line) > max_line_size and not line.endswith(b'\n'):
+            yield _InvalidLine("Line over the {} bytes limit".format(max_line_size))
+            # skip the rest of the oversized line
+            while line and not line.endswith(b'\n'):
+                line = stream.readline(max_line_size + 1)
+            continue
+        if line.strip():
+            try:
+                yield decode_json(line)
+            except InvalidWebhookBody as exc:
+                yield _InvalidLine(str(exc))
+
+
+def _batch_line(index, webhook, status, reply_bytes=None, error=None):
+    """One NDJSON line of a batch reply - the handler's bytes are spliced in as is"""
+    head = '{{"index":{},"webhook":{},"status":{}'.format(index, encode(webhook), status)
+    if reply_bytes is not None:
+        return head.encode('utf-8') + b',"response":' + reply_bytes + b'}\n'
+    return (head + ',"error":' + encode(error) + '}\n').encode('utf-8')
@@ -0,0 +1,422 @@
+# encoding: utf-8
+'''
+Flight data for the flight webhooks - status, gates and times, boarding passes and the
+arrivals/departures boards.
+
+FlightDataProvider is the interface the webhooks use; LocalFlightProvider implements it over
+local schedule files, loaded into in-memory indexes:
+
+    flight number     -> its flights, sorted by departure time
+    PNR               -> booking
+    airport           -> departures (and arrivals) sorted by time, range scanned with bisect
+
+Cancelled and changed bookings are kept in memory, on top of the files (a demo, not a booking
+system). The files are loaded on the first query, and re-checked every `check_interval` seconds: a file
+is only reloaded when its mtime changed - the others keep their parsed flights and bookings, only
+the indexes are rebuilt - and the new indexes replace the old ones in one assignment, so queries
+never see a half built index. A file that is missing or invalid is logged and its last good
+content kept (nothing if it never loaded), until it changes again.
+
+Schedule files are CSV (one flight per row - or one booking per row when there is a `pnr`
+column) or JSON (a list of flights, or {"flights": [...], "bookings": [...]}), with the fields of
+Flight / Booking. Times are ISO
+datetimes ("2016-08-09T07:30"), or times of day ("07:30") for flights operating daily - those
+are expanded over the next `daily_days` days, and refreshed when the date changes.
+'''
+from __future__ import unicode_literals, division
+import bisect
+import csv
+import datetime
+import io
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+LOGGER = logging.getLogger('webhooks.flights')
+
+FLIGHT_FIELDS = ('flight_number', 'airline_name', 'departure_airport', 'departure_city', 'departure_gate',
+                 'departure_terminal', 'arrival_airport', 'arrival_city', 'arrival_gate', 'arrival_terminal',
+                 'departure_time', 'arrival_time', 'departure_time_actual', 'arrival_time_actual', 'boarding_time',
+                 'status')
+BOOKING_FIELDS = ('pnr', 'passenger_name', 'flight_number', 'departure_date', 'seat', 'travel_class', 'qr_code')
+
+_TIME_FIELDS = ('departure_time', 'arrival_time', 'departure_time_actual', 'arrival_time_actual', 'boarding_time')
+_TIME_OF_DAY = re.compile(r'^\d{1,2}:\d{2}(:\d{2})?$')
+_FLIGHT_NUMBER_JUNK = re.compile(r'[\s\-]+')
+
+
+class FlightDataError(ValueError):
+    """A schedule file could not be loaded"""
+
+
+def normalize_flight_number(flight_number):
+    """'ua-123 ' -> 'UA123'"""
+    return _FLIGHT_NUMBER_JUNK.sub('', flight_number or '').upper()
+
+
+def _format_time(value):
+    return value.isoformat() if value is not None else ''
+
+
+class Flight(object):
+    """One flight (one departure of a flight number)"""
+    __slots__ = FLIGHT_FIELDS
+
+    def __init__(self, **fields):
+        for field in FLIGHT_FIELDS:
+            setattr(self, field, fields.get(field) or None)
+        self.flight_number = normalize_flight_number(self.flight_number)
+        if not self.flight_number or self.departure_time is None or not self.departure_airport:
+            raise FlightDataError("Flight needs flight_number, departure_time and departure_airport: {!r}".format(
+                fields))
+
+    @property
+    def number(self):
+        """The numeric part of the flight number"""
+        digits = re.search(r'\d+', self.flight_number)
+        return int(digits.group()) if digits else None
+
+    @property
+    def departure(self):
+        """When it leaves - the actual time if known"""
+        return self.departure_time_actual or self.departure_time
+
+    @property
+    def arrival(self):
+        """When it lands - the actual time if known"""
+        return self.arrival_time_actual or self.arrival_time
+
+    def update_json(self):
+        """The jsonData of an airline_update DataMessage"""
+        return dict(
+            flight_number=self.flight_number,
+            number=self.number,
+            airline_name=self.airline_name or '',
+            departure_airport=dict(airport_code=self.departure_airport, city=self.departure_city or '',
+                                   gate=self.departure_gate or '', terminal=self.departure_terminal or ''),
+            arrival_airport=dict(airport_code=self.arrival_airport or '', city=self.arrival_city or '',
+                                 gate=self.arrival_gate or '', terminal=self.arrival_terminal or ''),
+            flight_schedule=dict(departure_time_actual=_format_time(self.departure_time_actual),
+                                 arrival_time=_format_time(self.arrival_time),
+                                 departure_time=_format_time(self.departure_time),
+                                 boarding_time=_format_time(self.boarding_time)),
+        )
+
+    def __repr__(self):
+        return "Flight({} {} {})".format(self.flight_number, self.departure_airport, _format_time(self.departure_time))
+
+
+class Booking(object):
+    """A passenger's booking - on one flight, or several legs: "flight_number": "UAL123/UAL122"
+
+    `flight_number` is the (first) flight the boarding pass is for, `flight_numbers` all the legs.
+    """
+    __slots__ = BOOKING_FIELDS + ('flight_numbers',)
+
+    def __init__(self, **fields):
+        for field in BOOKING_FIELDS:
+            setattr(self, field, fields.get(field) or None)
+        self.pnr = (self.pnr or '').strip().upper()
+        self.flight_numbers = tuple(normalize_flight_number(number)
+                                    for number in (self.flight_number or '').split('/') if number.strip())
+        self.flight_number = self.flight_numbers[0] if self.flight_numbers else None
+        if not self.pnr or not self.flight_number:
+            raise FlightDataError("Booking needs pnr and flight_number: {!r}".format(fields))
+
+    def boarding_pass_json(self, flight):
+        """The jsonData of an airline_boardingpass DataMessage, for its `flight`"""
+        boarding = flight.boarding_time.strftime('%H:%M') if flight.boarding_time else ''
+        return dict(
+            auxiliary_fields=[dict(label='Terminal', value=flight.departure_terminal or ''),
+                              dict(label='Departure', value=flight.departure_time.strftime('%d%b %H:%M').upper())],
+            flight_info=dict(
+                arrival_airport=dict(airport_code=flight.arrival_airport or '', city=flight.arrival_city or ''),
+                departure_airport=dict(airport_code=flight.departure_airport, city=flight.departure_city or '',
+                                       gate=flight.departure_gate or '', terminal=flight.departure_terminal or ''),
+                flight_number=flight.flight_number,
+                flight_schedule=dict(arrival_time=_format_time(flight.arrival_time),
+                                     departure_time=_format_time(flight.departure_time))),
+            passenger_name=self.passenger_name or '',
+            pnr_number=self.pnr,
+            qr_code=self.qr_code or self.pnr,
+            seat=self.seat or '',
+            secondary_fields=[dict(label='Boarding', value=boarding),
+                              dict(label='Gate', value=flight.departure_gate or ''),
+                              dict(label='Seat', value=self.seat or '')],
+            travel_class=self.travel_class or 'economy',
+        )
+
+
+class FlightDataProvider(object):
+    """Where the flight webhooks get their data - all the times are naive, local to the airport"""
+
+    def flight(self, flight_number, date=None, now=None):
+        """The flight of `flight_number` departing on `date` (a datetime.date), or the next one
+        departing after `now` (the latest one if none is left), None if unknown"""
+        raise NotImplementedError
+
+    def booking(self, pnr):
+        """The Booking of `pnr`, or None"""
+        raise NotImplementedError
+
+    def flight_of(self, booking):
+        """The Flight of a booking, or None"""
+        return self.flight(booking.flight_number, date=booking.departure_date)
+
+    def flights_of(self, booking):
+        """The Flights of the legs of a booking, each one the first after the previous one - up to the
+        first unknown leg"""
+        legs = []
+        for number in booking.flight_numbers:
+            if not legs:
+                flight = self.flight(number, date=booking.departure_date)
+            else:
+                flight = self.flight(number, now=legs[-1].arrival or legs[-1].departure)
+            if flight is None:
+                break
+            legs.append(flight)
+        return legs
+
+    def cancel_booking(self, pnr):
+        """Cancel a booking, return it - None if unknown (or already cancelled)"""
+        raise NotImplementedError
+
+    def change_booking(self, pnr, flight_number, date=None):
+        """Move a booking to another flight, return the changed Booking - None if the booking is unknown"""
+        raise NotImplementedError
+
+    def departures(self, airport, start, end, limit=None):
+        """The flights leaving `airport` between `start` and `end`, by departure time"""
+        raise NotImplementedError
+
+    def arrivals(self, airport, start, end, limit=None):
+        """The flights landing at `airport` between `start` and `end`, by arrival time"""
+        raise NotImplementedError
+
+
+class _Board(object):
+    """Flights of one airport sorted by time, for range scans"""
+    __slots__ = ('times', 'flights')
+
+    def __init__(self, pairs):
+        pairs.sort(key=lambda pair: pair[0])
+        self.times = [when for when, _ in pairs]
+        self.flights = [flight for _, flight in pairs]
+
+    def between(self, start, end, limit=None):
+        low = bisect.bisect_left(self.times, start)
+        high = bisect.bisect_right(self.times, end)
+        if limit is not None:
+            high = min(high, low + limit)
+        return self.flights[low:high]
+
+
+class _FlightIndex(object):
+    """Immutable indexes over one load of the flights"""
+    __slots__ = ('by_number', 'departures', 'arrivals')
+
+    def __init__(self, flights):
+        by_number = {}
+        departures = {}
+        arrivals = {}
+        for flight in flights:
+            by_number.setdefault(flight.flight_number, []).append(flight)
+            departures.setdefault(flight.departure_airport, []).append((flight.departure, flight))
+            if flight.arrival_airport and flight.arrival is not None:
+                arrivals.setdefault(flight.arrival_airport, []).append((flight.arrival, flight))
+        for same_number in by_number.values():
+            same_number.sort(key=lambda flight: flight.departure_time)
+        self.by_number = by_number
+        self.departures = dict((airport, _Board(pairs)) for airport, pairs in departures.items())
+        self.arrivals = dict((airport, _Board(pairs)) for airport, pairs in arrivals.items())
+
+
+def _parse_time(value, day):
+    """A datetime from an ISO datetime, or a time of day on `day`"""
+    if isinstance(value, datetime.datetime) or not value:
+        return value or None
+    if _TIME_OF_DAY.match(value):
+        return datetime.datetime.combine(day, datetime.time(*map(int, value.split(':'))))
+    try:
+        return datetime.datetime.strptime(value[:19], '%Y-%m-%dT%H:%M:%S' if len(value) > 16 else '%Y-%m-%dT%H:%M')
+    except ValueError:
+        raise FlightDataError("Invalid time {!r}".format(value))
+
+
+def _expand_flight(record, today, daily_days):
+    """The Flights of one record - several for a daily flight"""
+    departure_time = record.get('departure_time') or ''
+    daily = isinstance(departure_time, str) and _TIME_OF_DAY.match(departure_time) is not None
+    days = [today + datetime.timedelta(days=offset) for offset in range(daily_days)] if daily else [None]
+    flights = []
+    for day in days:
+        fields = dict(record)
+        departure = fields['departure_time'] = _parse_time(departure_time, day)
+        if departure is None:
+            raise FlightDataError("Flight without departure_time: {!r}".format(record))
+        for field in _TIME_FIELDS[1:]:
+            value = fields.get(field)
+            if isinstance(value, str) and _TIME_OF_DAY.match(value):
+                fields[field] = _time_near(field, _parse_time(value, departure.date()), departure)
+            else:
+                fields[field] = _parse_time(value, None)
+        flights.append(Flight(**fields))
+    return flights
+
+
+def _time_near(field, when, departure):
+    """A time of day given for `field`, moved to the day that makes sense next to `departure`"""
+    one_day = datetime.timedelta(days=1)
+    if field.startswith('arrival'):
+        # landing earlier in the day than it left - lands the next day
+        return when + one_day if when < departure else when
+    if when - departure > one_day / 2:
+        return when - one_day
+    if departure - when > one_day / 2:
+        return when + one_day
+    return when
+
+
+def load_records(path):
+    """{'flights': [...], 'bookings': [...]} records of a CSV or JSON schedule file"""
+    with io.open(path, encoding='utf-8') as schedule:
+        if path.lower().endswith('.csv'):
+            reader = csv.DictReader(schedule)
+            rows = list(reader)
+            if 'pnr' in (reader.fieldnames or ()):
+                return dict(flights=[], bookings=rows)
+            return dict(flights=rows, bookings=[])
+        try:
+            data = json.load(schedule)
+        except ValueError as exc:
+            raise FlightDataError("{}: {}".format(path, exc))
+    if isinstance(data, list):
+        return dict(flights=data, bookings=[])
+    return dict(flights=data.get('flights') or [], bookings=data.get('bookings') or [])
+
+
+class LocalFlightProvider(FlightDataProvider):
+    """Flights and bookings of local schedule files, indexed in memory"""
+
+    def __init__(self, paths, check_interval=5, daily_days=2, clock=time.time):
+        self.paths = [paths] if isinstance(paths, str) else list(paths)
+        self.check_interval = check_interval
+        self.daily_days = daily_days
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._next_check = 0
+        self._mtimes = {}
+        # path -> (flights, {pnr: booking}) of its last good load, on `_loaded_day`
+        self._loaded = {}
+        self._loaded_day = None
+        self._index = None
+        self._bookings = {}
+        # PNR -> changed Booking, or None once cancelled
+        self._changed_bookings = {}
+        self._changes_lock = threading.Lock()
+
+    def refresh(self, force=False):
+        """Reload the files that changed since the last load, return True if anything was reloaded"""
+        with self._lock:
+            self._next_check = self._clock() + self.check_interval
+            today = datetime.date.fromtimestamp(self._clock())
+            new_day = today != self._loaded_day
+            changed = False
+            for path in self.paths:
+                try:
+                    mtime = os.stat(path).st_mtime
+                except OSError:
+                    mtime = None
+                if not force and not new_day and path in self._mtimes and self._mtimes[path] == mtime:
+                    continue
+                # a bad file is not retried before it changes (or the day does)
+                self._mtimes[path] = mtime
+                try:
+                    self._loaded[path] = self._load(path, today)
+                except (FlightDataError, OSError):
+                    LOGGER.exception("Could not load %s, keeping its last good schedule", path)
+                    continue
+                changed = True
+            if not changed and self._index is not None and not new_day:
+                return False
+            flights = []
+            bookings = {}
+            for path in self.paths:
+                path_flights, path_bookings = self._loaded.get(path, ((), {}))
+                flights.extend(path_flights)
+                bookings.update(path_bookings)
+            # swap in the new indexes only once they are complete
+            self._index = _FlightIndex(flights)
+            self._bookings = bookings
+            self._loaded_day = today
+            return True
+
+    def _load(self, path, today):
+        """(flights, {pnr: booking}) of one file"""
+        records = load_records(path)
+        flights = []
+        for record in records['flights']:
+            flights.extend(_expand_flight(record, today, self.daily_days))
+        bookings = {}
+        for record in records['bookings']:
+            booking = Booking(**record)
+            bookings[booking.pnr] = booking
+        return flights, bookings
+
+    def _current(self):
+        if self._index is None or self._clock() >= self._next_check:
+            self.refresh()
+        return self._index
+
+    def flight(self, flight_number, date=None, now=None):
+        flights = self._current().by_number.get(normalize_flight_number(flight_number))
+        if not flights:
+            return None
+        if date is not None:
+            if isinstance(date, str):
+                date = datetime.datetime.strptime(date[:10], '%Y-%m-%d').date()
+            for flight in flights:
+                if flight.departure_time.date() == date:
+                    return flight
+            return None
+        now = now or datetime.datetime.fromtimestamp(self._clock())
+        # still "the" flight until it landed
+        for flight in flights:
+            if (flight.arrival or flight.departure) >= now:
+                return flight
+        return flights[-1]
+
+    def booking(self, pnr):
+        self._current()
+        pnr = (pnr or '').strip().upper()
+        if pnr in self._changed_bookings:
+            return self._changed_bookings[pnr]
+        return self._bookings.get(pnr)
+
+    def cancel_booking(self, pnr):
+        with self._changes_lock:
+            booking = self.booking(pnr)
+            if booking is not None:
+                self._changed_bookings[booking.pnr] = None
+            return booking
+
+    def change_booking(self, pnr, flight_number, date=None):
+        with self._changes_lock:
+            booking = self.booking(pnr)
+            if booking is None:
+                return None
+            fields = dict((field, getattr(booking, field)) for field in BOOKING_FIELDS)
+            fields.update(flight_number=flight_number, departure_date=date)
+            changed = self._changed_bookings[booking.pnr] = Booking(**fields)
+            return changed
+
+    def departures(self, airport, start, end, limit=None):
+        board = self._current().departures.get((airport or '').upper())
+        return board.between(start, end, limit) if board is not None else []
+
+    def arrivals(self, airport, start, end, limit=None):
+        board = self._current().arrivals.get((airport or '').upper())
+        return board.between(start, end, limit) if board is not None else []
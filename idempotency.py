@@ -0,0 +1,107 @@
+# encoding: utf-8
+'''
+Duplicate suppression for the webhooks BotKit may retry - a retry must not cancel a reservation
+or change a booking twice.
+
+A call is identified by its webhook, its body (a hash of the canonical JSON), its Idempotency-Key
+header when one is sent and the server side state its reply depends on besides the body (`state`:
+the caller's login, the answers a flow has collected - the same body from two logins, or the last
+answer of two conversations, is not the same call).
+IdempotencyLayer, a WebhookDispatcher wrapper, then:
+
+    - runs the handler once for concurrent identical calls - the others wait for its reply
+      (single-flight, within this process)
+    - replays the reply of an identical call made in the last `ttl` seconds, without running
+      the handler (through the store - shared by the workers if it is a SqliteSessionStore)
+
+Only successful replies are kept; a call whose handler raised is run again on retry.
+'''
+from __future__ import unicode_literals, division
+import hashlib
+import json
+import threading
+
+from flask import Response
+
+from dispatcher import encode_reply
+from session_store import MemorySessionStore
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+REPLAY_HEADER = 'Idempotent-Replay'
+
+
+def request_key(webhook_request, header=IDEMPOTENCY_HEADER, state=''):
+    """The identity of a webhook call - webhook, Idempotency-Key header and a hash of the body and `state`"""
+    body = json.dumps(webhook_request.body, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    digest = hashlib.sha256('{}\n{}'.format(body, state).encode('utf-8')).hexdigest()[:32]
+    return 'idem:{}:{}:{}'.format(webhook_request.webhook, webhook_request.headers.get(header, ''), digest)
+
+
+class _InFlight(object):
+    __slots__ = ('done', 'body', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.body = None
+        self.error = None
+
+
+class IdempotencyLayer(object):
+    """Single-flight and replay of the calls of `webhooks`
+
+    `state`, if given, is a function of the WebhookRequest returning (as a string) the state the
+    reply depends on besides the body - calls in different states are never duplicates.
+    """
+
+    def __init__(self, webhooks, store=None, ttl=300, wait_timeout=30, header=IDEMPOTENCY_HEADER, state=None):
+        self.webhooks = frozenset(webhooks)
+        self.store = store if store is not None else MemorySessionStore()
+        self.ttl = ttl
+        self.wait_timeout = wait_timeout
+        self.header = header
+        self.state = state
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self.replays = 0
+        self.coalesced = 0
+
+    def _reply(self, body):
+        return Response(body, mimetype='application/json', headers={REPLAY_HEADER: 'true'})
+
+    def wrapper(self, call, webhook_request):
+        """WebhookDispatcher wrapper"""
+        if webhook_request.webhook not in self.webhooks:
+            return call(webhook_request)
+        state = self.state(webhook_request) if self.state is not None else ''
+        key = request_key(webhook_request, self.header, state)
+        cached = self.store.get(key)
+        if cached is not None:
+            with self._lock:
+                self.replays += 1
+            return self._reply(cached.encode('utf-8'))
+        with self._lock:
+            in_flight = self._in_flight.get(key)
+            leader = in_flight is None
+            if leader:
+                in_flight = self._in_flight[key] = _InFlight()
+        if not leader:
+            if in_flight.done.wait(self.wait_timeout):
+                with self._lock:
+                    self.coalesced += 1
+                if in_flight.error is not None:
+                    raise in_flight.error
+                return self._reply(in_flight.body)
+            # the first call is stuck - don't hang BotKit as well
+            return call(webhook_request)
+        try:
+            body = encode_reply(call(webhook_request))
+            in_flight.body = body
+            self.store.set(key, body.decode('utf-8'), self.ttl)
+            return Response(body, mimetype='application/json')
+        except Exception as exc:
+            in_flight.error = exc
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            in_flight.done.set()
@@ -0,0 +1,77 @@
+# encoding: utf-8
+'''
+Itinerary rendering - the flight legs of a booking as HtmlMessages.
+
+The leg template is compiled once. A rendered leg is kept, already encoded to JSON, keyed by the
+leg's content - the same leg shows up in many options of a search and in many bookings, and is
+then neither rendered nor encoded again. The messages are produced by generators, so the reply
+can be streamed (see botkit_messages.encode_stream) while the next legs are rendered.
+'''
+from __future__ import unicode_literals, division
+import threading
+from collections import OrderedDict
+
+from jinja2 import Environment
+
+from botkit_messages import EncodedMessage, HtmlMessage, TextMessage
+
+LEG_FIELDS = ('departs_at', 'origin', 'arrives_at', 'destination', 'airline', 'flight_number')
+
+LEG_TEMPLATE = ("<h3>{{ origin }} &rarr; {{ destination }}</h3>"
+                "<b>Departs</b> {{ departs_at }}<br>"
+                "<b>Arrives</b> {{ arrives_at }}<br>"
+                "<b>Flight</b> {{ airline }} {{ flight_number }}")
+
+
+def _time(value):
+    if value is None:
+        return ''
+    if hasattr(value, 'strftime'):
+        return value.strftime('%Y-%m-%d %H:%M')
+    return str(value).replace('T', ' ')[:16]
+
+
+def flight_leg(flight):
+    """The leg (a dict of LEG_FIELDS) of a flights.Flight"""
+    return dict(departs_at=_time(flight.departure), origin=flight.departure_airport,
+                arrives_at=_time(flight.arrival), destination=flight.arrival_airport or '',
+                airline=flight.airline_name or '', flight_number=flight.flight_number)
+
+
+class ItineraryRenderer(object):
+    """Renders legs to HtmlMessages, memoized by leg content in a bounded LRU"""
+
+    def __init__(self, leg_template=LEG_TEMPLATE, width=350, height=120, cache_size=4096):
+        self._template = Environment(autoescape=True).from_string(leg_template)
+        self.width = width
+        self.height = height
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def leg(self, leg):
+        """The HtmlMessage (pre-encoded) of a leg - a dict of LEG_FIELDS"""
+        key = tuple(leg.get(field) for field in LEG_FIELDS)
+        with self._lock:
+            message = self._cache.get(key)
+            if message is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return message
+        message = EncodedMessage.of(HtmlMessage(self._template.render(**dict(zip(LEG_FIELDS, key))),
+                                                width=self.width, height=self.height))
+        with self._lock:
+            self.misses += 1
+            self._cache[key] = message
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return message
+
+    def iter_legs(self, legs, title=None):
+        """The messages of a list of legs, after a `title` TextMessage if given"""
+        if title:
+            yield TextMessage(title)
+        for leg in legs:
+            yield self.leg(leg)
@@ -0,0 +1,201 @@
+# encoding: utf-8
+'''
+Location lookups (time zone, weather, airport directions) behind a shared read-through cache.
+
+Many users ask about the same few cities, so ReadThroughCache keeps the answers of a provider
+in memory, keyed by normalized location:
+
+    fresh (younger than `ttl`)              served from memory
+    stale (less than `stale_ttl` older)     served from memory, and refreshed in the background
+                                            on a worker pool - a failed refresh keeps the old value
+    missing or too old                      fetched while the caller waits
+
+Concurrent misses of the same key wait for one fetch (single-flight), and the cache holds at
+most `max_entries` keys, the least recently used being evicted.
+
+The providers are configured, not coded - see components.py. The ones here are stubs answering
+made up (but stable) values after an injected latency, for tests and local runs.
+'''
+from __future__ import unicode_literals, division
+import logging
+import random
+import re
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+LOGGER = logging.getLogger('webhooks.lookups')
+
+_PUNCTUATION = re.compile(r"[^\w\s'-]+", re.UNICODE)
+
+
+def normalize_location(text):
+    """The cache key of a location - case folded, without punctuation nor extra spaces"""
+    return ' '.join(_PUNCTUATION.sub(' ', text or '').split()).casefold()
+
+
+class _Entry(object):
+    __slots__ = ('value', 'fetched', 'refreshing')
+
+    def __init__(self, value, fetched):
+        self.value = value
+        self.fetched = fetched
+        self.refreshing = False
+
+
+class ReadThroughCache(object):
+    """TTL + stale-while-revalidate LRU in front of `fetch(key)`, with single-flight misses"""
+
+    def __init__(self, fetch, ttl=600, stale_ttl=3600, max_entries=1000, max_workers=4, name='lookup',
+                 clock=time.monotonic):
+        self.fetch = fetch
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self.max_workers = max_workers
+        self.name = name
+        self._clock = clock
+        self._entries = OrderedDict()
+        # {key: Future} of the fetches of missing keys
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self._executor = None
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.errors = 0
+
+    @property
+    def executor(self):
+        """The refresh pool, created on first use"""
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix=self.name)
+        return self._executor
+
+    def _store(self, key, value):
+        """Keep `value`, evicting the least recently used entries - called with the lock held"""
+        self._entries[key] = _Entry(value, self._clock())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def get(self, key):
+        """The value of `key` - raises what `fetch` raised if it had to be fetched and that failed"""
+        refresh = False
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                age = self._clock() - entry.fetched
+                if age < self.ttl + self.stale_ttl:
+                    self._entries.move_to_end(key)
+                    if age < self.ttl:
+                        self.hits += 1
+                        return entry.value
+                    self.stale_hits += 1
+                    if entry.refreshing:
+                        return entry.value
+                    entry.refreshing = refresh = True
+                else:
+                    del self._entries[key]
+            if not refresh:
+                future = self._in_flight.get(key)
+                leader = future is None
+                if leader:
+                    future = self._in_flight[key] = Future()
+                    self.misses += 1
+        if refresh:
+            self.executor.submit(self._refresh, key, entry)
+            return entry.value
+        if not leader:
+            return future.result()
+        try:
+            value = self.fetch(key)
+        except Exception as exc:
+            with self._lock:
+                del self._in_flight[key]
+                self.errors += 1
+            future.set_exception(exc)
+            raise
+        with self._lock:
+            self._store(key, value)
+            del self._in_flight[key]
+        future.set_result(value)
+        return value
+
+    def _refresh(self, key, entry):
+        try:
+            value = self.fetch(key)
+        except Exception: # pylint:disable=broad-except
+            LOGGER.warning("Refreshing %s %r failed, still serving the stale value", self.name, key, exc_info=True)
+            with self._lock:
+                self.errors += 1
+                entry.refreshing = False
+            return
+        with self._lock:
+            self.refreshes += 1
+            self._store(key, value)
+
+    def stats(self):
+        """Counters of the cache"""
+        return dict(entries=len(self._entries), hits=self.hits, stale_hits=self.stale_hits, misses=self.misses,
+                    refreshes=self.refreshes, errors=self.errors)
+
+
+class StubProvider(object):
+    """Base of the stub providers - answers after `latency` seconds, fails `failure_rate` of the time"""
+    name = 'stub'
+
+    def __init__(self, latency=0.0, failure_rate=0.0):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.calls = 0
+
+    def __call__(self, key):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if self.failure_rate and random.random() < self.failure_rate:
+            raise IOError("{} is unavailable".format(self.name))
+        return self.lookup(key, random.Random(zlib.crc32(key.encode('utf-8'))))
+
+    def lookup(self, key, rng):
+        """The value of a normalized location - `rng` is seeded by the key"""
+        raise NotImplementedError
+
+
+class StubTimezoneProvider(StubProvider):
+    """The IANA time zone of a city, None if unknown"""
+    name = 'timezone'
+    zones = {
+        'rome': 'Europe/Rome', 'paris': 'Europe/Paris', 'london': 'Europe/London', 'new york': 'America/New_York',
+        'nyc': 'America/New_York', 'san francisco': 'America/Los_Angeles', 'los angeles': 'America/Los_Angeles',
+        'tel aviv': 'Asia/Jerusalem', 'tokyo': 'Asia/Tokyo', 'moscow': 'Europe/Moscow',
+        'bangalore': 'Asia/Kolkata', 'mumbai': 'Asia/Kolkata', 'nice': 'Europe/Paris', 'sydney': 'Australia/Sydney',
+    }
+
+    def lookup(self, key, rng):
+        return self.zones.get(key)
+
+
+class StubWeatherProvider(StubProvider):
+    """(conditions, temperature in Celsius) of a city"""
+    name = 'weather'
+    conditions = ('Sunny', 'Partly cloudy', 'Cloudy', 'Light rain', 'Showers', 'Windy')
+
+    def lookup(self, key, rng):
+        return rng.choice(self.conditions), rng.randint(-5, 35)
+
+
+class StubNavigationProvider(StubProvider):
+    """Directions to a place in an airport - the key is '<airport> <place>'"""
+    name = 'navigation'
+
+    def lookup(self, key, rng):
+        airport, _, place = key.partition(' ')
+        return "{} is in terminal {} of {}, about {} minutes walk from security - follow the signs".format(
+            place.capitalize() or "That", rng.randint(1, 5), airport.upper(), rng.randint(2, 15))
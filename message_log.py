@@ -0,0 +1,187 @@
+# encoding: utf-8
+'''
+Append only NDJSON log of the events sent to the message_logger webhook.
+
+The webhook only puts the event on a bounded queue and returns; a background writer thread
+drains the queue in batches and writes each batch with a single write + fsync (group commit),
+so the cost of durability is paid once per batch, not once per message.
+
+When the queue is full (the disk can not keep up) the `overflow` policy decides:
+    'drop_newest'   reject the new event (the default - the webhook never waits)
+    'drop_oldest'   make room by dropping the oldest queued event
+    'block'         wait up to `block_timeout` seconds for room, then drop the new event
+Dropped events are counted in `stats()`.
+
+Files are rotated once they reach `max_file_bytes`, and optionally gzip compressed - every batch
+is a gzip sync flush, so a crash loses at most the batch being written.
+'''
+from __future__ import unicode_literals, division
+import atexit
+import gzip
+import logging
+import os
+import queue
+import threading
+import time
+
+from botkit_messages import encode
+
+LOGGER = logging.getLogger('webhooks.message_log')
+
+OVERFLOW_POLICIES = ('drop_newest', 'drop_oldest', 'block')
+
+_STOP = object()
+
+
+class MessageLog(object):
+    """Batched, rotating NDJSON sink written by a background thread"""
+
+    def __init__(self, directory, prefix='messages', max_file_bytes=64 * 1024 * 1024, compress=False,
+                 queue_size=10000, batch_size=500, flush_interval=1.0, overflow='drop_newest', block_timeout=0.05):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError("overflow must be one of {}, got {!r}".format(", ".join(OVERFLOW_POLICIES), overflow))
+        self.directory = directory
+        self.prefix = prefix
+        self.max_file_bytes = max_file_bytes
+        self.compress = compress
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.overflow = overflow
+        self.block_timeout = block_timeout
+        self._queue = queue.Queue(queue_size)
+        self._thread = None
+        self._start_lock = threading.Lock()
+        # `dropped` is counted by the request threads and by the writer
+        self._dropped_lock = threading.Lock()
+        self._file = None
+        self._raw = None
+        self._file_index = 0
+        self.written = 0
+        self.dropped = 0
+        self.batches = 0
+
+    def start(self):
+        """Start the writer thread - done by the first `append`"""
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='message-log-writer', daemon=True)
+                self._thread.start()
+                atexit.register(self.close)
+
+    def append(self, event):
+        """Queue one JSON-able event for writing, return False if it was dropped"""
+        if self._thread is None:
+            self.start()
+        record = (time.time(), event)
+        try:
+            if self.overflow == 'block':
+                self._queue.put(record, timeout=self.block_timeout)
+            else:
+                self._queue.put_nowait(record)
+            return True
+        except queue.Full:
+            pass
+        if self.overflow == 'drop_oldest':
+            while True:
+                try:
+                    self._queue.get_nowait()
+                    self._drop()
+                except queue.Empty:
+                    pass
+                try:
+                    self._queue.put_nowait(record)
+                    return True
+                except queue.Full:
+                    continue
+        self._drop()
+        return False
+
+    def _drop(self, count=1):
+        with self._dropped_lock:
+            self.dropped += count
+
+    def close(self, timeout=5):
+        """Write what is queued, stop the writer and close the file"""
+        thread = self._thread
+        if thread is None or not thread.is_alive():
+            return
+        self._queue.put(_STOP)
+        thread.join(timeout)
+
+    def stats(self):
+        """Counters of the sink"""
+        return dict(queued=self._queue.qsize(), written=self.written, dropped=self.dropped, batches=self.batches)
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            try:
+                first = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+            batch = []
+            if first is _STOP:
+                stopping = True
+            else:
+                batch.append(first)
+            while len(batch) < self.batch_size and not stopping:
+                try:
+                    record = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if record is _STOP:
+                    stopping = True
+                else:
+                    batch.append(record)
+            if batch:
+                try:
+                    self._write_batch(batch)
+                except Exception: # pylint:disable=broad-except
+                    # never let a bad event or a full disk kill the writer
+                    LOGGER.exception("Failed writing %d logged messages", len(batch))
+                    self._drop(len(batch))
+                    self._close_file()
+        self._close_file()
+
+    def _write_batch(self, batch):
+        lines = []
+        for received, event in batch:
+            try:
+                lines.append(encode(dict(received=received, event=event)))
+            except (TypeError, ValueError):
+                LOGGER.warning("Dropped a logged message that is not JSON serializable")
+                self._drop()
+        if not lines:
+            return
+        if self._file is None or self._raw.tell() >= self.max_file_bytes:
+            self._rotate()
+        self._file.write(('\n'.join(lines) + '\n').encode('utf-8'))
+        # one flush + fsync for the whole batch
+        self._file.flush()
+        if self._file is not self._raw:
+            self._raw.flush()
+        os.fsync(self._raw.fileno())
+        self.written += len(lines)
+        self.batches += 1
+
+    def _rotate(self):
+        self._close_file()
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self._file_index += 1
+        name = '{}-{}-{}-{}.ndjson'.format(self.prefix, time.strftime('%Y%m%d-%H%M%S'), os.getpid(),
+                                           self._file_index)
+        if self.compress:
+            name += '.gz'
+        self._raw = open(os.path.join(self.directory, name), 'ab')
+        self._file = gzip.GzipFile(fileobj=self._raw, mode='ab') if self.compress else self._raw
+
+    def _close_file(self):
+        if self._file is not None:
+            try:
+                self._file.close()
+                if self._file is not self._raw:
+                    self._raw.close()
+            except (IOError, OSError):
+                LOGGER.exception("Failed closing the message log")
+        self._file = self._raw = None
@@ -0,0 +1,269 @@
+# encoding: utf-8
+'''
+Request count, error count, payload sizes and latency histograms - per route and per webhook.
+
+Recording is lock free: each thread owns its own shard of counters and histograms, and only the
+rare reader (the `/metrics` scrape, the periodic log flush) merges the shards. The shard of a
+thread that ended is merged into the retired totals and dropped, so short lived threads do not
+pile up shards. Latencies go into
+HDR style log-linear histograms - 16 sub-buckets per power of two of microseconds, so any
+percentile is within ~6% of the exact value for a fixed few KB per route and thread.
+
+    GET /metrics         Prometheus text format (summaries with quantiles, plus counters)
+    log_interval > 0     also log one JSON line per route every `log_interval` seconds, checked at
+                         the end of requests (no background thread - a frozen Lambda has none)
+'''
+from __future__ import unicode_literals, division
+import json
+import logging
+import itertools
+import threading
+import time
+import types
+import weakref
+
+from flask import g, request, Response
+
+LOGGER = logging.getLogger('webhooks.metrics')
+
+SUB_BUCKET_BITS = 4
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+# microseconds up to 2**40 (~12 days) - anything above is clamped
+MAX_VALUE_BITS = 40
+BUCKET_COUNT = (MAX_VALUE_BITS - SUB_BUCKET_BITS + 1) * SUB_BUCKETS
+MAX_VALUE = (1 << MAX_VALUE_BITS) - 1
+
+QUANTILES = ((0.5, 'p50'), (0.9, 'p90'), (0.99, 'p99'), (0.999, 'p999'))
+
+
+def bucket_index(value):
+    """The histogram bucket of a non negative integer"""
+    if value < SUB_BUCKETS:
+        return value
+    if value > MAX_VALUE:
+        value = MAX_VALUE
+    shift = value.bit_length() - SUB_BUCKET_BITS - 1
+    return ((shift + 1) << SUB_BUCKET_BITS) + (value >> shift) - SUB_BUCKETS
+
+
+def bucket_upper_bound(index):
+    """The largest value counted in bucket `index`"""
+    if index < SUB_BUCKETS:
+        return index
+    shift = (index >> SUB_BUCKET_BITS) - 1
+    mantissa = (index & (SUB_BUCKETS - 1)) + SUB_BUCKETS
+    return ((mantissa + 1) << shift) - 1
+
+
+class Stats(object):
+    """Counters and latency histogram of one route (or webhook), in one thread"""
+    __slots__ = ('count', 'errors', 'bytes_in', 'bytes_out', 'latency_sum', 'latency_max', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.latency_sum = 0
+        self.latency_max = 0
+        self.buckets = [0] * BUCKET_COUNT
+
+    def record(self, latency_us, error=False, bytes_in=0, bytes_out=0):
+        """Count one call - only ever called by the owning thread"""
+        self.count += 1
+        if error:
+            self.errors += 1
+        self.bytes_in += bytes_in
+        self.bytes_out += bytes_out
+        self.latency_sum += latency_us
+        if latency_us > self.latency_max:
+            self.latency_max = latency_us
+        self.buckets[bucket_index(latency_us)] += 1
+
+    def merge(self, other):
+        """Add the numbers of `other` into this one"""
+        self.count += other.count
+        self.errors += other.errors
+        self.bytes_in += other.bytes_in
+        self.bytes_out += other.bytes_out
+        self.latency_sum += other.latency_sum
+        self.latency_max = max(self.latency_max, other.latency_max)
+        self.buckets = [mine + theirs for mine, theirs in zip(self.buckets, other.buckets)]
+
+    def quantile(self, fraction):
+        """Latency (microseconds) under which `fraction` of the calls completed"""
+        if not self.count:
+            return 0
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                return min(bucket_upper_bound(index), self.latency_max)
+        return self.latency_max
+
+
+class Metrics(object):
+    """Per thread sharded Stats, keyed by (family, label)"""
+
+    def __init__(self, log_interval=0):
+        self.log_interval = log_interval
+        self._local = threading.local()
+        # {shard id: shard} of the live threads, and the totals of the threads that ended
+        self._shards = {}
+        self._shard_ids = itertools.count()
+        self._retired = {}
+        self._shards_lock = threading.Lock()
+        self._last_log = time.time()
+
+    def _shard(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._local.shard = {}
+            shard_id = next(self._shard_ids)
+            with self._shards_lock:
+                self._shards[shard_id] = shard
+            weakref.finalize(threading.current_thread(), self._retire, shard_id)
+        return shard
+
+    def _retire(self, shard_id):
+        """Merge the shard of a thread that ended into the retired totals"""
+        with self._shards_lock:
+            shard = self._shards.pop(shard_id, None)
+            for key, stats in (shard or {}).items():
+                if key not in self._retired:
+                    self._retired[key] = Stats()
+                self._retired[key].merge(stats)
+
+    def record(self, family, label, latency_us, error=False, bytes_in=0, bytes_out=0):
+        """Count one call of `label` (a route or a webhook name)"""
+        shard = self._shard()
+        stats = shard.get((family, label))
+        if stats is None:
+            stats = shard[(family, label)] = Stats()
+        stats.record(latency_us, error, bytes_in, bytes_out)
+
+    def snapshot(self):
+        """{(family, label): Stats} merged over all threads"""
+        merged = {}
+        with self._shards_lock:
+            shards = list(self._shards.values())
+            for key, stats in self._retired.items():
+                merged[key] = Stats()
+                merged[key].merge(stats)
+        for shard in shards:
+            for key, stats in shard.copy().items():
+                if key not in merged:
+                    merged[key] = Stats()
+                merged[key].merge(stats)
+        return merged
+
+    def webhook_wrapper(self, call, webhook_request):
+        """WebhookDispatcher wrapper - times every handler call, batch items included
+
+        A generator reply is timed until it is exhausted (or closed), not just created.
+        """
+        started = time.perf_counter()
+        error = True
+        try:
+            reply = call(webhook_request)
+            error = False
+        finally:
+            if error:
+                self.record('handler', webhook_request.webhook, int((time.perf_counter() - started) * 1e6), True)
+        if isinstance(reply, types.GeneratorType):
+            return self._timed_stream(reply, webhook_request.webhook, started)
+        self.record('handler', webhook_request.webhook, int((time.perf_counter() - started) * 1e6))
+        return reply
+
+    def _timed_stream(self, reply, label, started):
+        error = True
+        try:
+            yield from reply
+            error = False
+        finally:
+            self.record('handler', label, int((time.perf_counter() - started) * 1e6), error)
+
+    def _before_request(self):
+        g.metrics_started = time.perf_counter()
+
+    def _after_request(self, response):
+        started = g.pop('metrics_started', None)
+        if started is not None:
+            route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+            error = response.status_code >= 500
+            bytes_in = request.content_length or 0
+            if response.is_streamed:
+                # timed (and its bytes counted) until the last chunk is sent and the response closed
+                sent = [0]
+                response.response = _counted(response.response, sent)
+                response.call_on_close(lambda: self.record('http', route, int((time.perf_counter() - started) * 1e6),
+                                                           error=error, bytes_in=bytes_in, bytes_out=sent[0]))
+            else:
+                self.record('http', route, int((time.perf_counter() - started) * 1e6), error=error,
+                            bytes_in=bytes_in, bytes_out=response.content_length or 0)
+        if self.log_interval and time.time() - self._last_log >= self.log_interval:
+            self.log()
+        return response
+
+    def log(self):
+        """Log one JSON line per route/webhook with its totals so far"""
+        self._last_log = time.time()
+        for (family, label), stats in sorted(self.snapshot().items()):
+            LOGGER.info(json.dumps(dict(metric='webhooks', family=family, label=label, count=stats.count,
+                                        errors=stats.errors, bytes_in=stats.bytes_in, bytes_out=stats.bytes_out,
+                                        latency_ms=dict((name, stats.quantile(q) / 1000) for q, name in QUANTILES),
+                                        latency_max_ms=stats.latency_max / 1000), sort_keys=True))
+
+    def prometheus(self):
+        """The metrics in Prometheus text exposition format"""
+        snapshot = sorted(self.snapshot().items())
+        lines = []
+        for family, label_name in (('http', 'route'), ('handler', 'webhook')):
+            rows = [(label, stats) for (row_family, label), stats in snapshot if row_family == family]
+            name = 'webhooks_{}'.format(family)
+            lines.append('# TYPE {}_latency_seconds summary'.format(name))
+            for label, stats in rows:
+                labels = '{}="{}"'.format(label_name, _escape(label))
+                for q, _ in QUANTILES:
+                    lines.append('{}_latency_seconds{{{},quantile="{}"}} {}'.format(
+                        name, labels, q, stats.quantile(q) / 1e6))
+                lines.append('{}_latency_seconds_sum{{{}}} {}'.format(name, labels, stats.latency_sum / 1e6))
+                lines.append('{}_latency_seconds_count{{{}}} {}'.format(name, labels, stats.count))
+            counters = [('errors_total', 'errors')]
+            if family == 'http':
+                counters += [('request_bytes_total', 'bytes_in'), ('response_bytes_total', 'bytes_out')]
+            for suffix, attr in counters:
+                lines.append('# TYPE {}_{} counter'.format(name, suffix))
+                for label, stats in rows:
+                    lines.append('{}_{}{{{}="{}"}} {}'.format(name, suffix, label_name, _escape(label),
+                                                              getattr(stats, attr)))
+        return '\n'.join(lines) + '\n'
+
+    def metrics_view(self):
+        """The /metrics endpoint"""
+        return Response(self.prometheus(), mimetype='text/plain; version=0.0.4')
+
+    def init_app(self, app, dispatcher=None, rule='/metrics'):
+        """Time every request of `app` (and every handler of `dispatcher`), serve them on `rule`"""
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.add_url_rule(rule, 'metrics', self.metrics_view, methods=['GET'])
+        if dispatcher is not None:
+            dispatcher.add_wrapper(self.webhook_wrapper)
+
+
+def _counted(chunks, sent):
+    """The chunks of a streamed body, adding up their size in sent[0]"""
+    try:
+        for chunk in chunks:
+            sent[0] += len(chunk)
+            yield chunk
+    finally:
+        close = getattr(chunks, 'close', None)
+        if close is not None:
+            close()
+
+
+def _escape(label):
+    return label.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
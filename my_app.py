@@ -13,24 +13,78 @@ This is Zappa - https://github.com/Miserlou/Zappa
 Assuming you have an AWS account you can have these webhooks running, "serverless", in 5 minutes.
 '''
 from __future__ import unicode_literals, division
-import string
-import random
+import os
 import json
-from random import sample
-
-from flask import Flask, request, redirect, render_template, jsonify, make_response
-import requests
+import datetime
+import tempfile
+from urllib.parse import unquote
+from zoneinfo import ZoneInfo
+
+from flask import Flask, request, redirect, render_template
+from jinja2 import ChoiceLoader, ModuleLoader
+
+# BOTKIT_API_LATEST_VERSION and DataMessageSubType used to live here, keep them importable from my_app
+from botkit_messages import BOTKIT_API_LATEST_VERSION, DataMessageSubType # pylint:disable=unused-import
+from botkit_messages import (BotkitResponse, TextMessage, ImageMessage, MultiChoiceQuestion, QuestionnaireEvent, Hook,
+                             LoginOAuthEvent, HandoffToHumanEvent, AirlineUpdateMessage, AirlineBoardingPassMessage,
+                             RichMessage, MultiRichMessage, EmailQuestion, OpenQuestion)
+from admission import AdmissionControl
+from capture import TrafficCapture
+from components import build, providers_config
+from compression import Compressor
+from dispatcher import WebhookDispatcher
+from flights import LocalFlightProvider
+from idempotency import IdempotencyLayer
+from itinerary import ItineraryRenderer, flight_leg
+from lookups import ReadThroughCache, normalize_location
+from message_log import MessageLog
+from metrics import Metrics
+from pagination import SHOW_MORE_WEBHOOK, Paginator, split_results
+from profiling import SamplingProfiler
+from proxy import CachingProxy
+from questionnaire import Flow, QuestionnaireEngine, Step
+from response_cache import static_response
+from search import SEARCH_FIELDS, SearchService
+from session_store import SessionManager, session_store_from_env
+from suggestions import SuggestionEngine
 
 APP = Flask(__name__)
 
-BOTKIT_API_LATEST_VERSION = "0.4.0"
-
-class DataMessageSubType(object):
-    """Sub Types of DataMessage JSON data"""
-    airline_itinerary = "airline_itinerary"
-    airline_checkin = "airline_checkin"
-    airline_boardingpass = "airline_boardingpass"
-    airline_update = "airline_update"
+# Templates precompiled by `python coldstart.py precompile` (run it before deploying) are imported instead of
+# being parsed and compiled by the first request of every cold Lambda. Without them Jinja compiles on first use.
+PRECOMPILED_TEMPLATES_DIR = os.path.join(APP.root_path, 'templates_compiled')
+if os.path.isdir(PRECOMPILED_TEMPLATES_DIR):
+    APP.jinja_options = dict(APP.jinja_options, loader=ChoiceLoader([ModuleLoader(PRECOMPILED_TEMPLATES_DIR),
+                                                                     APP.create_global_jinja_loader()]))
+WEBHOOKS = WebhookDispatcher()
+WEBHOOKS.init_app(APP)
+# WEBHOOKS_METRICS_LOG_INTERVAL=60 also logs the metrics as JSON lines (CloudWatch) once a minute
+METRICS = Metrics(log_interval=float(os.environ.get('WEBHOOKS_METRICS_LOG_INTERVAL', 0)))
+METRICS.init_app(APP, WEBHOOKS)
+# registered after METRICS so the metrics count the compressed bytes
+COMPRESSOR = Compressor()
+COMPRESSOR.init_app(APP)
+# WEBHOOKS_PROFILE_EVERY=100 profiles 1 in 100 requests, WEBHOOKS_PROFILE_TOKEN=<secret> the requests with an
+# "X-Profile: <secret>" header - their stacks are served by /admin/profile (to the holders of the token only), and
+# written to WEBHOOKS_PROFILE_FILE at exit
+if os.environ.get('WEBHOOKS_PROFILE_EVERY') or os.environ.get('WEBHOOKS_PROFILE_TOKEN'):
+    PROFILER = SamplingProfiler(every=int(os.environ.get('WEBHOOKS_PROFILE_EVERY') or 0),
+                                token=os.environ.get('WEBHOOKS_PROFILE_TOKEN'),
+                                dump_path=os.environ.get('WEBHOOKS_PROFILE_FILE'))
+    PROFILER.init_app(APP)
+# WEBHOOKS_CAPTURE_DIR=<dir> records the traffic (a WEBHOOKS_CAPTURE_SAMPLE fraction of it) as gzipped NDJSON, for
+# benchmarks/replay.py to replay in load tests
+CAPTURE = None
+if os.environ.get('WEBHOOKS_CAPTURE_DIR'):
+    CAPTURE = TrafficCapture(APP.wsgi_app, MessageLog(os.environ['WEBHOOKS_CAPTURE_DIR'], prefix='capture',
+                                                      compress=True),
+                             sample_rate=float(os.environ.get('WEBHOOKS_CAPTURE_SAMPLE', 1)))
+    APP.wsgi_app = CAPTURE
+# authorization codes issued by /dl and the login data of users - set WEBHOOKS_SESSION_DB to share them between workers
+SESSIONS = SessionManager(session_store_from_env())
+# long result lists go out one page at a time, the rest waits behind a cursor (in a store of its own, shared by the
+# workers like the sessions, so any worker can serve the next page)
+PAGES = Paginator(session_store_from_env('pages', max_entries=5000), ttl=900)
 
 class BotWebhookTypes(object):
     """The applicative webhooks"""
@@ -61,14 +115,13 @@ class BotWebhookTypes(object):
     show_reservation = 'show_reservation'
     ask_time = 'ask_time'
     ask_weather = 'ask_weather'
+    roadside_assistance = 'roadside_assistance'
 
 
-FLIGHT_STATUS_MESSAGE_EXAMPLE = dict(
-    _type='DataMessage',
-    subType='airline_update',
-    asAttachment=False,
-    introMessage='Here is an example of a Flight Status',
-    jsonData=dict(
+FLIGHT_STATUS_MESSAGE_EXAMPLE = AirlineUpdateMessage(
+    as_attachment=False,
+    intro_message='Here is an example of a Flight Status',
+    json_data=dict(
                 flight_number='UAL123',
                 number=123,
                 airline_name='United',
@@ -94,12 +147,36 @@ FLIGHT_STATUS_MESSAGE_EXAMPLE = dict(
     )
 
 
-BOARDING_PASS_MESSAGE_EXAMPLE = dict(
-    _type='DataMessage',
-    subType='airline_boardingpass',
-    asAttachment=True,
-    introMessage='Here is an example of a Boarding Pass',
-    jsonData={'auxiliary_fields': [{'label': 'Terminal', 'value': 'T1'},
+# flights and bookings answering the flight webhooks - WEBHOOKS_FLIGHTS_FILE is a comma separated list of
+# schedule files (CSV or JSON, see flights.py), loaded on first use and reloaded when they change
+FLIGHTS = LocalFlightProvider(
+    (os.environ.get('WEBHOOKS_FLIGHTS_FILE') or os.path.join(APP.root_path, 'data', 'schedule.json')).split(','))
+DEFAULT_AIRPORT = os.environ.get('WEBHOOKS_DEFAULT_AIRPORT', 'LHR')
+# the body fields the flight webhooks look at
+FLIGHT_QUERY_SCHEMA = {'flight_number': str, 'pnr': str, 'date': str}
+
+def requested_flight(webhook_request):
+    """(what was asked, the Flight or None) of a flight webhook call - (None, None) if no flight was asked about
+
+    The flight is the `flight_number` (on `date`) of the body, or the flight of the booking of its `pnr`.
+    """
+    number = webhook_request.get('flight_number')
+    if number:
+        try:
+            return number, FLIGHTS.flight(number, date=webhook_request.get('date'))
+        except ValueError:
+            return "{} on {}".format(number, webhook_request.get('date')), None
+    pnr = webhook_request.get('pnr')
+    if pnr:
+        booking = FLIGHTS.booking(pnr)
+        return "for booking {}".format(pnr), FLIGHTS.flight_of(booking) if booking is not None else None
+    return None, None
+
+
+BOARDING_PASS_MESSAGE_EXAMPLE = AirlineBoardingPassMessage(
+    as_attachment=True,
+    intro_message='Here is an example of a Boarding Pass',
+    json_data={'auxiliary_fields': [{'label': 'Terminal', 'value': 'T1'},
                                    {'label': 'Departure', 'value': '30OCT 19:05'}],
               'flight_info': {'arrival_airport': {'airport_code': 'AMS', 'city': 'Amsterdam'},
                               'departure_airport': {'airport_code': 'JFK', 'city': 'New York', 'gate': 'D57', 'terminal': 'T1'},
@@ -119,64 +196,67 @@ BOARDING_PASS_MESSAGE_EXAMPLE = dict(
     )
 
 
+SIMPLE_RESPONSE = static_response('simple', BotkitResponse([
+    TextMessage("Here is a text message"),
+    TextMessage("and a picture of a fish"),
+    ImageMessage("http://pngimg.com/upload/fish_PNG10538.png"),
+]))
+
 @APP.route('/simple', methods=['POST'])
 def simple():
     """Simple view function"""
-    response = dict(messages=[
-        dict(_type="TextMessage", text="Here is a text message"),
-        dict(_type="TextMessage", text="and a picture of a fish"),
-        dict(_type="ImageMessage",
-             imageUrl="http://pngimg.com/upload/fish_PNG10538.png")
-                                    ],
-                    botkitVersion=BOTKIT_API_LATEST_VERSION)
-    return jsonify(response)
+    return SIMPLE_RESPONSE.serve()
+
 
+HUMAN_RESPONSE = static_response('human', BotkitResponse([
+    TextMessage("I will try to transfer you to an agent!"),
+    HandoffToHumanEvent(),
+]))
+
+@WEBHOOKS.handler(BotWebhookTypes.contact_support)
+def contact_support_webhook(webhook_request): # pylint:disable=unused-argument
+    """Transfer to Human webhook"""
+    return HUMAN_RESPONSE
 
 @APP.route('/human', methods=['POST'])
 def human():
     """Transfer to Human function"""
-    response = dict(messages=[
-        dict(_type="TextMessage", text="I will try to transfer you to an agent!"),
-        dict(_type="HandoffToHumanEvent")
-                                    ],
-                    botkitVersion=BOTKIT_API_LATEST_VERSION)
-    return jsonify(response)
+    return WEBHOOKS.serve(BotWebhookTypes.contact_support)
+
+
+
+LOGIN_REQUIRED_MESSAGE = LoginOAuthEvent(text='Please Login in first',
+                                         web_login_url='https://chat.evature.com/demo_login',
+                                         login_success_hook=Hook('flight_boarding_pass'))
 
+# not a BotKit webhook type - the demo of a webhook that needs login, registered so batches can use it too
+LOCKED_WEBHOOK = 'locked'
 
+@WEBHOOKS.handler(LOCKED_WEBHOOK)
+def locked_webhook(webhook_request):
+    """Simple webhook that needs login"""
+    if SESSIONS.login_data(webhook_request):
+        return [
+            TextMessage("I guess you logged in"),
+            TextMessage("But you still get a picture of a lock"),
+            ImageMessage("http://www.fortresslockandsecurity.com/wp-content/uploads/2014/04/Austin-Locksmith.png"),
+        ]
+    return [LOGIN_REQUIRED_MESSAGE]
 
 @APP.route('/locked', methods=['POST'])
 def locked():
     """Simple view function that needs login"""
-    body = request.get_json(force=True)
-    if body and isinstance(body, dict) and body.get('loginData'):
-        response = dict(messages=[
-            dict(_type="TextMessage", text="I guess you logged in"),
-            dict(_type="TextMessage", text="But you still get a picture of a lock"),
-            dict(_type="ImageMessage",
-                 imageUrl="http://www.fortresslockandsecurity.com/wp-content/uploads/2014/04/Austin-Locksmith.png")
-                                    ],
-                        botkitVersion=BOTKIT_API_LATEST_VERSION)
-    else:
-        response = dict(botkitVersion=BOTKIT_API_LATEST_VERSION,
-                        messages=[dict(_type='LoginOAuthEvent',
-                                       loginSuccessHook={'webhook': 'flight_boarding_pass'},
-                                       text='Please Login in first',
-                                       webLoginUrl='https://chat.evature.com/demo_login')])
-    return jsonify(response)
+    return WEBHOOKS.serve(LOCKED_WEBHOOK)
+
 
 
+BOARDING_PASS_RESPONSE = static_response('boarding_pass', BotkitResponse([BOARDING_PASS_MESSAGE_EXAMPLE]))
 
 @APP.route('/bp', methods=['POST'])
 def boarding_pass():
     """Return a boarding pass"""
-    response = dict(messages=[BOARDING_PASS_MESSAGE_EXAMPLE],
-                    botkitVersion=BOTKIT_API_LATEST_VERSION)
-    return jsonify(response)
+    return BOARDING_PASS_RESPONSE.serve()
 
-def random_string(length_of_string):
-    """Generate a random string"""
-    return ''.join(random.choice(string.ascii_uppercase + string.digits)
-                   for _ in range(length_of_string))
 
 @APP.route('/dl', methods=['GET', 'POST'])
 def demo_login():
@@ -209,7 +289,8 @@ def demo_login():
                 # success
                 messages.append("Success!")
                 if redirect_uri:
-                    return redirect('{}&authorization_code={}'.format(redirect_uri, random_string(5)))
+                    code = SESSIONS.issue_code(dict(username=username))
+                    return redirect('{}&authorization_code={}'.format(redirect_uri, code))
             else:
                 # fail
                 messages.append("Invalid Username/Password<br>Use &ldquo;username&rdquo;  and &ldquo;password&rdquo;"
@@ -218,43 +299,269 @@ def demo_login():
     return render_template('demo_login.html', **context)
 
 
+@WEBHOOKS.handler(BotWebhookTypes.flight_boarding_pass, schema=FLIGHT_QUERY_SCHEMA)
+def flight_boarding_pass(webhook_request):
+    """Boarding pass webhook - only for logged in users"""
+    login_data = SESSIONS.login_data(webhook_request)
+    if not login_data:
+        return [LOGIN_REQUIRED_MESSAGE]
+    pnr = webhook_request.get('pnr') or (login_data.get('pnr') if isinstance(login_data, dict) else None)
+    booking = FLIGHTS.booking(pnr) if pnr else None
+    flight = FLIGHTS.flight_of(booking) if booking is not None else None
+    if flight is None:
+        return [BOARDING_PASS_MESSAGE_EXAMPLE]
+    return [AirlineBoardingPassMessage(as_attachment=True, intro_message='Here is your Boarding Pass',
+                                       json_data=booking.boarding_pass_json(flight))]
+
 @APP.route('/bplogin', methods=['POST'])
 def flight_boarding_pass_webhook():
-    body = request.get_json(force=True)
-    if body and isinstance(body, dict) and body.get('loginData'):
-        response = dict(messages=[BOARDING_PASS_MESSAGE_EXAMPLE],
-                        botkitVersion=BOTKIT_API_LATEST_VERSION)
-    else:
-        response = dict(botkitVersion=BOTKIT_API_LATEST_VERSION,
-                        messages=[dict(_type='LoginOAuthEvent',
-                                       loginSuccessHook={'webhook': 'flight_boarding_pass'},
-                                       text='Please Login in first',
-                                       webLoginUrl='https://chat.evature.com/demo_login')])
-    return jsonify(response)
+    """Boarding pass webhook - only for logged in users"""
+    return WEBHOOKS.serve(BotWebhookTypes.flight_boarding_pass)
+
+ROADSIDE_RESPONSE = static_response('roadside', BotkitResponse([
+    TextMessage("If you need roadside assistance with your Avis vehicle, please call 877-485-5295"),
+    ImageMessage("http://www.whatafuture.com/wp-content/uploads/2015/03/Google-roadside-assistance-1024x683.jpg"),
+]))
 
 @APP.route('/roadside', methods=['POST'])
 def roadside():
     """Simple roadside assistance function"""
-    response = dict(messages=[
-        dict(_type="TextMessage", text="If you need roadside assistance with your Avis vehicle, please call 877-485-5295"),
-        dict(_type="ImageMessage",
-             imageUrl="http://www.whatafuture.com/wp-content/uploads/2015/03/Google-roadside-assistance-1024x683.jpg")
-                                    ],
-                    botkitVersion=BOTKIT_API_LATEST_VERSION)
-    return jsonify(response)
-
+    return ROADSIDE_RESPONSE.serve()
+
+
+def roadside_dispatch(webhook_request):
+    """The last step of the roadside assistance flow - send help where the vehicle is"""
+    email = webhook_request.get('email')
+    return [TextMessage("Help is on the way to {}.{} For anything else please call 877-485-5295".format(
+        webhook_request.get('location'), " We sent the details to {}.".format(email) if email else ""))]
+
+ROADSIDE_FLOW = Flow('roadside_assistance', BotWebhookTypes.roadside_assistance, [
+    Step('ask', questions=[EmailQuestion(name='email', text="I need to identify you, what is your email?"),
+                           MultiChoiceQuestion(name='what_happened', text="What happened?",
+                                               choices=["Accident", "Mechanical problem", "Flat tire", "Locked out",
+                                                        "Other"])],
+         branch=('what_happened', {"Accident": 'injuries'}), then='location'),
+    Step('injuries', questions=[MultiChoiceQuestion(name='injured', text="Is anyone hurt?", choices=["Yes", "No"])],
+         branch=('injured', {"Yes": 'emergency'}), then='location'),
+    Step('emergency', say=[TextMessage("Please call 911 right away, then Avis at 877-485-5295")]),
+    Step('location', questions=[OpenQuestion(name='location', text="Where is the vehicle? An address or the nearest "
+                                                                   "highway exit")], then='dispatch'),
+    Step('dispatch', action=roadside_dispatch),
+])
+
+@WEBHOOKS.handler(BotWebhookTypes.roadside_assistance, schema=ROADSIDE_FLOW.schema())
+def roadside_assistance(webhook_request):
+    """Roadside assistance, one question at a time"""
+    reply = QUESTIONNAIRES.answer(webhook_request)
+    if reply is not None:
+        return reply
+    return QUESTIONNAIRES.start('roadside_assistance', webhook_request)
+
+@APP.route('/roadside_assistance', methods=['POST'])
+def roadside_assistance_webhook():
+    """Roadside assistance questionnaire"""
+    return WEBHOOKS.serve(BotWebhookTypes.roadside_assistance)
+
+
+FLIGHT_STATUS_RESPONSE = static_response('flight_status', BotkitResponse([FLIGHT_STATUS_MESSAGE_EXAMPLE]))
+
+@WEBHOOKS.handler(BotWebhookTypes.flight_status, schema=FLIGHT_QUERY_SCHEMA)
+def flight_status_webhook(webhook_request):
+    """Flight status of the requested flight - the example status when no flight was asked about"""
+    query, flight = requested_flight(webhook_request)
+    if query is None:
+        return FLIGHT_STATUS_RESPONSE
+    if flight is None:
+        return [TextMessage("I could not find flight {}".format(query))]
+    return [AirlineUpdateMessage(as_attachment=False, json_data=flight.update_json(),
+                                 intro_message='Here is the status of flight {}'.format(flight.flight_number))]
 
 @APP.route('/flightstat', methods=['POST'])
 def flight_status():
     """Simple flight status reply"""
-    response = dict(messages=[FLIGHT_STATUS_MESSAGE_EXAMPLE],
-                    botkitVersion=BOTKIT_API_LATEST_VERSION)
-    return jsonify(response)
+    return WEBHOOKS.serve(BotWebhookTypes.flight_status)
+
+
+def _hhmm(when):
+    return when.strftime('%H:%M')
+
+def _gate_answer(flight):
+    if not flight.departure_gate:
+        return "The gate of flight {} is not known yet".format(flight.flight_number)
+    terminal = " in terminal {}".format(flight.departure_terminal) if flight.departure_terminal else ""
+    return "Flight {} departs from gate {}{}".format(flight.flight_number, flight.departure_gate, terminal)
+
+def _departure_answer(flight):
+    answer = "Flight {} departs {} at {}".format(flight.flight_number, flight.departure_airport,
+                                                _hhmm(flight.departure_time))
+    if flight.departure_time_actual and flight.departure_time_actual != flight.departure_time:
+        answer += ", expected at {}".format(_hhmm(flight.departure_time_actual))
+    return answer
+
+def _arrival_answer(flight):
+    if flight.arrival is None:
+        return "The arrival time of flight {} is not known yet".format(flight.flight_number)
+    return "Flight {} arrives at {} at {}".format(flight.flight_number, flight.arrival_airport, _hhmm(flight.arrival))
+
+def _boarding_answer(flight):
+    if flight.boarding_time is None:
+        return "The boarding time of flight {} is not known yet".format(flight.flight_number)
+    return "Boarding for flight {} starts at {}".format(flight.flight_number, _hhmm(flight.boarding_time))
+
+FLIGHT_ANSWERS = {
+    BotWebhookTypes.flight_gate_number: _gate_answer,
+    BotWebhookTypes.flight_departure_time: _departure_answer,
+    BotWebhookTypes.flight_arrival_time: _arrival_answer,
+    BotWebhookTypes.flight_boarding_time: _boarding_answer,
+}
 
-@APP.route('/taltesting', methods=['POST'])
-def tal_testing():
-    """Playground for testing stuff"""
-    response = """{
+@WEBHOOKS.handler(*FLIGHT_ANSWERS, schema=FLIGHT_QUERY_SCHEMA)
+def flight_details(webhook_request):
+    """Gate, departure, arrival or boarding time of the requested flight"""
+    query, flight = requested_flight(webhook_request)
+    if query is None:
+        return [TextMessage("Which flight? Please tell me the flight number")]
+    if flight is None:
+        return [TextMessage("I could not find flight {}".format(query))]
+    return [TextMessage(FLIGHT_ANSWERS[webhook_request.webhook](flight))]
+
+
+# arrivals/departures boards show the flights of this window around now
+BOARD_PAST = datetime.timedelta(minutes=30)
+BOARD_AHEAD = datetime.timedelta(hours=6)
+BOARD_SIZE = 10
+
+@WEBHOOKS.handler(BotWebhookTypes.arrivals, BotWebhookTypes.departures, schema={'airport': str})
+def flights_board(webhook_request):
+    """Arrivals or departures board of an airport"""
+    airport = (webhook_request.get('airport') or DEFAULT_AIRPORT).upper()
+    now = datetime.datetime.now()
+    if webhook_request.webhook == BotWebhookTypes.arrivals:
+        title = "arrivals at {}".format(airport)
+        flights = FLIGHTS.arrivals(airport, now - BOARD_PAST, now + BOARD_AHEAD, limit=BOARD_SIZE)
+        cards = [RichMessage("{} {} from {}".format(_hhmm(flight.arrival), flight.flight_number,
+                                                   flight.departure_city or flight.departure_airport),
+                             subtitle=flight.status) for flight in flights]
+    else:
+        title = "departures from {}".format(airport)
+        flights = FLIGHTS.departures(airport, now - BOARD_PAST, now + BOARD_AHEAD, limit=BOARD_SIZE)
+        cards = [RichMessage("{} {} to {}".format(_hhmm(flight.departure), flight.flight_number,
+                                                 flight.arrival_city or flight.arrival_airport),
+                             subtitle=" - ".join(part for part in (flight.status, flight.departure_gate and
+                                                                   "Gate {}".format(flight.departure_gate)) if part)
+                             or None) for flight in flights]
+    if not cards:
+        return [TextMessage("No {} in the next {} hours".format(title, BOARD_AHEAD.seconds // 3600))]
+    return [TextMessage(title[0].upper() + title[1:]), MultiRichMessage(cards)]
+
+
+ITINERARIES = ItineraryRenderer()
+
+def requested_pnr(webhook_request):
+    """The `pnr` of the body, or else the one of the logged in user"""
+    pnr = webhook_request.get('pnr')
+    if not pnr:
+        login_data = SESSIONS.login_data(webhook_request)
+        pnr = login_data.get('pnr') if isinstance(login_data, dict) else None
+    return pnr
+
+@WEBHOOKS.handler(BotWebhookTypes.flight_itinerary, BotWebhookTypes.reservation_show, schema={'pnr': str})
+def show_itinerary(webhook_request):
+    """The legs of the booking of the `pnr` in the body, or of the logged in user"""
+    pnr = requested_pnr(webhook_request)
+    if not pnr:
+        return [TextMessage("What is your booking reference?")]
+    booking = FLIGHTS.booking(pnr)
+    legs = FLIGHTS.flights_of(booking) if booking is not None else []
+    if not legs:
+        return [TextMessage("I could not find booking {}".format(pnr))]
+    title = "Booking {}{}".format(booking.pnr, " - {}".format(booking.passenger_name) if booking.passenger_name else "")
+    return ITINERARIES.iter_legs((flight_leg(flight) for flight in legs), title)
+
+
+def caller_state(webhook_request):
+    """What the reply depends on besides the body - the caller's login and the answers of their flow so far"""
+    return json.dumps([SESSIONS.login_data(webhook_request), QUESTIONNAIRES.stored(webhook_request)], sort_keys=True)
+
+# BotKit retries webhooks on timeout - a retry of these must not run them twice. Not identify_user:
+# its reply opens a session, a replay would hand that session to whoever sends the same answers.
+IDEMPOTENCY = IdempotencyLayer([BotWebhookTypes.reservation_cancel, BotWebhookTypes.change_booking],
+                               store=session_store_from_env('idempotency'), state=caller_state)
+WEBHOOKS.add_wrapper(IDEMPOTENCY.wrapper)
+
+IDENTIFY_USER_QUESTIONS = [QuestionnaireEvent(
+    answered_hook=Hook(BotWebhookTypes.identify_user),
+    questions=[EmailQuestion(name='email', text="What is your email?"),
+               OpenQuestion(name='pnr', text="What is your booking reference?", validation_regex="[A-Za-z0-9]{6}")])]
+
+@WEBHOOKS.handler(BotWebhookTypes.identify_user_questions)
+def identify_user_questions(webhook_request): # pylint:disable=unused-argument
+    """The questions of the login form - the answers go to identify_user"""
+    return IDENTIFY_USER_QUESTIONS
+
+@WEBHOOKS.handler(BotWebhookTypes.identify_user, schema={'email': str, 'pnr': str})
+def identify_user(webhook_request):
+    """Log the user in with the answers of the login form - their email and booking reference"""
+    pnr = webhook_request.get('pnr')
+    booking = FLIGHTS.booking(pnr) if pnr else None
+    if booking is None:
+        return [TextMessage("Sorry, I could not find booking {}".format(pnr or ''))]
+    login_data = dict(pnr=booking.pnr, email=webhook_request.get('email'), name=booking.passenger_name)
+    user = webhook_request.user
+    login_data = SESSIONS.open_session(login_data, user.user_id if user is not None else None)
+    return dict(botkitVersion=BOTKIT_API_LATEST_VERSION, loginData=login_data,
+                messages=[TextMessage("Thanks, you are logged in")])
+
+@WEBHOOKS.handler(BotWebhookTypes.reservation_cancel, schema={'pnr': str})
+def reservation_cancel(webhook_request):
+    """Cancel the booking of the `pnr` in the body, or of the logged in user"""
+    pnr = requested_pnr(webhook_request)
+    if not pnr:
+        return [TextMessage("What is your booking reference?")]
+    booking = FLIGHTS.cancel_booking(pnr)
+    if booking is None:
+        return [TextMessage("I could not find booking {}".format(pnr))]
+    return [TextMessage("Booking {} is cancelled".format(booking.pnr))]
+
+def change_booking_now(webhook_request):
+    """Move the booking of the `pnr` in the body (or of the logged in user) to `flight_number` on `date`"""
+    pnr = requested_pnr(webhook_request)
+    query, flight = requested_flight(webhook_request)
+    if flight is None:
+        return [TextMessage("I could not find flight {}".format(query))]
+    booking = FLIGHTS.change_booking(pnr, flight.flight_number, flight.departure_time.date().isoformat())
+    if booking is None:
+        return [TextMessage("I could not find booking {}".format(pnr))]
+    return [TextMessage("Booking {} is now on flight {}, departing {} at {}".format(
+        booking.pnr, flight.flight_number, flight.departure_airport, flight.departure_time.strftime('%Y-%m-%d %H:%M')))]
+
+CHANGE_BOOKING_FLOW = Flow('change_booking', BotWebhookTypes.change_booking, [
+    Step('booking', questions=[OpenQuestion(name='pnr', text="What is your booking reference?",
+                                            validation_regex="[A-Za-z0-9]{6}")], then='flight'),
+    Step('flight', questions=[OpenQuestion(name='flight_number', text="Which flight would you like instead?"),
+                              OpenQuestion(name='date', text="On which date? (YYYY-MM-DD)",
+                                           validation_regex=r"\d{4}-\d{2}-\d{2}")], then='confirm'),
+    Step('confirm', questions=[MultiChoiceQuestion(name='confirm', text="Shall I change your booking to this flight?",
+                                                   choices=["Yes", "No"])],
+         branch=('confirm', {"Yes": 'change'}), then='keep'),
+    Step('change', action=change_booking_now),
+    Step('keep', say=[TextMessage("OK, your booking stays as it is")]),
+])
+
+@WEBHOOKS.handler(BotWebhookTypes.change_booking, schema=dict(FLIGHT_QUERY_SCHEMA, **CHANGE_BOOKING_FLOW.schema()))
+def change_booking(webhook_request):
+    """Change a booking right away when the call says to what, or else ask for what is missing"""
+    reply = QUESTIONNAIRES.answer(webhook_request)
+    if reply is not None:
+        return reply
+    pnr = requested_pnr(webhook_request)
+    if pnr and webhook_request.get('flight_number'):
+        return change_booking_now(webhook_request)
+    return QUESTIONNAIRES.start('change_booking', webhook_request, slots=dict(
+        pnr=pnr, flight_number=webhook_request.get('flight_number'), date=webhook_request.get('date')))
+
+
+TAL_TESTING_RESPONSE = static_response('tal_testing', json.loads("""{
   "botkitVersion": "0.3.0",
   "messages": [
     {
@@ -267,23 +574,28 @@ def tal_testing():
       ]
     }
   ]
-}"""
+}"""))
+
+@APP.route('/taltesting', methods=['POST'])
+def tal_testing():
+    """Playground for testing stuff"""
+    return TAL_TESTING_RESPONSE.serve()
 
-    return jsonify(json.loads(response))
+
+ROSHAN_RESULTS = json.loads(r"""
+{"botkitVersion":"0.3.0","messages":[{"_type":"TextMessage","text":"Here are the the top 3 results:"},{"_type":"MultiRichMessage","messages":[{"_type":"RichMessage","title":"BLR (2016-08-24 18:25) -> NCE (2016-08-24 09:40)","imageUrl":"http://tomcat.www.1aipp.com/sandboxrestservice_chatbot/flight.jpg","buttons":[{"_type":"ButtonMessage","text":"$ 1204.46","url":"https://www.amadeus.net/home/"},{"_type":"ButtonMessage","text":"More Details","url":"https://www.amadeus.net/home/"},{"_type":"ButtonMessage","text":"Book this flight","url":"https://www.amadeus.net/home/"},{"_type":"ButtonMessage","text":"Show similar flights","url":"https://www.amadeus.net/home/"}],"url":"https://www.amadeus.net/home/"},{"_type":"RichMessage","title":"BLR (2016-08-24 18:25) -> NCE (2016-08-24 09:40)","imageUrl":"http://tomcat.www.1aipp.com/sandboxrestservice_chatbot/flight.jpg","buttons":[{"_type":"ButtonMessage","text":"$ 1219.24","url":"https://www.amadeus.net/home/"},{"_type":"ButtonMessage","text":"More Details","url":"https://www.amadeus.net/home/"},{"_type":"ButtonMessage","text":"Book this flight","url":"https://www.amadeus.net/home/"},{"_type":"ButtonMessage","text":"Show similar flights","url":"https://www.amadeus.net/home/"}],"url":"https://www.amadeus.net/home/"},{"_type":"RichMessage","title":"BLR (2016-08-24 17:00) -> NCE (2016-08-24 06:40)","imageUrl":"http://tomcat.www.1aipp.com/sandboxrestservice_chatbot/flight.jpg","buttons":[{"_type":"ButtonMessage","text":"$ 1444.75","url":"https://www.amadeus.net/home/"},{"_type":"ButtonMessage","text":"More Details","url":"https://www.amadeus.net/home/"},{"_type":"ButtonMessage","text":"Book this flight","url":"https://www.amadeus.net/home/"},{"_type":"ButtonMessage","text":"Show similar flights","url":"https://www.amadeus.net/home/"}],"url":"https://www.amadeus.net/home/"}]}]}
+""")
+ROSHAN_RESPONSE = PAGES.static_pages('roshan', [[card] for card in ROSHAN_RESULTS['messages'][1]['messages']],
+                                     intro=ROSHAN_RESULTS['messages'][:1], carousel=True, page_size=2,
+                                     botkit_version=ROSHAN_RESULTS['botkitVersion'])
 
 @APP.route('/roshan', methods=['POST'])
 def for_roshan():
     """Trying to fix the response for Amadeus"""
-    response = r"""
-{"botkitVersion":"0.3.0","messages":[{"_type":"TextMessage","text":"Here are the the top 3 results:"},{"_type":"MultiRichMessage","messages":[{"_type":"RichMessage","title":"BLR (2016-08-24 18:25) -> NCE (2016-08-24 09:40)","imageUrl":"http://tomcat.www.1aipp.com/sandboxrestservice_chatbot/flight.jpg","buttons":[{"_type":"ButtonMessage","text":"$ 1204.46","url":"https://www.amadeus.net/home/"},{"_type":"ButtonMessage","text":"More Details","url":"https://www.amadeus.net/home/"},{"_type":"ButtonMessage","text":"Book this flight","url":"https://www.amadeus.net/home/"},{"_type":"ButtonMessage","text":"Show similar flights","url":"https://www.amadeus.net/home/"}],"url":"https://www.amadeus.net/home/"},{"_type":"RichMessage","title":"BLR (2016-08-24 18:25) -> NCE (2016-08-24 09:40)","imageUrl":"http://tomcat.www.1aipp.com/sandboxrestservice_chatbot/flight.jpg","buttons":[{"_type":"ButtonMessage","text":"$ 1219.24","url":"https://www.amadeus.net/home/"},{"_type":"ButtonMessage","text":"More Details","url":"https://www.amadeus.net/home/"},{"_type":"ButtonMessage","text":"Book this flight","url":"https://www.amadeus.net/home/"},{"_type":"ButtonMessage","text":"Show similar flights","url":"https://www.amadeus.net/home/"}],"url":"https://www.amadeus.net/home/"},{"_type":"RichMessage","title":"BLR (2016-08-24 17:00) -> NCE (2016-08-24 06:40)","imageUrl":"http://tomcat.www.1aipp.com/sandboxrestservice_chatbot/flight.jpg","buttons":[{"_type":"ButtonMessage","text":"$ 1444.75","url":"https://www.amadeus.net/home/"},{"_type":"ButtonMessage","text":"More Details","url":"https://www.amadeus.net/home/"},{"_type":"ButtonMessage","text":"Book this flight","url":"https://www.amadeus.net/home/"},{"_type":"ButtonMessage","text":"Show similar flights","url":"https://www.amadeus.net/home/"}],"url":"https://www.amadeus.net/home/"}]}]}
-"""
-    return jsonify(json.loads(response))
+    return ROSHAN_RESPONSE.serve()
 
 
-@APP.route('/sudhanwa', methods=['POST'])
-def for_sudhanwa():
-    """Trying to fix the response for Amadeus"""
-    response = """
+SUDHANWA_RESULTS = json.loads("""
 {
   "botkitVersion": "0.3.0",
   "messages": [
@@ -437,117 +749,201 @@ def for_sudhanwa():
     }
   ]
 }
-"""
+""")
+SUDHANWA_INTRO, SUDHANWA_GROUPS = split_results(SUDHANWA_RESULTS['messages'])
+SUDHANWA_RESPONSE = PAGES.static_pages('sudhanwa', SUDHANWA_GROUPS, intro=SUDHANWA_INTRO, page_size=1,
+                                       botkit_version=SUDHANWA_RESULTS['botkitVersion'])
 
-    return jsonify(json.loads(response))
+@APP.route('/sudhanwa', methods=['POST'])
+def for_sudhanwa():
+    """Trying to fix the response for Amadeus"""
+    return SUDHANWA_RESPONSE.serve()
+
+
+@WEBHOOKS.handler(SHOW_MORE_WEBHOOK, schema={'cursor': str, 'offset': int})
+def show_more_webhook(webhook_request):
+    """The next page of a result list - the payload of its "Show more" button"""
+    body = webhook_request.body or {}
+    # the payload as is, or the button's postback carrying it
+    payload = body.get('payload') if isinstance(body.get('payload'), dict) else body
+    cursor, offset = payload.get('cursor'), payload.get('offset')
+    messages = PAGES.page(cursor, offset) if isinstance(cursor, str) and isinstance(offset, int) else None
+    if messages is None:
+        return [TextMessage("Sorry, these results are no longer available - please search again")]
+    return messages
+
+@APP.route('/show_more', methods=['POST'])
+def show_more():
+    """The next page of a result list"""
+    return WEBHOOKS.serve(SHOW_MORE_WEBHOOK)
+
+
+BOT_PLEASE_REPLY = "YatraBot Please!"
+GREETING_FLOW = Flow('greeting', BotWebhookTypes.chat_greeting, [
+    Step('ask', questions=[MultiChoiceQuestion(text="Would you like to talk to YatraBot or wait for an agent?",
+                                               name='bot_or_agent', choices=[BOT_PLEASE_REPLY, "Wait for an agent"])],
+         branch=('bot_or_agent', {BOT_PLEASE_REPLY: 'bot'}), then='agent'),
+    Step('bot', say=[TextMessage("bot requested - how may I help?")]),
+    Step('agent', say=[TextMessage("human requested"), HandoffToHumanEvent()]),
+])
+
+@WEBHOOKS.handler(BotWebhookTypes.chat_greeting, schema=GREETING_FLOW.schema())
+def chat_greeting(webhook_request):
+    """Greeting webhook demo implementation"""
+    if not webhook_request.body:
+        return []
+    reply = QUESTIONNAIRES.answer(webhook_request)
+    if reply is not None:
+        return reply
+    if webhook_request.get('bot_or_agent'):
+        # an answer without a flow payload nor a stored state (an older hook, or no user id) - it still picks the step
+        return QUESTIONNAIRES.start('greeting', webhook_request, slots={'bot_or_agent': webhook_request.get(
+            'bot_or_agent')})
+    user = webhook_request.user
+    first_name = user.first_name if user else None
+    hello = TextMessage("Hello there {}!".format(first_name) if first_name else "Hello there!")
+    return QUESTIONNAIRES.start('greeting', webhook_request, intro=[hello])
 
+@APP.route('/greeting', methods=['POST'])
+def greeting():
+    """Greeting webhook demo implementation"""
+    return WEBHOOKS.serve(BotWebhookTypes.chat_greeting)
 
+# where each user is in the questionnaire flows - shared by the workers like the sessions, so any worker can take the
+# next answer
+QUESTIONNAIRES = QuestionnaireEngine([GREETING_FLOW, ROADSIDE_FLOW, CHANGE_BOOKING_FLOW],
+                                     store=session_store_from_env('flows'))
 
+# the first questions of the roadside assistance flow, as they are compiled - a static reply that cannot drift from it
+QUESTIONS_RESPONSE = static_response('questions', BotkitResponse(QUESTIONNAIRES.messages('roadside_assistance')))
 
 @APP.route('/questions', methods=['POST'])
 def questions():
     """Playing with questions"""
-    response = """
-    {
-      "botkitVersion":"0.4.0",
-      "messages":[
-        {
-          "_type":"QuestionnaireEvent",
-          "questionnaireAnsweredHook":{
-            "webhook":"roadside_assistance",
-            "payload":{
-              "more_info_to_attach_to_answers":123
-            }
-          },
-          "questionnaireAbortedHook":{
-            "webhook":"roadside_assistance",
-            "payload":{
-              "validation error?":321
-            }
-          },
-          "questions":[
-            {
-              "_type":"EmailQuestion",
-              "name":"email",
-              "text":"I need to identify you, what is your email?"
-            },
-            {
-              "_type":"MultiChoiceQuestion",
-              "text":"What happened?",
-              "name":"what_happened",
-              "choices":[
-                "Accident",
-                "Mechanical problem",
-                "Other"
-              ]
-            },
-            {
-              "_type":"OpenQuestion",
-              "name":"details",
-              "text":"I need a string that starts with 'a' and is 3 or more letters",
-              "validationRegex":"a.{2}"
-            }
-          ]
-        }
-      ]
-    }
-"""
-    return jsonify(json.loads(response))
+    return QUESTIONS_RESPONSE.serve()
+
+
+MESSAGE_LOG = MessageLog(os.environ.get('WEBHOOKS_MESSAGE_LOG_DIR') or os.path.join(tempfile.gettempdir(), 'webhooks'),
+                         compress=os.environ.get('WEBHOOKS_MESSAGE_LOG_GZIP') == '1')
+EMPTY_RESPONSE = static_response('empty', BotkitResponse([]))
+
+@WEBHOOKS.handler(BotWebhookTypes.message_logger, schema={})
+def message_logger(webhook_request):
+    """Called for every message sent - queue it for the message log and reply right away"""
+    if webhook_request.body:
+        MESSAGE_LOG.append(webhook_request.body)
+    return EMPTY_RESPONSE
+
+@APP.route('/message_logger', methods=['POST'])
+def message_logger_webhook():
+    """Message logger webhook"""
+    return WEBHOOKS.serve(BotWebhookTypes.message_logger)
+
+
+# the search suppliers, location providers & co. - from the WEBHOOKS_PROVIDERS file (stand-ins when running locally)
+PROVIDERS = providers_config()
+SEARCH = SearchService([build(config) for config in PROVIDERS.get('search', [])],
+                       deadline=float(os.environ.get('WEBHOOKS_SEARCH_DEADLINE', 2)))
+SEARCH_WEBHOOKS = {
+    BotWebhookTypes.search_flight: 'flight',
+    BotWebhookTypes.search_hotel: 'hotel',
+    BotWebhookTypes.search_car: 'car',
+    BotWebhookTypes.search_cruise: 'cruise',
+}
 
+def search_webhook(webhook_request):
+    """Search the suppliers, reply with the best offers that arrived before the deadline"""
+    kind = SEARCH_WEBHOOKS[webhook_request.webhook]
+    results, _ = SEARCH.search(kind, webhook_request.body or {})
+    if not results:
+        return [TextMessage("Sorry, I could not find any {} right now".format(kind))]
+    return [TextMessage("Here are the top {} results:".format(len(results)))] + PAGES.paginate(
+        [[result.to_message()] for result in results], carousel=True)
+
+for _webhook, _kind in SEARCH_WEBHOOKS.items():
+    WEBHOOKS.handler(_webhook, schema=SEARCH_FIELDS[_kind])(search_webhook)
 
-@APP.route('/greeting', methods=['POST'])
-def greeting():
-    """Greeting webhook demo implementation"""
-    messages = []
-    body = request.get_json(force=True)
-    first_name = None
-    bot_or_agent_key = "bot_or_agent"
-    bot_please_reply = "YatraBot Please!"
-    if body and isinstance(body, dict):
-        bot_or_agent = body.get(bot_or_agent_key)
-        if bot_or_agent:
-            if bot_or_agent == bot_please_reply:
-                messages.append(dict(_type="TextMessage", text="bot requested - how may I help?"))
-            else:
-                messages.append(dict(_type="TextMessage", text="human requested"))
-                messages.append(dict(_type="HandoffToHumanEvent"))
-        else:
-            user = body.get('user')
-            if user and isinstance(user, dict):
-                first_name = user.get('firstName')
-                if first_name:
-                    messages.append(dict(_type="TextMessage", text="Hello there {}!".format(first_name)))
-            if not first_name:
-                messages.append(dict(_type="TextMessage", text="Hello there!"))
-            messages.append(dict(_type="QuestionnaireEvent",
-                                 questionnaireAnsweredHook=dict(webhook="chat_greeting", payload=dict()),
-                                 questions=[dict(_type="MultiChoiceQuestion",
-                                                 text="Would you like to talk to YatraBot or wait for an agent?",
-                                                 name=bot_or_agent_key,
-                                                 choices=["YatraBot Please!",
-                                                          "Wait for an agent"])]))
-    response = dict(messages=messages, botkitVersion=BOTKIT_API_LATEST_VERSION)
-    return jsonify(response)
 
+# per user and per webhook rate limits, and load shedding - added last so it is the outermost wrapper and a
+# refused call costs next to nothing. message_logger is only queued, and must not lose messages.
+ADMISSION = AdmissionControl(user_rate=float(os.environ.get('WEBHOOKS_USER_RATE', 5)),
+                             user_burst=int(os.environ.get('WEBHOOKS_USER_BURST', 20)),
+                             max_in_flight=int(os.environ.get('WEBHOOKS_MAX_IN_FLIGHT', 64)),
+                             webhook_rates=dict((webhook, (20, 40)) for webhook in SEARCH_WEBHOOKS),
+                             exempt=[BotWebhookTypes.message_logger])
+WEBHOOKS.add_wrapper(ADMISSION.wrapper)
 
 
+PROXY = CachingProxy()
+
 @APP.route('/https_proxy', methods=['GET'])
 def https_proxy():
     """Trying to fix the response for Amadeus"""
     url = request.args.get('url')
     if url:
-        unquoted_url = requests.utils.unquote(url)
-        try:
-            res = requests.get(unquoted_url)
-        except requests.exceptions.RequestException:
-            pass
-        else:
-            response = make_response(res.content)
-            for key, value in res.headers.iteritems():
-                response.headers[key] = value
-            return response
+        return PROXY.serve(unquote(url))
     return "No URL"
 
+def lookup_cache(name, ttl, stale_ttl):
+    """The read-through cache of the `name` provider of PROVIDERS, None if none is configured"""
+    config = PROVIDERS.get(name)
+    return ReadThroughCache(build(config), ttl=ttl, stale_ttl=stale_ttl, name=name) if config else None
+
+# time zones, weather and airport directions - most users ask about the same few places, so these are served from
+# memory and refreshed in the background
+TIMEZONES = lookup_cache('timezone', ttl=24 * 3600, stale_ttl=7 * 24 * 3600)
+WEATHER = lookup_cache('weather', ttl=600, stale_ttl=1800)
+NAVIGATION = lookup_cache('navigation', ttl=3600, stale_ttl=24 * 3600)
+
+def cached_lookup(cache, location):
+    """The value of `location` in `cache`, None if the provider failed (or there is none)"""
+    if cache is None:
+        return None
+    try:
+        return cache.get(normalize_location(location))
+    except Exception: # pylint:disable=broad-except
+        APP.logger.exception("%s lookup of %r failed", cache.name, location)
+        return None
+
+@WEBHOOKS.handler(BotWebhookTypes.ask_time, schema={'location': str})
+def ask_time(webhook_request):
+    """The local time in the `location` of the body"""
+    location = webhook_request.get('location')
+    if not location:
+        return [TextMessage("The time where?")]
+    zone = cached_lookup(TIMEZONES, location)
+    if zone is None:
+        return [TextMessage("Sorry, I don't know the time in {}".format(location))]
+    now = datetime.datetime.now(ZoneInfo(zone))
+    return [TextMessage("It is {} in {} ({})".format(now.strftime('%H:%M'), location.strip().title(),
+                                                     now.strftime('%A')))]
+
+@WEBHOOKS.handler(BotWebhookTypes.ask_weather, schema={'location': str})
+def ask_weather(webhook_request):
+    """The weather in the `location` of the body"""
+    location = webhook_request.get('location')
+    if not location:
+        return [TextMessage("The weather where?")]
+    weather = cached_lookup(WEATHER, location)
+    if weather is None:
+        return [TextMessage("Sorry, I can't get the weather in {} right now".format(location))]
+    conditions, celsius = weather
+    return [TextMessage("{} in {}, {}\u00b0C ({:.0f}\u00b0F)".format(conditions, location.strip().title(), celsius,
+                                                                   celsius * 9 / 5 + 32))]
+
+@WEBHOOKS.handler(BotWebhookTypes.airport_navigation, schema={'airport': str, 'place': str})
+def airport_navigation(webhook_request):
+    """Directions to the `place` of the body, in its `airport` (or the default one)"""
+    place = webhook_request.get('place')
+    if not place:
+        return [TextMessage("Where would you like to go?")]
+    airport = (webhook_request.get('airport') or DEFAULT_AIRPORT).upper()
+    directions = cached_lookup(NAVIGATION, '{} {}'.format(airport, place))
+    if directions is None:
+        return [TextMessage("Sorry, I can't find {} in {} right now".format(place, airport))]
+    return [TextMessage(directions)]
+
+
 AIRPORT_SUGGESTIONS = [
     ("Flight Status:",
      ["My flight status",
@@ -601,20 +997,18 @@ AIRPORT_SUGGESTIONS = [
     ]),
 ]
 
+SUGGESTIONS = SuggestionEngine(AIRPORT_SUGGESTIONS)
+
+@WEBHOOKS.handler(BotWebhookTypes.show_help)
+def show_help(webhook_request):
+    """Capabilities webhook - a few random suggestions of what to ask, new ones for returning users"""
+    user = webhook_request.user
+    return SUGGESTIONS.suggest(user.user_id if user is not None else None)
+
 @APP.route('/capabilities_evature_airports', methods=['POST'])
 def capabilities_evature_airports():
     """Capabilities view function"""
-    messages = [dict(_type="TextMessage", text="I can do many things! Here are a few options:")]
-    categories = sample(AIRPORT_SUGGESTIONS, 3)
-    multi_rich_messages = []
-    for category in categories:
-        buttons = [dict(_type="ButtonMessage", text=text, action=dict(_type="InputTextAction", inputText=text))
-                   for text in sample(category[1], 3)] # pylint:disable=unsubscriptable-object
-        message = dict(_type="RichMessage", title=category[0], buttons=buttons) # pylint:disable=unsubscriptable-object
-        multi_rich_messages.append(message)
-    messages.append(dict(_type="MultiRichMessage", messages=multi_rich_messages))
-    response = dict(botkitVersion=BOTKIT_API_LATEST_VERSION, messages=messages)
-    return jsonify(response)
+    return WEBHOOKS.serve(BotWebhookTypes.show_help)
 
 
 
@@ -0,0 +1,105 @@
+# encoding: utf-8
+'''
+Server side pagination of long result lists.
+
+A result list is a list of groups - the messages of one result (a RichMessage card, or a card
+followed by its itinerary legs). Only the first page goes out; the rest stays here, already
+encoded, behind a cursor, and the page ends with a "Show more" button whose payload
+({"webhook": "show_more", "cursor": ..., "offset": ...}) gets the next page from the
+`show_more` webhook.
+
+    paginate(groups)            dynamic results - kept in the store (LRU + TTL) for `ttl` seconds
+    static_pages(name, groups)  results that never change - kept for good, the first page is a
+                                StaticResponse
+
+Carousel results (one RichMessage per group) are paged as MultiRichMessages, the "Show more"
+card being the last card.
+'''
+from __future__ import unicode_literals, division
+import secrets
+
+from botkit_messages import (BOTKIT_API_LATEST_VERSION, BotkitResponse, ButtonMessage, EncodedMessage, RichMessage,
+                             encode)
+from response_cache import static_response
+from session_store import MemorySessionStore
+
+SHOW_MORE_WEBHOOK = 'show_more'
+
+
+def _is_card(message):
+    if isinstance(message, dict):
+        return message.get('_type') == 'RichMessage'
+    return isinstance(message, RichMessage)
+
+
+def _carousel(fragments):
+    return EncodedMessage('{"_type":"MultiRichMessage","messages":[' + ','.join(fragments) + ']}')
+
+
+def split_results(messages):
+    """(intro, groups) of a flat list of messages - a group starts at each RichMessage"""
+    intro, groups = [], []
+    for message in messages:
+        if _is_card(message):
+            groups.append([message])
+        elif groups:
+            groups[-1].append(message)
+        else:
+            intro.append(message)
+    return intro, groups
+
+
+class Paginator(object):
+    """Pages of result lists, behind cursors"""
+
+    def __init__(self, store=None, page_size=3, ttl=900, webhook=SHOW_MORE_WEBHOOK):
+        self.store = store if store is not None else MemorySessionStore(max_entries=1000)
+        self.page_size = page_size
+        self.ttl = ttl
+        self.webhook = webhook
+        self._static = {}
+
+    def _record(self, groups, carousel, page_size):
+        return dict(groups=[[encode(message) for message in group] for group in groups], carousel=carousel,
+                    page_size=page_size or self.page_size)
+
+    def _page(self, cursor, record, offset):
+        """The messages of the page of `record` starting at group `offset`"""
+        groups = record['groups']
+        end = offset + record['page_size']
+        fragments = [fragment for group in groups[offset:end] for fragment in group]
+        if end < len(groups):
+            left = len(groups) - end
+            more = RichMessage("{} more result{}".format(left, 's' if left > 1 else ''), buttons=[ButtonMessage(
+                "Show more", payload=dict(webhook=self.webhook, cursor=cursor, offset=end))])
+            fragments.append(encode(more))
+        if record['carousel']:
+            return [_carousel(fragments)]
+        return [EncodedMessage(fragment) for fragment in fragments]
+
+    def paginate(self, groups, carousel=False, page_size=None):
+        """The messages of the first page of `groups` - the rest is kept for `ttl` seconds"""
+        page_size = page_size or self.page_size
+        if len(groups) <= page_size:
+            messages = [message for group in groups for message in group]
+            return [_carousel([encode(message) for message in messages])] if carousel else messages
+        cursor = secrets.token_urlsafe(12)
+        record = self._record(groups, carousel, page_size)
+        self.store.set('page:' + cursor, record, self.ttl)
+        return self._page(cursor, record, 0)
+
+    def static_pages(self, name, groups, intro=(), carousel=False, page_size=None,
+                     botkit_version=BOTKIT_API_LATEST_VERSION):
+        """The StaticResponse of the first page of `groups` (after the `intro` messages), registered as `name`"""
+        record = self._static['static:' + name] = self._record(groups, carousel, page_size)
+        return static_response(name, BotkitResponse(list(intro) + self._page('static:' + name, record, 0),
+                                                    botkit_version=botkit_version))
+
+    def page(self, cursor, offset):
+        """The messages of the page of `cursor` starting at `offset`, None if it expired or never existed"""
+        record = self._static.get(cursor)
+        if record is None:
+            record = self.store.get('page:' + cursor)
+        if record is None or not 0 <= offset < len(record['groups']):
+            return None
+        return self._page(cursor, record, offset)
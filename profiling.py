@@ -0,0 +1,167 @@
+# encoding: utf-8
+'''
+On demand sampling profiler of live requests - where does the time of a slow route go.
+
+A profiled request registers its thread; a background sampler thread wakes up every `interval`
+seconds while any request is being profiled, reads the current stack of each registered thread
+(sys._current_frames - the request is never interrupted nor traced) and counts it under the
+request's route. A request is profiled when
+
+    every > 0           it is one of every `every` requests
+    token is set        it carries a `header` with that token (to profile one request on demand)
+
+Stacks are kept in collapsed format, one line per distinct stack with its sample count, ready
+for flamegraph.pl or speedscope:
+
+    /sudhanwa;flask.app:wsgi_app;...;response_cache:serve 42
+
+    GET <rule>           the collapsed stacks (?route=/sudhanwa for one route, ?reset=1 to clear) -
+                         only for callers with the token (header or ?token=), 403 when no token is set
+    dump(path)           write them to a file - done at exit when `dump_path` is set
+
+The profiler is only installed (init_app) when configured, so it costs nothing otherwise.
+'''
+from __future__ import unicode_literals, division
+import atexit
+import hmac
+import itertools
+import logging
+import os
+import sys
+import threading
+import time
+
+from flask import Response, abort, request
+
+LOGGER = logging.getLogger('webhooks.profiling')
+
+PROFILE_HEADER = 'X-Profile'
+OTHER_STACKS = '[other stacks]'
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return '{}:{}'.format(frame.f_globals.get('__name__') or os.path.basename(code.co_filename), code.co_name)
+
+
+def collapse(frame, max_depth=128):
+    """The stack of `frame` as 'outermost;...;innermost'"""
+    names = []
+    while frame is not None and len(names) < max_depth:
+        names.append(_frame_name(frame))
+        frame = frame.f_back
+    names.reverse()
+    return ';'.join(names)
+
+
+class SamplingProfiler(object):
+    """Collapsed stacks per route, sampled from the threads of the profiled requests"""
+
+    def __init__(self, every=0, token=None, header=PROFILE_HEADER, interval=0.005, max_stacks=20000,
+                 dump_path=None):
+        self.every = every
+        self.token = token
+        self.header = header
+        self.interval = interval
+        self.max_stacks = max_stacks
+        self.dump_path = dump_path
+        self._counter = itertools.count(1)
+        # {thread ident: route} of the requests being profiled
+        self._active = {}
+        self._stacks = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self.profiled = 0
+        self.samples = 0
+        if dump_path:
+            atexit.register(self.dump, dump_path)
+
+    def wants(self, headers):
+        """True if the current request should be profiled"""
+        given = headers.get(self.header)
+        if self.token and given and hmac.compare_digest(given.encode('utf-8'), self.token.encode('utf-8')):
+            return True
+        return self.every > 0 and next(self._counter) % self.every == 0
+
+    def start(self, route):
+        """Profile the current thread as serving `route` - until `stop`"""
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+                    self._thread.start()
+        self._active[threading.get_ident()] = route
+        self.profiled += 1
+        self._wakeup.set()
+
+    def stop(self):
+        """The current thread is done with its profiled request"""
+        self._active.pop(threading.get_ident(), None)
+
+    def _run(self):
+        own = threading.get_ident()
+        while True:
+            if not self._active:
+                self._wakeup.clear()
+                # checked again after clearing - a request may have started in between
+                if not self._active:
+                    self._wakeup.wait()
+            time.sleep(self.interval)
+            self._sample(own)
+
+    def _sample(self, own):
+        frames = sys._current_frames() # pylint:disable=protected-access
+        active = list(self._active.items())
+        with self._lock:
+            for ident, route in active:
+                frame = frames.get(ident)
+                if frame is None or ident == own:
+                    continue
+                key = route + ';' + collapse(frame)
+                if key not in self._stacks and len(self._stacks) >= self.max_stacks:
+                    key = route + ';' + OTHER_STACKS
+                self._stacks[key] = self._stacks.get(key, 0) + 1
+                self.samples += 1
+
+    def collapsed(self, route=None):
+        """The stacks (of `route`, or all of them) in collapsed format, heaviest first"""
+        with self._lock:
+            stacks = sorted(self._stacks.items(), key=lambda item: -item[1])
+        prefix = route + ';' if route else ''
+        return ''.join('{} {}\n'.format(stack, count) for stack, count in stacks if stack.startswith(prefix))
+
+    def reset(self):
+        """Forget the stacks sampled so far"""
+        with self._lock:
+            self._stacks.clear()
+
+    def dump(self, path):
+        """Write the collapsed stacks to `path`"""
+        with open(path, 'w') as dump_file:
+            dump_file.write(self.collapsed())
+        LOGGER.info("Wrote %d profiler samples to %s", self.samples, path)
+
+    def _before_request(self):
+        if self.wants(request.headers):
+            self.start(request.url_rule.rule if request.url_rule is not None else 'unmatched')
+
+    def _teardown_request(self, _exc):
+        if self._active:
+            self.stop()
+
+    def profile_view(self):
+        """The admin endpoint"""
+        given = request.headers.get(self.header) or request.args.get('token') or ''
+        if not self.token or not hmac.compare_digest(given.encode('utf-8'), self.token.encode('utf-8')):
+            abort(403)
+        body = self.collapsed(request.args.get('route'))
+        if request.args.get('reset'):
+            self.reset()
+        return Response(body, mimetype='text/plain')
+
+    def init_app(self, app, rule='/admin/profile'):
+        """Profile the sampled requests of `app`, serve the stacks on `rule`"""
+        app.before_request(self._before_request)
+        app.teardown_request(self._teardown_request)
+        app.add_url_rule(rule, 'profile', self.profile_view, methods=['GET'])
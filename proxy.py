@@ -0,0 +1,228 @@
+# encoding: utf-8
+'''
+The HTTPS proxy behind /https_proxy - BotKit fetches (mostly) images through it.
+
+- Upstream connections are pooled and kept alive in one requests.Session.
+- Bodies are streamed to the client chunk by chunk, never fully buffered.
+- Connect/read timeouts, an overall deadline and a maximal body size are enforced.
+- Hop-by-hop headers are not forwarded.
+- The body is asked for uncompressed (Accept-Encoding: identity) - it is forwarded and cached as
+  is, so it must be readable by any client (images are compressed already anyway).
+- Small enough responses are kept in an LRU cache, fresh for their Cache-Control max-age
+  (or Expires), and revalidated with If-None-Match/If-Modified-Since once stale. Responses
+  setting cookies are not - they are for the client that asked, not for the next one.
+
+requests is only imported when the first URL is proxied - it is the heaviest import of the app,
+and webhooks served by a cold Lambda should not pay for it.
+'''
+from __future__ import unicode_literals, division
+import threading
+import time
+from collections import OrderedDict
+from email.utils import parsedate_tz, mktime_tz
+
+from flask import Response, request
+from werkzeug.http import unquote_etag
+
+# the body is forwarded and cached as is, whatever the client accepts - so it is asked for uncompressed
+UPSTREAM_ACCEPT_ENCODING = 'identity'
+
+# RFC 7230 section 6.1 - never forwarded by a proxy
+HOP_BY_HOP_HEADERS = frozenset(['connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization', 'te',
+                                'trailer', 'transfer-encoding', 'upgrade', 'proxy-connection'])
+
+
+class CacheEntry(object):
+    """A cached upstream response"""
+    __slots__ = ('status', 'headers', 'body', 'expires_at', 'etag', 'last_modified')
+
+    def __init__(self, status, headers, body, expires_at, etag, last_modified):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.expires_at = expires_at
+        self.etag = etag
+        self.last_modified = last_modified
+
+    def is_fresh(self, now):
+        """True while it can be served without asking upstream"""
+        return now < self.expires_at
+
+
+class ResponseCache(object):
+    """Thread safe LRU of CacheEntry, bounded by entry count and total body size"""
+
+    def __init__(self, max_entries=256, max_bytes=32 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """The entry of `key` (fresh or not), or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry):
+        """Add or replace `key`, evicting the least recently used entries as needed"""
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= len(old.body)
+            self._entries[key] = entry
+            self._size += len(entry.body)
+            while self._entries and (len(self._entries) > self.max_entries or self._size > self.max_bytes):
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted.body)
+
+    def revalidated(self, entry, expires_at):
+        """Upstream confirmed `entry` (304) - it is fresh again until `expires_at`"""
+        with self._lock:
+            entry.expires_at = expires_at
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def freshness_lifetime(headers, now):
+    """Seconds the response may be served from cache, None if it must not be cached at all"""
+    directives = {}
+    for part in headers.get('Cache-Control', '').split(','):
+        name, _, value = part.strip().partition('=')
+        if name:
+            directives[name.lower()] = value.strip('"')
+    if 'no-store' in directives or 'private' in directives:
+        return None
+    if 'no-cache' in directives:
+        return 0
+    for name in ('s-maxage', 'max-age'):
+        if name in directives:
+            try:
+                return max(0, int(directives[name]))
+            except ValueError:
+                return 0
+    expires = headers.get('Expires')
+    if expires:
+        parsed = parsedate_tz(expires)
+        return max(0, mktime_tz(parsed) - now) if parsed else 0
+    return 0
+
+
+def cache_lifetime(status, headers, now):
+    """Seconds a response can be cached for, None if it is not to be cached"""
+    if status != 200 or 'Set-Cookie' in headers:
+        return None
+    lifetime = freshness_lifetime(headers, now)
+    if lifetime is None or not (lifetime > 0 or 'ETag' in headers or 'Last-Modified' in headers):
+        return None
+    return lifetime
+
+
+class CachingProxy(object):
+    """Streams upstream GET responses to the client, through a small revalidating cache"""
+
+    def __init__(self, connect_timeout=3.05, read_timeout=10, total_timeout=30, max_body_size=10 * 1024 * 1024,
+                 max_cached_body_size=1024 * 1024, chunk_size=64 * 1024, pool_size=20, cache=None):
+        self.timeout = (connect_timeout, read_timeout)
+        self.total_timeout = total_timeout
+        self.max_body_size = max_body_size
+        self.max_cached_body_size = max_cached_body_size
+        self.chunk_size = chunk_size
+        self.pool_size = pool_size
+        self.cache = cache if cache is not None else ResponseCache()
+        self._session = None
+        self._session_lock = threading.Lock()
+        self._request_error = None
+
+    @property
+    def session(self):
+        """The pooled keep-alive session, created on first use"""
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    import requests
+                    from requests.adapters import HTTPAdapter
+                    self._request_error = requests.exceptions.RequestException
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+                    session.mount('http://', adapter)
+                    session.mount('https://', adapter)
+                    self._session = session
+        return self._session
+
+    def serve(self, url):
+        """The Flask response for GET `url`"""
+        if not url.startswith(('http://', 'https://')):
+            return Response("Only http(s) URLs can be proxied", status=400, mimetype='text/plain')
+        now = time.time()
+        entry = self.cache.get(url)
+        if entry is not None and entry.is_fresh(now):
+            return self._from_cache(entry)
+        upstream_headers = {'Accept-Encoding': UPSTREAM_ACCEPT_ENCODING}
+        if entry is not None:
+            if entry.etag:
+                upstream_headers['If-None-Match'] = entry.etag
+            if entry.last_modified:
+                upstream_headers['If-Modified-Since'] = entry.last_modified
+        session = self.session
+        try:
+            res = session.get(url, headers=upstream_headers, stream=True, timeout=self.timeout, allow_redirects=True)
+        except self._request_error:
+            return Response("Upstream request failed", status=502, mimetype='text/plain')
+        if entry is not None and res.status_code == 304:
+            res.close()
+            self.cache.revalidated(entry, now + (freshness_lifetime(res.headers, now) or 0))
+            return self._from_cache(entry)
+        length = res.headers.get('Content-Length')
+        if length and length.isdigit() and int(length) > self.max_body_size:
+            res.close()
+            return Response("Upstream response too large", status=502, mimetype='text/plain')
+        skipped = _skipped_headers(res)
+        headers = [(key, value) for key, value in res.headers.items() if key.lower() not in skipped]
+        lifetime = cache_lifetime(res.status_code, res.headers, now)
+        cache_key = url if lifetime is not None else None
+        return Response(self._stream(res, cache_key, headers, now, lifetime), status=res.status_code, headers=headers,
+                        direct_passthrough=True)
+
+    def _stream(self, res, cache_key, headers, now, lifetime):
+        """Yield the raw upstream body, caching it on the way if it is small enough"""
+        deadline = now + self.total_timeout
+        sent = 0
+        kept = [] if cache_key is not None else None
+        try:
+            # raw chunks - the Content-Encoding/Length headers stay valid since nothing is decoded
+            for chunk in res.raw.stream(self.chunk_size, decode_content=False):
+                sent += len(chunk)
+                if sent > self.max_body_size or time.time() > deadline:
+                    # headers are already out - the best we can do is cut the body short
+                    kept = None
+                    break
+                if kept is not None:
+                    kept.append(chunk)
+                    if sent > self.max_cached_body_size:
+                        kept = None
+                yield chunk
+            else:
+                if kept is not None:
+                    self.cache.put(cache_key, CacheEntry(res.status_code, headers, b''.join(kept), now + lifetime,
+                                                         res.headers.get('ETag'), res.headers.get('Last-Modified')))
+        finally:
+            res.close()
+
+    @staticmethod
+    def _from_cache(entry):
+        if entry.etag and request.if_none_match.contains_weak(unquote_etag(entry.etag)[0]):
+            return Response(status=304, headers=[('ETag', entry.etag)])
+        return Response(entry.body, status=entry.status, headers=entry.headers)
+
+
+def _skipped_headers(res):
+    """Hop-by-hop headers, including the ones named by the upstream Connection header"""
+    connection = res.headers.get('Connection', '')
+    if not connection:
+        return HOP_BY_HOP_HEADERS
+    return HOP_BY_HOP_HEADERS.union(name.strip().lower() for name in connection.split(','))
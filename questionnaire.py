@@ -0,0 +1,241 @@
+# encoding: utf-8
+'''
+Multi-step questionnaire flows, declared once and compiled to transition tables.
+
+A Flow is a list of Steps. Entering a step sends its `say` messages and its questions (a
+QuestionnaireEvent whose hook payload names the flow and the step); the answers come back to
+the flow's webhook, are kept in the conversation's slots, and the answer to the step's `branch`
+question picks the next step (`then` when there is no branch or the answer is not listed).
+A step without questions ends the flow - its `action`, if any, is called with the webhook
+request, its body completed with every answer of the flow. A step whose questions all have an
+answer already (given when the flow was started) is skipped.
+
+Compiling the flows turns step names into indexes, the branches into one dict keyed by
+(flow, step, answer) and the messages of every step into pre-encoded JSON, so an answer costs a
+store lookup, one table lookup and no encoding.
+
+The state of a conversation is a small array - [flow, step, [slot values]] - kept for `ttl`
+seconds per user in a session store (a MemorySessionStore by default; a SqliteSessionStore
+works too). Without a user id there is no state to keep: the step comes from the hook payload,
+and the answers given so far travel in it too (`slots`), to come back with the next answers.
+'''
+from __future__ import unicode_literals, division
+
+from botkit_messages import EncodedMessage, Hook, QuestionnaireEvent
+from dispatcher import WebhookRequest
+from session_store import MemorySessionStore
+
+
+def _answer(value):
+    return value.strip().lower() if isinstance(value, str) else value
+
+
+class Step(object):
+    """One step of a flow - what is said and asked on entering it, and where its answers lead"""
+    __slots__ = ('name', 'questions', 'say', 'branch', 'then', 'action')
+
+    def __init__(self, name, questions=(), say=(), branch=None, then=None, action=None):
+        self.name = name
+        self.questions = list(questions)
+        self.say = list(say)
+        # (question name, {answer: step name})
+        self.branch = branch
+        self.then = then
+        self.action = action
+
+
+class Flow(object):
+    """Named steps, answered through `webhook` - the first step is the start"""
+    __slots__ = ('name', 'webhook', 'steps')
+
+    def __init__(self, name, webhook, steps):
+        self.name = name
+        self.webhook = webhook
+        self.steps = list(steps)
+
+    def schema(self):
+        """The webhook body schema of the answers"""
+        schema = dict((question.name, str) for step in self.steps for question in step.questions)
+        schema['payload'] = dict
+        return schema
+
+
+class QuestionnaireEngine(object):
+    """Runs compiled flows, keeping the state of each conversation in `store`"""
+
+    def __init__(self, flows, store=None, ttl=1800):
+        self.store = store if store is not None else MemorySessionStore()
+        self.ttl = ttl
+        self._flows = list(flows)
+        self._flow_index = dict((flow.name, index) for index, flow in enumerate(self._flows))
+        # per flow: {step name: index}, [slot names], and per step (messages, [(slot, question name)])
+        self._step_index = []
+        self._slot_names = []
+        self._steps = []
+        # {(flow, step, answer): next step}, {(flow, step): (slot of the branch question or None, default next step)}
+        self._table = {}
+        self._defaults = {}
+        for flow_index, flow in enumerate(self._flows):
+            self._compile(flow_index, flow)
+
+    def _compile(self, flow_index, flow):
+        step_index = dict((step.name, index) for index, step in enumerate(flow.steps))
+        slots = []
+        for step in flow.steps:
+            for question in step.questions:
+                if question.name not in slots:
+                    slots.append(question.name)
+
+        def target(name):
+            if name is None:
+                return None
+            if name not in step_index:
+                raise ValueError("Flow {} has no step {!r}".format(flow.name, name))
+            return step_index[name]
+
+        compiled = []
+        for index, step in enumerate(flow.steps):
+            asked = [(slots.index(question.name), question.name) for question in step.questions]
+            compiled.append((self._step_messages(flow, step), asked))
+            branch_slot = None
+            if step.branch is not None:
+                branch_question, answers = step.branch
+                branch_slot = slots.index(branch_question)
+                for answer, name in answers.items():
+                    self._table[(flow_index, index, _answer(answer))] = target(name)
+            self._defaults[(flow_index, index)] = (branch_slot, target(step.then))
+        self._step_index.append(step_index)
+        self._slot_names.append(slots)
+        self._steps.append(compiled)
+
+    @staticmethod
+    def _step_messages(flow, step, slots=None):
+        """The (encoded) messages of entering `step` - the hook payload carries `slots` if given"""
+        messages = [EncodedMessage.of(message) for message in step.say]
+        if step.questions:
+            payload = dict(flow=flow.name, step=step.name)
+            if slots:
+                payload['slots'] = slots
+            messages.append(EncodedMessage.of(QuestionnaireEvent(
+                step.questions, answered_hook=Hook(flow.webhook, payload=payload),
+                aborted_hook=Hook(flow.webhook, payload=dict(payload, aborted=True)))))
+        return messages
+
+    def messages(self, name, step=None):
+        """The messages of entering `step` (the first one by default) of flow `name`, for a new conversation"""
+        flow_index = self._flow_index[name]
+        return list(self._steps[flow_index][self._step_index[flow_index][step] if step is not None else 0][0])
+
+    @staticmethod
+    def _key(webhook_request):
+        user = webhook_request.user
+        return 'flow:{}'.format(user.user_id) if user is not None and user.user_id is not None else None
+
+    def stored(self, webhook_request):
+        """The stored state of the caller's conversation - None without one, or without a user id"""
+        key = self._key(webhook_request)
+        return self.store.get(key) if key is not None else None
+
+    def start(self, name, webhook_request, intro=(), step=None, slots=None):
+        """The messages starting flow `name` (at `step`, with some `slots` already known), after `intro`"""
+        flow_index = self._flow_index[name]
+        state = [name, 0, [None] * len(self._slot_names[flow_index])]
+        names = self._slot_names[flow_index]
+        for slot, value in (slots or {}).items():
+            if slot in names and value is not None:
+                state[2][names.index(slot)] = value
+        step_index = self._step_index[flow_index][step] if step is not None else 0
+        return list(intro) + self._enter(flow_index, step_index, state, webhook_request)
+
+    def _next(self, flow_index, step_index, values):
+        """The step after `step_index`, given the answers so far - one table lookup"""
+        branch_slot, default = self._defaults[(flow_index, step_index)]
+        if branch_slot is None:
+            return default
+        return self._table.get((flow_index, step_index, _answer(values[branch_slot])), default)
+
+    def _enter(self, flow_index, step_index, state, webhook_request):
+        key = self._key(webhook_request)
+        values = state[2]
+        # steps whose questions are all answered already (known up front) are skipped
+        for _ in range(len(self._steps[flow_index])):
+            if step_index is None:
+                break
+            asked = self._steps[flow_index][step_index][1]
+            if not asked or any(values[slot] is None for slot, _ in asked):
+                break
+            step_index = self._next(flow_index, step_index, values)
+        if step_index is None:
+            if key is not None:
+                self.store.delete(key)
+            return []
+        messages, asked = self._steps[flow_index][step_index]
+        if asked:
+            state[1] = step_index
+            if key is not None:
+                self.store.set(key, state, self.ttl)
+                return list(messages)
+            filled = dict((slot, value) for slot, value in zip(self._slot_names[flow_index], values)
+                          if value is not None)
+            if filled:
+                # no session to keep the answers in - they go out with the questions, and come back with their answers
+                flow = self._flows[flow_index]
+                return self._step_messages(flow, flow.steps[step_index], filled)
+            return list(messages)
+        if key is not None:
+            self.store.delete(key)
+        action = self._flows[flow_index].steps[step_index].action
+        if action is None:
+            return list(messages)
+        body = dict(webhook_request.body or {})
+        body.update((slot, value) for slot, value in zip(self._slot_names[flow_index], values) if value is not None)
+        return list(messages) + list(action(WebhookRequest(webhook_request.webhook, body, webhook_request.args,
+                                                           webhook_request.headers)))
+
+    def _state(self, webhook_request):
+        """(flow index, state) of the flow the call answers, (None, None) if it answers none
+
+        That is the flow named by the hook payload, or else the one the user is in - if the call
+        answers its current step.
+        """
+        body = webhook_request.body or {}
+        payload = body.get('payload') if isinstance(body.get('payload'), dict) else {}
+        key = self._key(webhook_request)
+        stored = self.store.get(key) if key is not None else None
+        name = payload.get('flow')
+        if isinstance(name, str) and name in self._flow_index:
+            flow_index = self._flow_index[name]
+            step_index = self._step_index[flow_index].get(payload.get('step'))
+            if step_index is None or self._flows[flow_index].webhook != webhook_request.webhook:
+                return None, None
+            if stored is not None and stored[0] == name:
+                return flow_index, [name, step_index, stored[2]]
+            carried = payload.get('slots') if isinstance(payload.get('slots'), dict) else {}
+            return flow_index, [name, step_index, [carried.get(slot) if isinstance(carried.get(slot), str) else None
+                                                   for slot in self._slot_names[flow_index]]]
+        if stored is not None and stored[0] in self._flow_index:
+            flow_index = self._flow_index[stored[0]]
+            if self._flows[flow_index].webhook == webhook_request.webhook and any(
+                    body.get(question) is not None for _, question in self._steps[flow_index][stored[1]][1]):
+                return flow_index, stored
+        return None, None
+
+    def answer(self, webhook_request):
+        """The messages of the next step of the flow the call answers, None if it answers no flow"""
+        flow_index, state = self._state(webhook_request)
+        if state is None:
+            return None
+        body = webhook_request.body or {}
+        payload = body.get('payload')
+        if isinstance(payload, dict) and payload.get('aborted'):
+            key = self._key(webhook_request)
+            if key is not None:
+                self.store.delete(key)
+            return []
+        step_index = state[1]
+        values = state[2]
+        for slot, question in self._steps[flow_index][step_index][1]:
+            value = body.get(question)
+            if value is not None:
+                values[slot] = value
+        return self._enter(flow_index, self._next(flow_index, step_index, values), state, webhook_request)
@@ -0,0 +1,155 @@
+# encoding: utf-8
+'''
+Decoding and validation of incoming BotKit webhook bodies.
+
+The body is read once, with a size cap, and decoded with orjson when it is installed (the
+standard json module otherwise). It is then checked against the compiled schema of its webhook,
+so a malformed or oversized call is rejected before any handler code runs.
+
+Schemas are plain dicts: {field: spec}, a spec being a type (or tuple of types), a nested schema
+dict, Choice(...) or Required(spec). Fields are optional unless Required, JSON null counts as
+missing, unknown fields are ignored. `compile_schema` turns them into a validating function once.
+'''
+from __future__ import unicode_literals, division
+import json
+
+try:
+    import orjson
+except ImportError: # optional - faster decoding when installed
+    orjson = None
+
+if orjson is not None:
+    loads = orjson.loads # pylint:disable=invalid-name
+    JSON_BACKEND = 'orjson'
+else:
+    loads = json.loads # pylint:disable=invalid-name
+    JSON_BACKEND = 'json'
+
+# BotKit bodies are small - anything bigger than this is rejected without being parsed
+MAX_BODY_SIZE = 256 * 1024
+# bodies of unknown length are read by chunks of this size
+READ_CHUNK_SIZE = 16 * 1024
+
+
+class InvalidWebhookBody(ValueError):
+    """The body of a webhook call is oversized, malformed or does not match its schema"""
+
+    def __init__(self, message, status=400):
+        super(InvalidWebhookBody, self).__init__(message)
+        self.status = status
+
+
+class Required(object):
+    """Schema spec of a field that must be present (and not null)"""
+    __slots__ = ('spec',)
+
+    def __init__(self, spec):
+        self.spec = spec
+
+
+class Choice(object):
+    """Schema spec of a field that must be one of the given values"""
+    __slots__ = ('values',)
+
+    def __init__(self, *values):
+        self.values = frozenset(values)
+
+
+_MISSING = object()
+
+
+def _type_names(types):
+    return '/'.join({dict: 'object', list: 'array', str: 'string', int: 'number', float: 'number',
+                     bool: 'boolean'}.get(cls, cls.__name__) for cls in types)
+
+
+def _compile_spec(spec, path):
+    if isinstance(spec, dict):
+        return compile_schema(spec, path)
+    if isinstance(spec, Choice):
+        values = spec.values
+
+        def check_choice(value):
+            if value not in values:
+                raise InvalidWebhookBody("{} must be one of {}".format(path, ", ".join(sorted(map(repr, values)))))
+        return check_choice
+    types = spec if isinstance(spec, tuple) else (spec,)
+    if object in types:
+        return None
+    names = _type_names(types)
+
+    def check_type(value):
+        if not isinstance(value, types) or (isinstance(value, bool) and bool not in types):
+            raise InvalidWebhookBody("{} must be a {}".format(path, names))
+    return check_type
+
+
+def compile_schema(schema, path='body'):
+    """A function validating a decoded body (or nested object) against `schema`"""
+    checks = []
+    for key, spec in schema.items():
+        required = isinstance(spec, Required)
+        if required:
+            spec = spec.spec
+        checks.append((key, required, _compile_spec(spec, '{}.{}'.format(path, key))))
+    checks = tuple(checks)
+
+    def validate(value):
+        if not isinstance(value, dict):
+            raise InvalidWebhookBody("{} must be an object".format(path))
+        get = value.get
+        for key, required, check in checks:
+            item = get(key, _MISSING)
+            if item is _MISSING or item is None:
+                if required:
+                    raise InvalidWebhookBody("{}.{} is required".format(path, key))
+            elif check is not None:
+                check(item)
+    return validate
+
+
+# Fields BotKit may send to any webhook
+BOTKIT_BODY_SCHEMA = {
+    'user': {'firstName': str, 'lastName': str, 'id': (str, int)},
+    'loginData': object,
+}
+
+
+def webhook_schema(extra=None):
+    """The compiled schema of a webhook - the common BotKit fields plus its own `extra` fields"""
+    schema = dict(BOTKIT_BODY_SCHEMA)
+    if extra:
+        schema.update(extra)
+    return compile_schema(schema)
+
+
+def read_json_body(stream, content_length, max_size=MAX_BODY_SIZE):
+    """Read and decode the body, None when empty - raises InvalidWebhookBody"""
+    if content_length is not None and content_length > max_size:
+        raise InvalidWebhookBody("Body of {} bytes is over the {} bytes limit".format(content_length, max_size), 413)
+    if content_length is not None:
+        # sized to the body - a read of max_size would allocate the whole limit for every call
+        data = stream.read(content_length + 1)
+    else:
+        chunks = []
+        size = 0
+        while size <= max_size:
+            chunk = stream.read(min(READ_CHUNK_SIZE, max_size + 1 - size))
+            if not chunk:
+                break
+            chunks.append(chunk)
+            size += len(chunk)
+        data = b''.join(chunks)
+    if len(data) > max_size:
+        raise InvalidWebhookBody("Body is over the {} bytes limit".format(max_size), 413)
+    return decode_json(data)
+
+
+def decode_json(data):
+    """Decode a JSON document, None when empty - raises InvalidWebhookBody"""
+    if not data or data.isspace():
+        return None
+    try:
+        return loads(data)
+    except ValueError as exc:
+        raise InvalidWebhookBody("Malformed JSON body: {}".format(exc))
@@ -0,0 +1,73 @@
+# encoding: utf-8
+'''
+Pre-serialized replies for the webhooks whose answer never changes.
+
+Each payload is encoded once, at import time, together with its ETag, its Content-Length and
+(when it is big enough to be worth it) compressed copies at the best compression level - gzip,
+and brotli when it is installed. Each encoding is a variant with its own ETag ("<hash>-gzip"),
+as the bytes differ. Serving it is then a matter of picking the right bytes - no
+dict building, no json.loads/jsonify round trip, no compression per request. The compressed
+copies are made on first use, so the (slow) best level brotli does not add to the cold start.
+'''
+from __future__ import unicode_literals, division
+import hashlib
+
+from flask import request, Response
+
+from botkit_messages import encode_bytes
+from compression import COMPRESS_MIN_SIZE, ENCODINGS, best_encoding, compress
+
+
+class StaticResponse(object):
+    """A webhook reply serialized once and served as raw bytes"""
+    __slots__ = ('name', 'body', 'etag', 'compressible', 'compressed', 'mimetype')
+
+    def __init__(self, name, payload, mimetype='application/json', compress_min_size=COMPRESS_MIN_SIZE):
+        self.name = name
+        self.mimetype = mimetype
+        self.body = encode_bytes(payload)
+        self.etag = hashlib.sha1(self.body).hexdigest()[:20]
+        self.compressible = compress_min_size is not None and len(self.body) >= compress_min_size
+        # {encoding: bytes}, filled on first use
+        self.compressed = {}
+
+    def compressed_body(self, encoding):
+        """The body compressed with `encoding` (computed once)"""
+        body = self.compressed.get(encoding)
+        if body is None:
+            body = self.compressed[encoding] = compress(self.body, encoding, best=True)
+        return body
+
+    def serve(self):
+        """Return the Flask response for the current request (a 304 if the client already has it)"""
+        encoding = best_encoding(ENCODINGS) if self.compressible else None
+        etag = '{}-{}'.format(self.etag, encoding) if encoding is not None else self.etag
+        if request.if_none_match.contains_weak(etag):
+            response = Response(status=304)
+            response.headers['ETag'] = '"{}"'.format(etag)
+            if self.compressible:
+                response.headers['Vary'] = 'Accept-Encoding'
+            return response
+        body = self.body
+        if encoding is not None:
+            body = self.compressed_body(encoding)
+        response = Response(body, mimetype=self.mimetype)
+        response.headers['Content-Length'] = str(len(body))
+        response.headers['ETag'] = '"{}"'.format(etag)
+        if self.compressible:
+            response.headers['Vary'] = 'Accept-Encoding'
+            if encoding is not None:
+                response.headers['Content-Encoding'] = encoding
+        return response
+
+
+REGISTRY = {}
+
+
+def static_response(name, payload, **kwargs):
+    """Serialize `payload` once and register it under `name`"""
+    if name in REGISTRY:
+        raise ValueError("Static response {!r} is already registered".format(name))
+    response = StaticResponse(name, payload, **kwargs)
+    REGISTRY[name] = response
+    return response
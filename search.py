@@ -0,0 +1,162 @@
+# encoding: utf-8
+'''
+Flight / hotel / car / cruise search over several suppliers at once.
+
+SearchService sends the query to every supplier adapter that handles its kind in parallel (on a
+thread pool), waits at most `deadline` seconds in total, and answers with whatever results
+arrived in time - a slow or failing supplier costs its own results, never the whole reply.
+
+Results are cached by normalized query (LRU + TTL) - only complete ones, a search some supplier
+did not answer in time is retried on the next call.
+
+The suppliers are configured, not coded - see components.py. StubSupplier answers made up (but
+stable) results after an injected latency, and can be told to fail, for tests and local runs.
+'''
+from __future__ import unicode_literals, division
+import logging
+import random
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from botkit_messages import ButtonMessage, RichMessage
+from session_store import MemorySessionStore
+
+LOGGER = logging.getLogger('webhooks.search')
+
+# The query fields of each kind of search, and their types - also the webhook body schemas
+SEARCH_FIELDS = {
+    'flight': {'origin': str, 'destination': str, 'departure_date': str, 'return_date': str, 'passengers': int},
+    'hotel': {'location': str, 'check_in': str, 'check_out': str, 'guests': int},
+    'car': {'location': str, 'pick_up_date': str, 'drop_off_date': str},
+    'cruise': {'destination': str, 'departure_date': str},
+}
+
+
+def normalize_query(kind, params):
+    """The cache key of a search - its kind and the (stripped, case folded) values of its fields"""
+    if kind not in SEARCH_FIELDS:
+        raise ValueError("Unknown search kind {!r}".format(kind))
+    values = []
+    for field in sorted(SEARCH_FIELDS[kind]):
+        value = params.get(field)
+        if isinstance(value, str):
+            value = value.strip().upper() or None
+        values.append(value)
+    return (kind,) + tuple(values)
+
+
+class SearchResult(object):
+    """One offer of a supplier"""
+    __slots__ = ('supplier', 'title', 'price', 'currency', 'subtitle', 'url', 'image_url')
+
+    def __init__(self, supplier, title, price, currency='USD', subtitle=None, url=None, image_url=None):
+        self.supplier = supplier
+        self.title = title
+        self.price = price
+        self.currency = currency
+        self.subtitle = subtitle
+        self.url = url
+        self.image_url = image_url
+
+    def to_message(self):
+        """The RichMessage card of the result"""
+        price = "{} {:.2f}".format(self.currency, self.price)
+        buttons = [ButtonMessage(price, url=self.url)] if self.url else []
+        return RichMessage(self.title, image_url=self.image_url, subtitle=self.subtitle or price, url=self.url,
+                           buttons=buttons)
+
+
+class Supplier(object):
+    """A supplier adapter - subclasses implement `search`"""
+    name = None
+    kinds = ()
+
+    def search(self, kind, params):
+        """[SearchResult] for the query - may raise, may be slow"""
+        raise NotImplementedError
+
+
+class StubSupplier(Supplier):
+    """Made up results after `latency` seconds, failing `failure_rate` of the time"""
+    images = {
+        'flight': 'http://tomcat.www.1aipp.com/sandboxrestservice_chatbot/flight.jpg',
+        'hotel': 'https://www.travelexinsurance.com/images/default-album/mainimg_flightinsurance.jpg',
+    }
+
+    def __init__(self, name, kinds, latency=0.0, failure_rate=0.0, results=3, url='https://www.amadeus.net/home/'):
+        self.name = name
+        self.kinds = tuple(kinds)
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.results = results
+        self.url = url
+
+    def search(self, kind, params):
+        if self.latency:
+            time.sleep(self.latency)
+        if self.failure_rate and random.random() < self.failure_rate:
+            raise IOError("{} is unavailable".format(self.name))
+        key = normalize_query(kind, params)
+        # the same query always gets the same offers
+        rng = random.Random(zlib.crc32(repr((self.name,) + key).encode('utf-8')))
+        if kind == 'flight':
+            what = "{} -> {}".format(params.get('origin') or 'Anywhere', params.get('destination') or 'Anywhere')
+        elif kind == 'cruise':
+            what = "Cruise to {}".format(params.get('destination') or 'the Caribbean')
+        else:
+            what = "{} in {}".format(kind.capitalize(), params.get('location') or 'town')
+        return [SearchResult(self.name, "{} - option {}".format(what, index + 1), round(rng.uniform(80, 1500), 2),
+                             subtitle="by {}".format(self.name), url=self.url, image_url=self.images.get(kind))
+                for index in range(self.results)]
+
+
+class SearchService(object):
+    """Parallel search over `suppliers` with a global deadline and a result cache"""
+
+    def __init__(self, suppliers, deadline=2.0, max_workers=16, max_results=10, cache_ttl=300, cache_size=1024):
+        self.suppliers = list(suppliers)
+        self.deadline = deadline
+        self.max_workers = max_workers
+        self.max_results = max_results
+        self.cache_ttl = cache_ttl
+        self.cache = MemorySessionStore(max_entries=cache_size)
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+    @property
+    def executor(self):
+        """The thread pool, created on first use"""
+        if self._executor is None:
+            with self._executor_lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix='search')
+        return self._executor
+
+    def search(self, kind, params):
+        """(results sorted by price, True if every supplier answered in time)"""
+        key = normalize_query(kind, params)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached, True
+        suppliers = [supplier for supplier in self.suppliers if kind in supplier.kinds]
+        futures = dict((self.executor.submit(supplier.search, kind, params), supplier) for supplier in suppliers)
+        done, not_done = wait(futures, timeout=self.deadline)
+        results = []
+        complete = not not_done
+        for future in done:
+            try:
+                results.extend(future.result())
+            except Exception: # pylint:disable=broad-except
+                LOGGER.exception("Supplier %s failed", futures[future].name)
+                complete = False
+        for future in not_done:
+            # not started yet: never run it - started: its result is ignored
+            future.cancel()
+            LOGGER.warning("Supplier %s missed the %.1fs deadline", futures[future].name, self.deadline)
+        results.sort(key=lambda result: result.price)
+        results = results[:self.max_results]
+        if complete:
+            self.cache.set(key, results, self.cache_ttl)
+        return results, complete
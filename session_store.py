@@ -0,0 +1,251 @@
+# encoding: utf-8
+'''
+Server side login state: the authorization codes handed out by /dl and the login data of users
+who completed the login flow.
+
+Two stores with the same interface (set/get/pop/delete, every entry with its own TTL):
+
+    MemorySessionStore   in process LRU - the default, fine for a single worker
+    SqliteSessionStore   a SQLite file shared by all the workers of a host, see session_store_from_env
+
+SessionManager issues and redeems the one-time authorization codes, and keeps the login data of
+each session (keyed by a token handed to BotKit in the loginData) and of each BotKit user id, so
+gated webhooks resolve a login with a single lookup. A loginData that does not name a code or a
+session issued here counts for nothing.
+'''
+from __future__ import unicode_literals, division
+import json
+import os
+import re
+import secrets
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+_TABLE_NAME = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+# DELETE ... RETURNING needs SQLite 3.35 - older libraries pop in a transaction
+_HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+
+class MemorySessionStore(object):
+    """In process LRU of (value, expiry) - entries are dropped when they expire or are least recently used"""
+
+    def __init__(self, max_entries=10000, clock=time.time):
+        self.max_entries = max_entries
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def set(self, key, value, ttl):
+        """Store `value` under `key` for `ttl` seconds"""
+        with self._lock:
+            self._entries[key] = (value, self._clock() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get(self, key, default=None):
+        """The value of `key`, `default` if missing or expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            if entry[1] <= self._clock():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def pop(self, key, default=None):
+        """Remove `key` and return its value - atomic, so a one-time code is only ever redeemed once"""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        if entry is None or entry[1] <= self._clock():
+            return default
+        return entry[0]
+
+    def delete(self, key):
+        """Forget `key`"""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def purge(self):
+        """Drop the expired entries, return how many"""
+        now = self._clock()
+        with self._lock:
+            expired = [key for key, (_, expires_at) in self._entries.items() if expires_at <= now]
+            for key in expired:
+                del self._entries[key]
+        return len(expired)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SqliteSessionStore(object):
+    """Entries in a table of a SQLite file (JSON values), shared by every process using the same path
+
+    Expired rows are purged once every `purge_every` writes - and the rows closest to expiring
+    too, if there are more than `max_entries`.
+    """
+    purge_every = 500
+
+    def __init__(self, path, table='sessions', max_entries=None, clock=time.time):
+        if not _TABLE_NAME.match(table):
+            raise ValueError("Invalid table name {!r}".format(table))
+        self.path = path
+        self.table = table
+        self.max_entries = max_entries
+        self._clock = clock
+        self._local = threading.local()
+        self._writes = 0
+        self._writes_lock = threading.Lock()
+        with self._connection() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS {} '
+                               '(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)'.format(table))
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            # WAL: readers never block the writer, and the other way around
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    def set(self, key, value, ttl):
+        """Store `value` under `key` for `ttl` seconds"""
+        self._connection().execute('INSERT OR REPLACE INTO {} (key, value, expires_at) VALUES (?, ?, ?)'.format(
+            self.table), (key, json.dumps(value), self._clock() + ttl))
+        with self._writes_lock:
+            self._writes += 1
+            purge = self._writes % self.purge_every == 0
+        if purge:
+            self.purge()
+
+    def get(self, key, default=None):
+        """The value of `key`, `default` if missing or expired"""
+        row = self._connection().execute('SELECT value FROM {} WHERE key = ? AND expires_at > ?'.format(self.table),
+                                         (key, self._clock())).fetchone()
+        return json.loads(row[0]) if row is not None else default
+
+    def pop(self, key, default=None):
+        """Remove `key` and return its value - atomic across processes"""
+        connection = self._connection()
+        if _HAS_RETURNING:
+            row = connection.execute('DELETE FROM {} WHERE key = ? RETURNING value, expires_at'.format(self.table),
+                                     (key,)).fetchone()
+        else:
+            # the write lock is taken up front, so no other process can pop the same row in between
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                row = connection.execute('SELECT value, expires_at FROM {} WHERE key = ?'.format(self.table),
+                                         (key,)).fetchone()
+                if row is not None:
+                    connection.execute('DELETE FROM {} WHERE key = ?'.format(self.table), (key,))
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+            connection.execute('COMMIT')
+        if row is None or row[1] <= self._clock():
+            return default
+        return json.loads(row[0])
+
+    def delete(self, key):
+        """Forget `key`"""
+        self._connection().execute('DELETE FROM {} WHERE key = ?'.format(self.table), (key,))
+
+    def purge(self):
+        """Drop the expired entries (and the extra ones over `max_entries`), return how many"""
+        connection = self._connection()
+        purged = connection.execute('DELETE FROM {} WHERE expires_at <= ?'.format(self.table),
+                                    (self._clock(),)).rowcount
+        if self.max_entries is not None:
+            purged += connection.execute('DELETE FROM {0} WHERE key IN (SELECT key FROM {0} ORDER BY expires_at DESC '
+                                         'LIMIT -1 OFFSET ?)'.format(self.table), (self.max_entries,)).rowcount
+        return purged
+
+    def __len__(self):
+        return self._connection().execute('SELECT COUNT(*) FROM {}'.format(self.table)).fetchone()[0]
+
+
+def session_store_from_env(table='sessions', max_entries=10000):
+    """SqliteSessionStore (of `table`) on $WEBHOOKS_SESSION_DB when it is set, MemorySessionStore otherwise
+
+    Each kind of state gets its own store, so one of them filling up never evicts another.
+    """
+    path = os.environ.get('WEBHOOKS_SESSION_DB')
+    if path:
+        return SqliteSessionStore(path, table, max_entries)
+    return MemorySessionStore(max_entries)
+
+
+class SessionManager(object):
+    """Authorization codes, sessions and per user login data, on top of a session store"""
+    _CODE = 'code:'
+    _SESSION = 'session:'
+    _LOGIN = 'login:'
+
+    def __init__(self, store=None, code_ttl=300, login_ttl=3600):
+        self.store = store if store is not None else MemorySessionStore()
+        self.code_ttl = code_ttl
+        self.login_ttl = login_ttl
+
+    def issue_code(self, login_data):
+        """A new one-time authorization code standing for `login_data`"""
+        code = secrets.token_urlsafe(16)
+        self.store.set(self._CODE + code, login_data, self.code_ttl)
+        return code
+
+    def redeem_code(self, code):
+        """The login data of `code` - None if unknown, expired or already redeemed"""
+        return self.store.pop(self._CODE + code)
+
+    def open_session(self, login_data, user_id=None):
+        """The loginData to hand to BotKit for `login_data` - it carries the token of a new session"""
+        token = secrets.token_urlsafe(16)
+        self.store.set(self._SESSION + token, login_data, self.login_ttl)
+        if user_id is not None:
+            self.remember_login(user_id, login_data)
+        return dict(login_data, session=token)
+
+    def remember_login(self, user_id, login_data):
+        """Cache the login data of a user"""
+        self.store.set(self._LOGIN + str(user_id), login_data, self.login_ttl)
+
+    def forget_login(self, user_id):
+        """Log the user out"""
+        self.store.delete(self._LOGIN + str(user_id))
+
+    def login_data(self, webhook_request):
+        """The login data of the caller, or None if not logged in
+
+        Only what was stored here counts: the login of a code issued by /dl (redeemed on first
+        use, its session then lasts `login_ttl` - BotKit keeps sending the same code), of a
+        session opened by `open_session`, or of the BotKit user id. The other loginData fields
+        are ignored.
+        """
+        user = webhook_request.user
+        user_id = user.user_id if user is not None else None
+        login_data = webhook_request.login_data
+        found = None
+        if isinstance(login_data, dict):
+            code = login_data.get('authorization_code')
+            token = login_data.get('session')
+            if code is not None:
+                found = self.redeem_code(str(code))
+                if found is not None:
+                    self.store.set(self._SESSION + str(code), found, self.login_ttl)
+                else:
+                    found = self.store.get(self._SESSION + str(code))
+            elif token is not None:
+                found = self.store.get(self._SESSION + str(token))
+        if user_id is None:
+            return found
+        # a read, and a write only the first time a code or session is used by this user
+        remembered = self.store.get(self._LOGIN + str(user_id))
+        if found is not None and found != remembered:
+            self.remember_login(user_id, found)
+        return found if found is not None else remembered
@@ -0,0 +1,127 @@
+# encoding: utf-8
+'''
+Capability suggestions - the "here are a few things you can ask" reply.
+
+Every button, card header and the intro text are encoded to JSON once, when the engine is built;
+a reply only picks the suggestions and joins the precomputed fragments.
+
+Categories and suggestions may carry weights (more likely to be picked), and a user is not shown
+a suggestion again until they have seen all the others of its category. What each user has seen
+is one integer bitmask, kept for the `max_users` most recent users only.
+'''
+from __future__ import unicode_literals, division
+import heapq
+import random
+import threading
+from collections import OrderedDict
+
+from botkit_messages import (ButtonMessage, EncodedMessage, InputTextAction, MultiRichMessage, RichMessage,
+                             TextMessage, encode)
+
+_PLACEHOLDER = ButtonMessage('placeholder', payload='placeholder')
+
+
+def _split_around(message, placeholder):
+    """The JSON of `message` before and after the JSON of `placeholder`"""
+    text = encode(message)
+    head, tail = text.split(encode(placeholder))
+    return head, tail
+
+
+def _weighted(item):
+    """(value, weight) of a `value` or `(value, weight)` item"""
+    if isinstance(item, (tuple, list)) and len(item) == 2 and isinstance(item[1], (int, float)):
+        return item[0], item[1]
+    return item, 1
+
+
+class _Category(object):
+    __slots__ = ('head', 'tail', 'ids', 'weights', 'mask')
+
+    def __init__(self, head, tail, ids, weights):
+        self.head = head
+        self.tail = tail
+        self.ids = ids
+        self.weights = weights
+        self.mask = sum(1 << index for index in ids)
+
+
+class SuggestionEngine(object):
+    """Picks suggestions from `categories` and builds the reply from pre-encoded fragments
+
+    `categories` - [(title, [text, ...])] - a category may be (title, texts, weight) and a text
+    (text, weight). A weight of 2 makes it twice as likely to be picked.
+    """
+
+    def __init__(self, categories, intro="I can do many things! Here are a few options:", categories_per_reply=3,
+                 suggestions_per_category=3, max_users=10000, rng=None):
+        self.categories_per_reply = categories_per_reply
+        self.suggestions_per_category = suggestions_per_category
+        self.max_users = max_users
+        self._rng = rng if rng is not None else random.Random()
+        self._intro = EncodedMessage.of(TextMessage(intro))
+        self._buttons = []
+        self._categories = []
+        self._category_weights = []
+        for category in categories:
+            title, texts = category[:2]
+            self._category_weights.append(category[2] if len(category) > 2 else 1)
+            ids = []
+            weights = []
+            for item in texts:
+                text, weight = _weighted(item)
+                ids.append(len(self._buttons))
+                weights.append(weight)
+                self._buttons.append(encode(ButtonMessage(text, action=InputTextAction(text))))
+            head, tail = _split_around(RichMessage(title, buttons=[_PLACEHOLDER]), _PLACEHOLDER)
+            self._categories.append(_Category(head, tail, tuple(ids), tuple(weights)))
+        self._carousel_head, self._carousel_tail = _split_around(
+            MultiRichMessage([RichMessage('placeholder', buttons=[_PLACEHOLDER])]),
+            RichMessage('placeholder', buttons=[_PLACEHOLDER]))
+        self._seen = OrderedDict()
+        self._seen_lock = threading.Lock()
+
+    def _pick(self, items, weights, count):
+        """`count` distinct items, weighted (Efraimidis-Spirakis when the weights differ)"""
+        if count >= len(items):
+            return list(items)
+        if len(set(weights)) == 1:
+            return self._rng.sample(items, count)
+        rand = self._rng.random
+        keyed = [(rand() ** (1 / weight), index) for index, weight in enumerate(weights)]
+        return [items[index] for _, index in heapq.nlargest(count, keyed)]
+
+    def _pick_suggestions(self, category, seen):
+        """Ids of the buttons to show from `category`, not in `seen` if possible, and the updated `seen`"""
+        count = min(self.suggestions_per_category, len(category.ids))
+        fresh = [index for index, suggestion in enumerate(category.ids) if not seen >> suggestion & 1]
+        if len(fresh) < count:
+            # seen (nearly) all of them - start over for this category, the fresh ones first
+            seen &= ~category.mask
+            rest = [index for index in range(len(category.ids)) if index not in fresh]
+            picked = fresh + self._pick(rest, [category.weights[index] for index in rest], count - len(fresh))
+        else:
+            picked = self._pick(fresh, [category.weights[index] for index in fresh], count)
+        ids = [category.ids[index] for index in picked]
+        for suggestion in ids:
+            seen |= 1 << suggestion
+        return ids, seen
+
+    def suggest(self, user_id=None):
+        """The reply messages - for `user_id` (if known) without repeating what they saw already"""
+        categories = self._pick(self._categories, self._category_weights, self.categories_per_reply)
+        seen = 0
+        if user_id is not None:
+            with self._seen_lock:
+                seen = self._seen.get(user_id, 0)
+        cards = []
+        for category in categories:
+            ids, seen = self._pick_suggestions(category, seen)
+            cards.append(category.head + ','.join(self._buttons[suggestion] for suggestion in ids) + category.tail)
+        if user_id is not None:
+            with self._seen_lock:
+                self._seen[user_id] = seen
+                self._seen.move_to_end(user_id)
+                while len(self._seen) > self.max_users:
+                    self._seen.popitem(last=False)
+        return [self._intro, EncodedMessage(self._carousel_head + ','.join(cards) + self._carousel_tail)]
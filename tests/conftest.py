@@ -0,0 +1,8 @@
+# encoding: utf-8
+'''
+The modules of the app live at the root of the repository, next to my_app.py.
+'''
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,57 @@
+# encoding: utf-8
+'''
+TrafficCapture - the app reads the body it was sent, and what is recorded is redacted.
+'''
+from __future__ import unicode_literals, division
+import io
+import json
+
+from capture import REDACTED, TrafficCapture
+
+LOGIN_BODY = {'user': {'id': '42'}, 'loginData': {'authorization_code': 'c0de', 'session': 's3ss'},
+              'answers': [{'email': 'tal@example.com', 'pnr': 'CG4X7U'}]}
+
+
+class App(object):
+    """Reads the whole body - keeps what it read"""
+
+    def __init__(self):
+        self.bodies = []
+
+    def __call__(self, environ, start_response):
+        self.bodies.append(environ['wsgi.input'].read())
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return [b'ok']
+
+
+def capture_call(capture, body, chunked=False, query=''):
+    environ = {'REQUEST_METHOD': 'POST', 'PATH_INFO': '/webhook', 'QUERY_STRING': query,
+               'CONTENT_TYPE': 'application/json', 'wsgi.input': io.BytesIO(body)}
+    if chunked:
+        environ.update({'HTTP_TRANSFER_ENCODING': 'chunked', 'wsgi.input_terminated': True})
+    else:
+        environ['CONTENT_LENGTH'] = str(len(body))
+    response = capture(environ, lambda status, headers, exc_info=None: None)
+    list(response)
+    response.close()
+    return capture.sink[-1]
+
+
+def test_chunked_bodies_reach_the_app():
+    app = App()
+    capture = TrafficCapture(app, [], max_body_size=16)
+    small, large = b'{"a":1}', json.dumps(LOGIN_BODY).encode('utf-8')
+    assert capture_call(capture, small, chunked=True)['body'] == '{"a":1}'
+    record = capture_call(capture, large, chunked=True)
+    assert record['truncated'] and 'body' not in record
+    assert app.bodies == [small, large]
+
+
+def test_json_fields_and_query_parameters_are_redacted():
+    capture = TrafficCapture(App(), [])
+    record = capture_call(capture, json.dumps(LOGIN_BODY).encode('utf-8'),
+                          query='redirect_uri=https%3A%2F%2Fexample.com&account_linking_token=t0ken')
+    body = json.loads(record['body'])
+    assert body['loginData'] == {'authorization_code': REDACTED, 'session': REDACTED}
+    assert body['answers'] == [{'email': REDACTED, 'pnr': REDACTED}] and body['user'] == {'id': '42'}
+    assert 't0ken' not in record['query'] and 'example.com' in record['query']
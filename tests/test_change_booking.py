@@ -0,0 +1,51 @@
+# encoding: utf-8
+'''
+The change_booking flow through /webhook - each conversation changes the booking it was about,
+even when its answers look the same as the ones of an earlier conversation.
+'''
+from __future__ import unicode_literals, division
+import json
+
+import pytest
+
+import my_app
+
+USER = {'id': 'test-change-booking', 'firstName': 'Tal', 'lastName': 'Weiss'}
+
+
+@pytest.fixture
+def client():
+    return my_app.APP.test_client()
+
+
+def call(client, body):
+    response = client.post('/webhook?webhook=change_booking', data=json.dumps(body),
+                           content_type='application/json')
+    assert response.status_code == 200
+    return response.get_json()
+
+
+def hook_payload(reply):
+    """The payload the answers of the questions in `reply` come back with"""
+    event, = [message for message in reply['messages'] if message['_type'] == 'QuestionnaireEvent']
+    return event['questionnaireAnsweredHook']['payload']
+
+
+def change(client, pnr, flight_number, date, user=USER):
+    reply = call(client, {'user': user})
+    reply = call(client, {'user': user, 'payload': hook_payload(reply), 'pnr': pnr})
+    reply = call(client, {'user': user, 'payload': hook_payload(reply), 'flight_number': flight_number,
+                          'date': date})
+    reply = call(client, {'user': user, 'payload': hook_payload(reply), 'confirm': "Yes"})
+    return [message['text'] for message in reply['messages']]
+
+
+@pytest.mark.parametrize('user', [USER, None])
+def test_two_flows_in_a_row_each_change_the_booking(client, user):
+    today = my_app.FLIGHTS.flight('BA117').departure_time.date().isoformat()
+    first = change(client, 'CG4X7U', 'BA117', today, user)
+    assert first[0].startswith("Booking CG4X7U is now on flight BA117")
+    assert my_app.FLIGHTS.booking('CG4X7U').flight_number == 'BA117'
+    second = change(client, 'CG4X7U', 'AF1781', today, user)
+    assert second[0].startswith("Booking CG4X7U is now on flight AF1781")
+    assert my_app.FLIGHTS.booking('CG4X7U').flight_number == 'AF1781'
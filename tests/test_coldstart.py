@@ -0,0 +1,24 @@
+# encoding: utf-8
+'''
+Cold start of `import my_app` - no heavy module on the import path, and (with
+WEBHOOKS_CHECK_IMPORTTIME=1 - a wall clock measure, for a quiet machine) the same budget check
+as `python coldstart.py importtime`.
+'''
+from __future__ import unicode_literals, division
+import os
+
+import pytest
+
+import coldstart
+
+
+@pytest.mark.skipif(not os.environ.get('WEBHOOKS_CHECK_IMPORTTIME'), reason="set WEBHOOKS_CHECK_IMPORTTIME=1 to run")
+def test_importtime_within_budget(capsys):
+    status = coldstart.importtime(coldstart.DEFAULT_BUDGET_MS, top=0, repeat=3)
+    assert status == 0, capsys.readouterr().out
+
+
+def test_lazy_modules_stay_off_the_import_path():
+    imported = set(name for name, _, _, _ in coldstart.measure_import())
+    assert 'my_app' in imported
+    assert imported.isdisjoint(coldstart.LAZY_MODULES), sorted(imported.intersection(coldstart.LAZY_MODULES))
@@ -0,0 +1,45 @@
+# encoding: utf-8
+'''
+IdempotencyLayer - replays of the same call, and calls that only look the same.
+'''
+from __future__ import unicode_literals, division
+
+from dispatcher import WebhookRequest
+from idempotency import REPLAY_HEADER, IdempotencyLayer
+
+
+class Handler(object):
+    """Answers its call number - counts its calls"""
+
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, webhook_request):
+        self.calls += 1
+        return {'call': self.calls}
+
+
+def test_the_same_call_is_replayed():
+    handler, layer = Handler(), IdempotencyLayer(['cancel'])
+    first = layer.wrapper(handler, WebhookRequest('cancel', {'pnr': 'CG4X7U'}))
+    again = layer.wrapper(handler, WebhookRequest('cancel', {'pnr': 'CG4X7U'}))
+    assert handler.calls == 1 and again.get_data() == first.get_data()
+    assert again.headers[REPLAY_HEADER] == 'true' and layer.replays == 1
+
+
+def test_the_same_body_in_another_state_is_run_again():
+    logins = {'alice': 'CG4X7U', 'bob': 'ZX81AB'}
+    state = {'user': 'alice'}
+    handler = Handler()
+    layer = IdempotencyLayer(['cancel'], state=lambda webhook_request: logins[state['user']])
+    layer.wrapper(handler, WebhookRequest('cancel', {}))
+    state['user'] = 'bob'
+    layer.wrapper(handler, WebhookRequest('cancel', {}))
+    assert handler.calls == 2 and layer.replays == 0
+
+
+def test_other_webhooks_are_not_kept():
+    handler, layer = Handler(), IdempotencyLayer(['cancel'])
+    layer.wrapper(handler, WebhookRequest('identify_user', {'pnr': 'CG4X7U'}))
+    layer.wrapper(handler, WebhookRequest('identify_user', {'pnr': 'CG4X7U'}))
+    assert handler.calls == 2 and len(layer.store) == 0
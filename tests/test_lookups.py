@@ -0,0 +1,142 @@
+# encoding: utf-8
+'''
+ReadThroughCache - fresh, stale and expired entries, failed refreshes, single-flight misses and
+LRU eviction - driven by an injected clock and an in-process provider.
+'''
+from __future__ import unicode_literals, division
+import threading
+import time
+
+import pytest
+
+import components
+from lookups import ReadThroughCache, StubTimezoneProvider, normalize_location
+
+
+class Clock(object):
+    """A clock that only moves when told to"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class Provider(object):
+    """Answers '<key>#<call number>', or raises `error` when set - records its calls"""
+
+    def __init__(self):
+        self.calls = []
+        self.error = None
+        self.gate = None
+
+    def __call__(self, key):
+        self.calls.append(key)
+        if self.gate is not None:
+            self.gate.wait(5)
+        if self.error is not None:
+            raise self.error
+        return '{}#{}'.format(key, len(self.calls))
+
+
+def settle(cache, counter, value=1, timeout=5):
+    """Wait for the background refresh - until the `counter` stat reaches `value`"""
+    deadline = time.monotonic() + timeout
+    while cache.stats()[counter] < value and time.monotonic() < deadline:
+        time.sleep(0.001)
+
+
+def test_fresh_entries_are_served_from_memory():
+    clock, provider = Clock(), Provider()
+    cache = ReadThroughCache(provider, ttl=10, stale_ttl=20, clock=clock)
+    assert cache.get('rome') == 'rome#1'
+    clock.now += 9
+    assert cache.get('rome') == 'rome#1'
+    assert provider.calls == ['rome']
+    assert cache.stats()['hits'] == 1 and cache.stats()['misses'] == 1
+
+
+def test_stale_entries_are_served_and_refreshed_in_the_background():
+    clock, provider = Clock(), Provider()
+    cache = ReadThroughCache(provider, ttl=10, stale_ttl=20, clock=clock)
+    cache.get('paris')
+    clock.now += 15
+    assert cache.get('paris') == 'paris#1'
+    settle(cache, 'refreshes')
+    assert cache.get('paris') == 'paris#2'
+    assert cache.stats()['stale_hits'] == 1 and cache.stats()['refreshes'] == 1
+
+
+def test_expired_entries_are_fetched_again():
+    clock, provider = Clock(), Provider()
+    cache = ReadThroughCache(provider, ttl=10, stale_ttl=20, clock=clock)
+    cache.get('tokyo')
+    clock.now += 31
+    assert cache.get('tokyo') == 'tokyo#2'
+    assert cache.stats()['misses'] == 2
+
+
+def test_a_failed_refresh_keeps_the_stale_value():
+    clock, provider = Clock(), Provider()
+    cache = ReadThroughCache(provider, ttl=10, stale_ttl=20, clock=clock)
+    cache.get('nice')
+    clock.now += 15
+    provider.error = IOError("down")
+    assert cache.get('nice') == 'nice#1'
+    settle(cache, 'errors')
+    assert cache.stats()['errors'] == 1
+    # still served, and refreshed again by the next call
+    provider.error = None
+    assert cache.get('nice') == 'nice#1'
+    settle(cache, 'refreshes')
+    assert cache.get('nice') == 'nice#3'
+
+
+def test_a_failed_miss_raises_and_is_not_cached():
+    provider = Provider()
+    provider.error = IOError("down")
+    cache = ReadThroughCache(provider, clock=Clock())
+    with pytest.raises(IOError):
+        cache.get('oslo')
+    provider.error = None
+    assert cache.get('oslo') == 'oslo#2'
+
+
+def test_concurrent_misses_share_one_fetch():
+    provider = Provider()
+    provider.gate = threading.Event()
+    cache = ReadThroughCache(provider, clock=Clock())
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get('london'))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.1)
+    provider.gate.set()
+    for thread in threads:
+        thread.join(5)
+    assert results == ['london#1'] * 8
+    assert provider.calls == ['london']
+
+
+def test_least_recently_used_entries_are_evicted():
+    provider = Provider()
+    cache = ReadThroughCache(provider, max_entries=2, clock=Clock())
+    cache.get('a')
+    cache.get('b')
+    cache.get('a')
+    cache.get('c')
+    assert cache.stats()['entries'] == 2
+    assert cache.get('a') == 'a#1'
+    assert cache.get('b') == 'b#4'
+
+
+def test_locations_are_normalized():
+    assert normalize_location("  New York,  NY! ") == normalize_location("new york ny")
+    assert normalize_location(None) == ''
+
+
+def test_providers_are_built_from_the_configuration():
+    provider = components.build({'class': 'lookups.StubTimezoneProvider'})
+    assert isinstance(provider, StubTimezoneProvider)
+    assert provider('rome') == 'Europe/Rome' and provider('atlantis') is None
@@ -0,0 +1,29 @@
+# encoding: utf-8
+'''
+StaticResponse - each encoding of the body is a variant with its own ETag.
+'''
+from __future__ import unicode_literals, division
+
+from flask import Flask
+
+from response_cache import StaticResponse
+
+REPLY = StaticResponse('test', {'messages': [{'_type': 'TextMessage', 'text': "Hello " * 500}]})
+
+APP = Flask(__name__)
+APP.add_url_rule('/reply', 'reply', REPLY.serve, methods=['POST'])
+
+
+def test_each_encoding_has_its_own_etag():
+    client = APP.test_client()
+    etags = set()
+    for encoding in ('identity', 'gzip'):
+        response = client.post('/reply', headers={'Accept-Encoding': encoding})
+        assert response.headers['Vary'] == 'Accept-Encoding'
+        etags.add(response.headers['ETag'])
+        again = client.post('/reply', headers={'Accept-Encoding': encoding, 'If-None-Match': response.headers['ETag']})
+        assert again.status_code == 304 and again.headers['Vary'] == 'Accept-Encoding'
+    assert len(etags) == 2
+    # a client that changed encodings gets the body, not a 304 for the variant it does not have
+    gzip_etag = [etag for etag in etags if etag.endswith('-gzip"')][0]
+    assert client.post('/reply', headers={'Accept-Encoding': 'identity', 'If-None-Match': gzip_etag}).status_code == 200
@@ -0,0 +1,108 @@
+# encoding: utf-8
+'''
+SearchService fan-out, deadline and partial failures - with in-process suppliers.
+'''
+from __future__ import unicode_literals, division
+import json
+import threading
+import time
+
+import pytest
+
+import components
+from search import SearchResult, SearchService, StubSupplier, Supplier
+
+
+class FixedSupplier(Supplier):
+    """Answers `prices`, after `gate` is set if given - counts its calls"""
+
+    def __init__(self, name, kinds, prices, gate=None, error=None):
+        self.name = name
+        self.kinds = tuple(kinds)
+        self.prices = prices
+        self.gate = gate
+        self.error = error
+        self.calls = []
+
+    def search(self, kind, params):
+        self.calls.append((kind, dict(params)))
+        if self.gate is not None:
+            self.gate.wait(5)
+        if self.error is not None:
+            raise self.error
+        return [SearchResult(self.name, "{} {}".format(self.name, price), price) for price in self.prices]
+
+
+def test_fans_out_to_the_suppliers_of_the_kind():
+    first = FixedSupplier('first', ['flight'], [300, 100])
+    second = FixedSupplier('second', ['flight', 'hotel'], [200])
+    hotels = FixedSupplier('hotels', ['hotel'], [50])
+    service = SearchService([first, second, hotels], deadline=1)
+    results, complete = service.search('flight', {'origin': 'LHR'})
+    assert complete
+    assert [(result.supplier, result.price) for result in results] == [('first', 100), ('second', 200),
+                                                                       ('first', 300)]
+    assert first.calls == second.calls == [('flight', {'origin': 'LHR'})]
+    assert hotels.calls == []
+
+
+def test_keeps_the_best_results_and_caches_complete_searches():
+    supplier = FixedSupplier('only', ['car'], [5, 4, 3, 2, 1])
+    service = SearchService([supplier], max_results=3)
+    results, _ = service.search('car', {'location': 'Paris'})
+    assert [result.price for result in results] == [1, 2, 3]
+    again, complete = service.search('car', {'location': ' paris '})
+    assert complete and again == results
+    assert len(supplier.calls) == 1
+
+
+def test_answers_at_the_deadline_without_the_late_supplier():
+    gate = threading.Event()
+    fast = FixedSupplier('fast', ['hotel'], [120])
+    slow = FixedSupplier('slow', ['hotel'], [80], gate=gate)
+    service = SearchService([fast, slow], deadline=0.2)
+    try:
+        started = time.monotonic()
+        results, complete = service.search('hotel', {'location': 'Rome'})
+        elapsed = time.monotonic() - started
+    finally:
+        gate.set()
+    assert 0.2 <= elapsed < 2
+    assert not complete
+    assert [result.supplier for result in results] == ['fast']
+    # an incomplete search is not cached
+    service.search('hotel', {'location': 'Rome'})
+    assert len(fast.calls) == 2
+
+
+def test_a_failing_supplier_costs_only_its_own_results():
+    working = FixedSupplier('working', ['cruise'], [900])
+    broken = FixedSupplier('broken', ['cruise'], [], error=IOError("down"))
+    service = SearchService([working, broken], deadline=1)
+    results, complete = service.search('cruise', {'destination': 'Nassau'})
+    assert not complete
+    assert [result.supplier for result in results] == ['working']
+
+
+def test_unknown_kind_is_rejected():
+    with pytest.raises(ValueError):
+        SearchService([]).search('train', {})
+
+
+def test_suppliers_are_built_from_the_providers_file(tmp_path, monkeypatch):
+    path = tmp_path / 'providers.json'
+    path.write_text(json.dumps({'search': [{'class': 'search.StubSupplier', 'name': 'Configured',
+                                            'kinds': ['flight'], 'results': 2}]}))
+    monkeypatch.setenv(components.PROVIDERS_ENV, str(path))
+    suppliers = [components.build(config) for config in components.providers_config()['search']]
+    assert len(suppliers) == 1 and isinstance(suppliers[0], StubSupplier)
+    results, complete = SearchService(suppliers).search('flight', {'origin': 'TLV', 'destination': 'NYC'})
+    assert complete and len(results) == 2 and results[0].supplier == 'Configured'
+
+
+def test_no_stub_suppliers_on_lambda(monkeypatch):
+    monkeypatch.delenv(components.PROVIDERS_ENV, raising=False)
+    monkeypatch.setenv('AWS_LAMBDA_FUNCTION_NAME', 'webhooks')
+    assert components.providers_config() == {}
+    monkeypatch.delenv('AWS_LAMBDA_FUNCTION_NAME')
+    assert [config['class'] for config in components.providers_config()['search']] == ['search.StubSupplier'] * 3